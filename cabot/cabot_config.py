@@ -1,4 +1,7 @@
 import os
+import tempfile
+
+from cabot.settings_utils import force_bool
 
 # Credentials for Graphite server to monitor
 GRAPHITE_API = os.environ.get('GRAPHITE_API')
@@ -11,15 +14,102 @@ JENKINS_API = os.environ.get('JENKINS_API')
 JENKINS_USER = os.environ.get('JENKINS_USER')
 JENKINS_PASS = os.environ.get('JENKINS_PASS')
 
+# Jenkins checks list every job on their server in one request, which is
+# reused by each worker for this many seconds, so that the batches of checks
+# spread through a scheduling cycle share it. Set to 0 to list jobs per batch.
+JENKINS_JOBS_CACHE_TTL = int(os.environ.get('JENKINS_JOBS_CACHE_TTL', 30))
+
 # Point at a public calendar you want to use to schedule a duty rota
 CALENDAR_ICAL_URL = os.environ.get('CALENDAR_ICAL_URL')
 
+# Occurrences of this many recurring rota events are kept between syncs, so
+# that only the days newly in the window need expanding. 0 turns this off.
+CALENDAR_OCCURRENCE_CACHE_SIZE = int(os.environ.get('CALENDAR_OCCURRENCE_CACHE_SIZE', 1000))
+
+# Duty officers are looked up from shifts held in memory, reloaded when the
+# rota changes, or after this many seconds where Django's cache isn't shared
+# between processes. Set to 0 to look them up in the database every time.
+DUTY_OFFICER_CACHE_MAX_AGE = int(os.environ.get('DUTY_OFFICER_CACHE_MAX_AGE', 60))
+
+# The scheduler and worker metrics (also served at /api/metrics) are logged
+# this often, in seconds
+METRICS_LOG_INTERVAL = int(os.environ.get('METRICS_LOG_INTERVAL', 300))
+# Each process counts in memory and writes its counts to the cache this often
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 30))
+
 # So that links back to the Cabot instance display correctly
 WWW_HTTP_HOST = os.environ.get('WWW_HTTP_HOST')
 WWW_SCHEME = os.environ.get('WWW_SCHEME', "https")
 
 HTTP_USER_AGENT = os.environ.get('HTTP_USER_AGENT', 'Cabot')
 
+# How long (in seconds) a dispatched check is considered in flight before
+# the scheduler will dispatch it again if it still hasn't finished
+CHECK_LEASE_EXPIRY = int(os.environ.get('CHECK_LEASE_EXPIRY', 600))
+
+# Maximum number of checks sent to a worker in a single task
+CHECK_BATCH_SIZE = int(os.environ.get('CHECK_BATCH_SIZE', 50))
+
+# Services and instances are recalculated at most once per this many seconds,
+# however many of their checks finish in between. Set to 0 to recalculate
+# after every check. Needs a cache shared between workers to dedupe across them.
+STATUS_UPDATE_COALESCE_WINDOW = int(os.environ.get('STATUS_UPDATE_COALESCE_WINDOW', 5))
+
+# Send checks to a Celery queue per check type (see Procfile) rather than
+# the default queue
+CELERY_ROUTE_CHECKS_BY_TYPE = force_bool(os.environ.get('CELERY_ROUTE_CHECKS_BY_TYPE', True))
+
+# Number of HTTP checks in a batch which may run at once, and at most how
+# many of those may be talking to the same host
+HTTP_CHECK_CONCURRENCY = int(os.environ.get('HTTP_CHECK_CONCURRENCY', 50))
+HTTP_CHECK_HOST_CONCURRENCY = int(os.environ.get('HTTP_CHECK_HOST_CONCURRENCY', 8))
+
+# HTTP checks keep connections open to the hosts they check: at most this
+# many per host, closed once unused for HTTP_POOL_IDLE_TIMEOUT seconds
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_POOL_IDLE_TIMEOUT = int(os.environ.get('HTTP_POOL_IDLE_TIMEOUT', 300))
+
+# HTTP checks read response bodies a chunk at a time, stopping as soon as
+# text_match is found, and give up after HTTP_CHECK_MAX_BODY_BYTES
+HTTP_CHECK_STREAM_BODY = force_bool(os.environ.get('HTTP_CHECK_STREAM_BODY', True))
+HTTP_CHECK_MAX_BODY_BYTES = int(os.environ.get('HTTP_CHECK_MAX_BODY_BYTES', 10 * 1024 * 1024))
+
+# Compiled text_match patterns are kept for reuse, up to this many per worker
+HTTP_CHECK_PATTERN_CACHE_SIZE = int(os.environ.get('HTTP_CHECK_PATTERN_CACHE_SIZE', 1000))
+# Set to re2 (and install the re2 module) to match text_match patterns in
+# linear time. re2 does not support backreferences or lookaround.
+HTTP_CHECK_REGEX_ENGINE = os.environ.get('HTTP_CHECK_REGEX_ENGINE', 're')
+
+# ICMP checks ping their instances from the worker process itself where
+# the system allows unprivileged ICMP sockets (see net.ipv4.ping_group_range),
+# and otherwise run `ping`. Replies are waited for for ICMP_TIMEOUT seconds.
+ICMP_NATIVE_PROBER = force_bool(os.environ.get('ICMP_NATIVE_PROBER', True))
+ICMP_TIMEOUT = float(os.environ.get('ICMP_TIMEOUT', 5))
+
+# Graphite render responses are reused by checks and the check form for up
+# to the metric's resolution, capped at GRAPHITE_RENDER_CACHE_MAX_TTL seconds.
+# Set GRAPHITE_RENDER_CACHE_SIZE to 0 to turn this off.
+GRAPHITE_RENDER_CACHE_SIZE = int(os.environ.get('GRAPHITE_RENDER_CACHE_SIZE', 1000))
+GRAPHITE_RENDER_CACHE_MAX_TTL = int(os.environ.get('GRAPHITE_RENDER_CACHE_MAX_TTL', 30))
+
+# Format in which to fetch metrics from Graphite: json, raw or msgpack (which
+# needs the msgpack module). msgpack is the quickest to parse for large
+# responses; raw is slower to parse than json. Compare them on your own
+# metrics with bin/benchmark_graphite_formats. JSON is used if the Graphite
+# server doesn't support the format.
+GRAPHITE_FORMAT = os.environ.get('GRAPHITE_FORMAT', 'json')
+
+# Metric names are crawled from Graphite into a file, which the check form's
+# autocomplete is answered from (so it needs to be somewhere both the web
+# and worker processes can see). Top level branches are recrawled when they
+# are older than GRAPHITE_METRIC_INDEX_MAX_AGE seconds, with up to
+# GRAPHITE_METRIC_INDEX_CONCURRENCY requests at a time. Set
+# GRAPHITE_METRIC_INDEX_PATH to an empty string to always ask Graphite.
+GRAPHITE_METRIC_INDEX_PATH = os.environ.get(
+    'GRAPHITE_METRIC_INDEX_PATH', os.path.join(tempfile.gettempdir(), 'cabot_metric_index.json'))
+GRAPHITE_METRIC_INDEX_MAX_AGE = int(os.environ.get('GRAPHITE_METRIC_INDEX_MAX_AGE', 3600))
+GRAPHITE_METRIC_INDEX_CONCURRENCY = int(os.environ.get('GRAPHITE_METRIC_INDEX_CONCURRENCY', 4))
+
 # How often should alerts be sent for important failures?
 ALERT_INTERVAL = int(os.environ.get('ALERT_INTERVAL', 10))
 
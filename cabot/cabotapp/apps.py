@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core import checks
 from django.db.models.signals import post_migrate
 
 
@@ -8,6 +10,18 @@ def post_migrate_callback(**kwargs):
     update_alert_plugins()
     create_default_jenkins_config()
 
+@checks.register(checks.Tags.caches, deploy=True)
+def check_cache_is_shared(**kwargs):
+    if settings.CACHES['default']['BACKEND'].endswith('LocMemCache'):
+        return [checks.Warning(
+            'The default cache is local to each process, so check scheduling, '
+            'metrics and duty rota changes are not shared between workers.',
+            hint='Set CACHE_BACKEND to a shared backend, see conf/production.env.example.',
+            id='cabotapp.W001',
+        )]
+    return []
+
+
 class CabotappConfig(AppConfig):
     name = 'cabot.cabotapp'
 
@@ -1,45 +1,97 @@
 import datetime
+import hashlib
 from django.conf import settings
+from django.core.cache import cache
 from django.utils.timezone import now, get_current_timezone
 from dateutil import rrule
 from icalendar import Calendar
 import requests
 
+from . import metrics
+from .utils import LRUCache
+
 import logging
 logger = logging.getLogger(__name__)
 
 
 MAX_FUTURE = 60  # days
 
+# The validators and hash of the feed as last processed
+FEED_STATE_KEY = 'cabot-calendar-feed'
+
+# An unchanged feed is still processed this often, so that new occurrences
+# of recurring events come into the MAX_FUTURE days window
+REPROCESS_INTERVAL = datetime.timedelta(days=1)
+
+# (uid, last modified, rrule, dtstart, exdates) -> the expanded rruleset and
+# the occurrences of it in the window it was last expanded for
+occurrence_cache = LRUCache(settings.CALENDAR_OCCURRENCE_CACHE_SIZE)
+
 
 def ensure_tzaware(dt):
+    if not isinstance(dt, datetime.datetime):
+        # All day events start and end at midnight
+        dt = datetime.datetime.combine(dt, datetime.time())
     if dt.tzinfo is None:
         return get_current_timezone().localize(dt)
     return dt
 
 
+def _exdates(component):
+    if 'exdate' not in component:
+        return ()
+    lines = component.decoded('exdate')
+    if not hasattr(lines, '__iter__'):
+        lines = [lines]
+    return tuple(ensure_tzaware(exdate.dt) for exdate_line in lines for exdate in exdate_line.dts)
+
+
+def _occurrences(component, utcnow, later):
+    """
+    Start times of a recurring event between `utcnow` and `later`.
+
+    The rruleset caches what it has generated, and the occurrences found
+    last time are reused, so that only the days which have come into the
+    window since are expanded.
+    """
+    rrule_as_str = component.get('rrule').to_ical()
+    dtstart = ensure_tzaware(component.decoded('dtstart'))
+    exdates = _exdates(component)
+    # The uid and last modified time are part of the key, so that an edited
+    # event is never answered from what was expanded for an older version
+    key = (component.decoded('uid'), component.decoded('last-modified'), rrule_as_str, dtstart, exdates)
+    cached = occurrence_cache.get(key)
+    if cached is None:
+        metrics.incr('calendar.occurrence_cache.misses')
+        recur_set = rrule.rruleset(cache=True)
+        recur_set.rrule(rrule.rrulestr(rrule_as_str, dtstart=dtstart, cache=True))
+        for exdate in exdates:
+            recur_set.exdate(exdate)
+        cached = {'rruleset': recur_set}
+    else:
+        metrics.incr('calendar.occurrence_cache.hits')
+        recur_set = cached['rruleset']
+
+    if 'after' in cached and cached['after'] <= utcnow <= cached['before'] <= later:
+        start_times = [start for start in cached['start_times'] if start > utcnow]
+        start_times.extend(start for start in recur_set.between(cached['before'], later, inc=True)
+                           if start != later)
+    else:
+        start_times = recur_set.between(utcnow, later)
+    cached.update(after=utcnow, before=later, start_times=start_times)
+    occurrence_cache.set(key, cached)
+    return start_times
+
+
 def _recurring_component_to_events(component):
     """
     Given an icalendar component with an "RRULE"
     Return a list of events as dictionaries
     """
-    rrule_as_str = component.get('rrule').to_ical()
-    recur_rule = rrule.rrulestr(rrule_as_str,
-                                dtstart=ensure_tzaware(component.decoded('dtstart')))
-    recur_set = rrule.rruleset()
-    recur_set.rrule(recur_rule)
-    if 'exdate' in component:
-        lines = component.decoded('exdate')
-        if not hasattr(lines, '__iter__'):
-            lines = [lines]
-        for exdate_line in lines:
-            for exdate in exdate_line.dts:
-                recur_set.exdate(ensure_tzaware(exdate.dt))
-
     # get list of events in MAX_FUTURE days
     utcnow = now()
     later = utcnow + datetime.timedelta(days=MAX_FUTURE)
-    start_times = recur_set.between(utcnow, later)
+    start_times = _occurrences(component, utcnow, later)
 
     # build list of events
     event_length = component.decoded('dtend') - component.decoded('dtstart')
@@ -62,9 +114,53 @@ def get_calendar_data():
     return cal
 
 
-def get_events():
+def get_changed_events():
+    """
+    Returns the events in the rota feed and the state to pass to
+    `save_feed_state` once they have been processed, or (None, None) if the
+    feed hasn't changed since it was last processed.
+
+    The feed is fetched with a conditional GET, so an unchanged feed costs a
+    304, and its content is hashed for servers which don't support that.
+    """
+    feed_url = settings.CALENDAR_ICAL_URL
+    state = cache.get(FEED_STATE_KEY)
+    if not state or state['url'] != feed_url:
+        state = {'url': feed_url, 'etag': None, 'last_modified': None, 'hash': None, 'processed_at': None}
+    recent = state['processed_at'] and now() - state['processed_at'] < REPROCESS_INTERVAL
+
+    headers = {}
+    if recent and state['etag']:
+        headers['If-None-Match'] = state['etag']
+    if recent and state['last_modified']:
+        headers['If-Modified-Since'] = state['last_modified']
+    resp = requests.get(feed_url, headers=headers)
+    if resp.status_code == 304:
+        metrics.incr('calendar.not_modified')
+        return None, None
+    resp.raise_for_status()
+
+    previous_hash = state['hash']
+    state = dict(state, etag=resp.headers.get('ETag'), last_modified=resp.headers.get('Last-Modified'),
+                 hash=hashlib.sha1(resp.content).hexdigest())
+    if recent and state['hash'] == previous_hash:
+        metrics.incr('calendar.unchanged')
+        # Keep the new validators, so the next fetch can be conditional
+        cache.set(FEED_STATE_KEY, state, timeout=None)
+        return None, None
+    return get_events(Calendar.from_ical(resp.content)), state
+
+
+def save_feed_state(state):
+    """Records that the feed described by `state` has been processed"""
+    cache.set(FEED_STATE_KEY, dict(state, processed_at=now()), timeout=None)
+
+
+def get_events(calendar=None):
+    if calendar is None:
+        calendar = get_calendar_data()
     events = []
-    for component in get_calendar_data().walk():
+    for component in calendar.walk():
         if component.name == 'VEVENT':
             if 'rrule' in component:
                 events.extend(_recurring_component_to_events(component))
@@ -1,36 +1,252 @@
 from django.conf import settings
 import requests
 import logging
+import operator
+import re
 import time
 
+from . import metric_index, metrics
+from .utils import LRUCache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 graphite_api = settings.GRAPHITE_API
 user = settings.GRAPHITE_USER
 password = settings.GRAPHITE_PASS
 graphite_from = settings.GRAPHITE_FROM
 auth = (user, password)
 
+# Series fetched together in one render request are tagged with the index
+# of the target they came from, so that they can be split up again
+BATCH_TAG = '__cabot_%d__'
+BATCH_TAG_RE = re.compile(r'^__cabot_(\d+)__(.*)$', re.DOTALL)
+
+
+# Content types Graphite sends each format with. Versions which don't know
+# a format render a PNG instead, so anything else means it's unsupported.
+FORMAT_CONTENT_TYPES = {
+    'json': 'application/json',
+    'raw': 'text/plain',
+    'msgpack': 'application/x-msgpack',
+}
+
+# Formats the Graphite server turned out not to support
+unsupported_formats = set()
+
+# Responses with at least this many datapoints are evaluated with numpy
+# arrays, if it is installed. Below that, setting up the arrays costs more
+# than it saves.
+ARRAY_MIN_POINTS = 2000
+
+# The series statistic and comparison failing each check type
+THRESHOLD_COMPARISONS = {
+    '<': ('min', operator.lt),
+    '<=': ('min', operator.le),
+    '>': ('max', operator.gt),
+    '>=': ('max', operator.ge),
+}
+
+
+# Render responses, keyed by (normalised target, from). Shared by check
+# runs and the check form's preview, and not to be modified by callers.
+render_cache = LRUCache(settings.GRAPHITE_RENDER_CACHE_SIZE)
 
-def get_data(target_pattern, mins_to_check=None):
 
+def get_from(mins_to_check=None):
     if mins_to_check:
-        _from = '-%dminute' % mins_to_check
-    else:
-        _from = graphite_from
+        return '-%dminute' % mins_to_check
+    return graphite_from
 
-    resp = requests.get(
-        graphite_api + 'render', auth=auth,
-        params={
-            'target': target_pattern,
-            'format': 'json',
-            'from': _from,
-        }
-    )
-    resp.raise_for_status()
-    return resp.json()
 
+def window_minutes(frequency, last_started, now):
+    """
+    Minutes of data a check run at `now` looks at: its frequency, or
+    everything since its last run started if that was longer ago.
+    """
+    if last_started is None:
+        return frequency
+    return max(frequency, ((now - last_started).total_seconds() / 60) + 1)
 
-def get_matching_metrics(pattern):
-    print 'Getting metrics matching %s' % pattern
+
+def normalize_target(target):
+    """Drops whitespace outside quoted strings, so equivalent targets share a cache entry"""
+    normalized = []
+    quote = None
+    for char in target.strip():
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '\'"':
+            quote = char
+        elif char.isspace():
+            continue
+        normalized.append(char)
+    return ''.join(normalized)
+
+
+def cache_ttl(data):
+    """
+    Seconds for which a render response can be reused: the step between
+    datapoints, as no new point is expected sooner, capped by
+    GRAPHITE_RENDER_CACHE_MAX_TTL.
+    """
+    for series in data:
+        points = series.get('datapoints') or []
+        if len(points) >= 2 and points[1][1] > points[0][1]:
+            return min(points[1][1] - points[0][1], settings.GRAPHITE_RENDER_CACHE_MAX_TTL)
+    return settings.GRAPHITE_RENDER_CACHE_MAX_TTL
+
+
+def get_cached(keys):
+    """The cached render responses for `keys`, with None for those not cached"""
+    found = [render_cache.get(key) for key in keys]
+    misses = found.count(None)
+    # Counted once per lookup rather than once per key
+    if misses < len(found):
+        metrics.incr('graphite.render_cache.hits', len(found) - misses)
+    if misses:
+        metrics.incr('graphite.render_cache.misses', misses)
+    return found
+
+
+def render_format():
+    fmt = settings.GRAPHITE_FORMAT
+    if fmt not in FORMAT_CONTENT_TYPES:
+        logging.warning('Unknown GRAPHITE_FORMAT %s, using json' % fmt)
+        return 'json'
+    if fmt == 'msgpack' and msgpack is None:
+        logging.warning('GRAPHITE_FORMAT is msgpack but the msgpack module is not installed, using json')
+        return 'json'
+    if fmt in unsupported_formats:
+        return 'json'
+    return fmt
+
+
+def series_from_raw(lines):
+    """
+    Parses Graphite's raw format, a line per series of
+    `name,start,end,step|value,value,...`, into series as the JSON format
+    gives them.
+    """
+    data = []
+    for line in lines:
+        if not line:
+            continue
+        header, values = line.rsplit('|', 1)
+        name, start, end, step = header.rsplit(',', 3)
+        values = [None if v == 'None' else float(v) for v in values.split(',')] if values else []
+        data.append({
+            'target': name,
+            'datapoints': [[v, t] for v, t in zip(values, xrange(int(start), int(end), int(step)))],
+        })
+    return data
+
+
+def series_from_msgpack(content):
+    """Parses Graphite's msgpack format into series as the JSON format gives them"""
+    data = []
+    for series in msgpack.unpackb(content, raw=False):
+        timestamps = xrange(series['start'], series['end'], series['step'])
+        data.append({
+            'target': series['name'],
+            'datapoints': [[v, t] for v, t in zip(series['values'], timestamps)],
+        })
+    return data
+
+
+def render(method, fields):
+    """
+    Requests series from Graphite's render API with `method` ('get' or
+    'post'), in the format set by GRAPHITE_FORMAT, and returns them as the
+    JSON format would. If the server sends back something other than the
+    format asked for, JSON is used from then on.
+    """
+    fmt = render_format()
+    kwargs = {'params' if method == 'get' else 'data': dict(fields, format=fmt)}
+    if fmt == 'raw':
+        # Parsed a line at a time rather than held in memory all at once
+        kwargs['stream'] = True
+    resp = getattr(requests, method)(graphite_api + 'render', auth=auth, **kwargs)
+    try:
+        resp.raise_for_status()
+        if fmt == 'json':
+            return resp.json()
+        content_type = resp.headers.get('content-type', '').split(';')[0].strip()
+        try:
+            if content_type != FORMAT_CONTENT_TYPES[fmt]:
+                raise ValueError('got a %s response' % content_type)
+            if fmt == 'raw':
+                return series_from_raw(resp.iter_lines(decode_unicode=True))
+            return series_from_msgpack(resp.content)
+        except (ValueError, TypeError, KeyError) as e:
+            logging.warning('Graphite does not support format=%s (%s), using json' % (fmt, e))
+            unsupported_formats.add(fmt)
+            return render(method, fields)
+    finally:
+        resp.close()
+
+
+def get_data(target_pattern, mins_to_check=None):
+    _from = get_from(mins_to_check)
+    key = (normalize_target(target_pattern), _from)
+    data = get_cached([key])[0]
+    if data is not None:
+        return data
+    data = render('get', {
+        'target': target_pattern,
+        'from': _from,
+    })
+    render_cache.set(key, data, cache_ttl(data))
+    return data
+
+
+def get_data_many(target_patterns, mins_to_check=None):
+    """
+    Fetches several targets over the same window in a single render
+    request. Returns a list holding the series of each target, in the same
+    order as `target_patterns`.
+
+    One bad target fails the whole request, so callers should fall back to
+    fetching targets one at a time if this raises.
+    """
+    _from = get_from(mins_to_check)
+    keys = [(normalize_target(target), _from) for target in target_patterns]
+    split = get_cached(keys)
+    missing = [i for i, data in enumerate(split) if data is None]
+    if not missing:
+        return split
+
+    tagged = ["aliasSub(%s, '^', '%s')" % (target_patterns[i], BATCH_TAG % i) for i in missing]
+    # Sent as a form rather than in the query string as there may be many
+    data = render('post', {
+        'target': tagged,
+        'from': _from,
+    })
+    for i in missing:
+        split[i] = []
+    for series in data:
+        match = BATCH_TAG_RE.match(series['target'])
+        if match is None or int(match.group(1)) not in missing:
+            logging.warning('Unexpected series in batched Graphite response: %s' % series['target'])
+            continue
+        series['target'] = match.group(2)
+        split[int(match.group(1))].append(series)
+    for i in missing:
+        render_cache.set(keys[i], split[i], cache_ttl(split[i]))
+    return split
+
+
+def find_metrics(pattern):
+    """Asks Graphite for the nodes matching `pattern`"""
+    logging.debug('Getting metrics matching %s' % pattern)
     resp = requests.get(
         graphite_api + 'metrics/find/', auth=auth,
         params={
@@ -45,23 +261,30 @@ def get_matching_metrics(pattern):
     return resp.json()
 
 
+def get_matching_metrics(pattern):
+    """
+    Nodes matching `pattern`, from the local metric index if it has been
+    built, or else from Graphite.
+    """
+    index = metric_index.current()
+    if index is not None:
+        return index.find(pattern)
+    return find_metrics(pattern)
+
+
 def get_all_metrics(limit=None):
     """Grabs all metrics by navigating find API recursively"""
-    metrics = []
+    return metric_index.crawl(find_metrics, [''], settings.GRAPHITE_METRIC_INDEX_CONCURRENCY)['']
 
-    def get_leafs_of_node(nodepath):
-        for obj in get_matching_metrics(nodepath)['metrics']:
-            if int(obj['is_leaf']) == 1:
-                metrics.append(obj['path'])
-            else:
-                get_leafs_of_node(obj['path'])
-    get_leafs_of_node('')
-    return metrics
 
+def update_metric_index():
+    """Recrawls the stale parts of the local metric index and saves it"""
+    index = metric_index.refresh(metric_index.current(), find_metrics)
+    index.save(settings.GRAPHITE_METRIC_INDEX_PATH)
+    return index
 
-def parse_metric(metric, mins_to_check=5, utcnow=None):
-    if utcnow is None:
-        utcnow = time.time()
+
+def parse_metric(metric, mins_to_check=5, utcnow=None, aggregate=None):
     ret = {
         'num_series_with_data': 0,
         'num_series_no_data': 0,
@@ -70,12 +293,79 @@ def parse_metric(metric, mins_to_check=5, utcnow=None):
         'series': [],
     }
     try:
-        data = get_data(metric, mins_to_check)
+        data = get_data(metric_target(metric, aggregate), mins_to_check)
     except requests.exceptions.RequestException, e:
         ret['error'] = 'Error getting data from Graphite: %s' % e
         ret['raw'] = ret['error']
         logging.error('Error getting data from Graphite: %s' % e)
         return ret
+    if aggregate:
+        return parse_aggregated_data(data, metric, aggregate, mins_to_check, utcnow)
+    return parse_data(data, mins_to_check, utcnow)
+
+
+# Names of the series in the response to an aggregated target
+AGGREGATE_ALIAS = '__cabot_aggregate__'
+COUNT_ALIAS = '__cabot_count__'
+SUM_ALIAS = '__cabot_sum__'
+POINTS_ALIAS = '__cabot_points__'
+
+
+def metric_target(metric, aggregate=None):
+    """
+    The target to render for `metric`. With an `aggregate` function (such
+    as maxSeries) that is the single series it reduces the metric's series
+    to, together with the number of them which have any data and the sum
+    and number of their values at each point in time (for the average), so
+    that only four series come back however many the metric has.
+    """
+    if not aggregate:
+        return metric
+    return ("group(alias(%s(%s), '%s'), alias(countSeries(removeEmptySeries(%s)), '%s'), "
+            "alias(sumSeries(%s), '%s'), alias(sumSeries(isNonNull(%s)), '%s'))") % (
+        aggregate, metric, AGGREGATE_ALIAS, metric, COUNT_ALIAS, metric, SUM_ALIAS, metric, POINTS_ALIAS)
+
+
+def parse_aggregated_data(data, metric, aggregate, mins_to_check=5, utcnow=None):
+    """
+    Summarises the response to an aggregated `metric_target` as for
+    `parse_data`, with the aggregate as the only series but the number of
+    series with data, and the average of all their values, being those of
+    the metric itself.
+    """
+    ret = parse_data([s for s in data if s['target'] == AGGREGATE_ALIAS], mins_to_check, utcnow)
+    for series in ret['series']:
+        series['target'] = '%s(%s)' % (aggregate, metric)
+    if utcnow is None:
+        utcnow = time.time()
+
+    def values(alias):
+        return [value for s in data if s['target'] == alias for value, timestamp in s['datapoints']
+                if validate_datapoint((value, timestamp), mins_to_check, utcnow)]
+    counts = [value for s in data if s['target'] == COUNT_ALIAS for value, _ in s['datapoints']
+              if value is not None]
+    ret['num_series_with_data'] = int(max(counts)) if counts else 0
+    ret['num_series_no_data'] = 0
+    num_points = sum(values(POINTS_ALIAS))
+    if num_points:
+        ret['average_value'] = float(sum(values(SUM_ALIAS))) / num_points
+    ret['raw'] = data
+    return ret
+
+
+def parse_data(data, mins_to_check=5, utcnow=None):
+    """Summarises series returned by Graphite, as for `parse_metric`"""
+    if utcnow is None:
+        utcnow = time.time()
+    if numpy is not None and sum(len(target['datapoints']) for target in data) >= ARRAY_MIN_POINTS:
+        return parse_data_arrays(data, mins_to_check, utcnow)
+    ret = {
+        'num_series_with_data': 0,
+        'num_series_no_data': 0,
+        'error': None,
+        'raw': '',
+        'series': [],
+    }
     all_values = []
     for target in data:
         series = {'values': [
@@ -96,6 +386,83 @@ def parse_metric(metric, mins_to_check=5, utcnow=None):
     ret['raw'] = data
     return ret
 
+
+def parse_data_arrays(data, mins_to_check, utcnow):
+    """
+    Same as `parse_data`, with the datapoints of every series in one array
+    so that missing and out of window points are dropped, and each series'
+    min, max and average found, without a Python loop over the points.
+    Each series' values (and all_values) are arrays rather than lists.
+    Averages are summed pairwise rather than in order, so can differ from
+    `parse_data`'s in the last bits.
+    """
+    ret = {
+        'num_series_with_data': 0,
+        'num_series_no_data': 0,
+        'error': None,
+        'raw': data,
+        'series': [],
+    }
+    lengths = [len(target['datapoints']) for target in data]
+    total = sum(lengths)
+    # Filled straight from the points, which is much quicker than building
+    # arrays from the [value, timestamp] lists
+    values = numpy.fromiter(
+        (numpy.nan if value is None else value for target in data for value, _ in target['datapoints']),
+        numpy.float64, total)
+    timestamps = numpy.fromiter(
+        (timestamp for target in data for _, timestamp in target['datapoints']), numpy.float64, total)
+    keep = ~numpy.isnan(values) & (timestamps > utcnow - 60 * mins_to_check)
+    values = values[keep]
+    counts = numpy.bincount(numpy.repeat(numpy.arange(len(data)), lengths)[keep], minlength=len(data))
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+    with_data = counts > 0
+    if values.size:
+        firsts = starts[with_data]
+        maxes = numpy.maximum.reduceat(values, firsts).tolist()
+        mins = numpy.minimum.reduceat(values, firsts).tolist()
+        averages = (numpy.add.reduceat(values, firsts) / counts[with_data]).tolist()
+        ret['average_value'] = float(values.sum() / values.size)
+
+    n = 0
+    for target, start, end in zip(data, starts.tolist(), ends.tolist()):
+        if start == end:
+            ret['num_series_no_data'] += 1
+            continue
+        ret['series'].append({
+            'target': target['target'],
+            'values': values[start:end],
+            'max': maxes[n],
+            'min': mins[n],
+            'average_value': averages[n],
+        })
+        n += 1
+    ret['num_series_with_data'] = n
+    ret['all_values'] = values
+    return ret
+
+
+def series_failures(series, check_type, threshold):
+    """
+    The (target, value) of each of the series `parse_data` gave whose
+    values fail a check of `check_type` against `threshold`.
+    """
+    if not series:
+        return []
+    if check_type == '==':
+        return [(s['target'], threshold) for s in series if threshold in s['values']]
+    if check_type not in THRESHOLD_COMPARISONS:
+        raise Exception(u'Check type %s not supported' % check_type)
+    key, compare = THRESHOLD_COMPARISONS[check_type]
+    values = [s[key] for s in series]
+    if numpy is not None:
+        failing = compare(numpy.array(values), threshold).tolist()
+    else:
+        failing = [compare(value, threshold) for value in values]
+    return [(s['target'], value) for s, value, failed in zip(series, values, failing) if failed]
+
+
 def validate_datapoint(datapoint, mins_to_check, utcnow):
     val, timestamp = datapoint
     secs_to_check = 60 * mins_to_check
@@ -0,0 +1,367 @@
+import codecs
+import cookielib
+import logging
+import re
+import socket
+import threading
+import time
+from timeit import default_timer
+from urlparse import urlparse
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.utils import timezone
+from requests.packages.urllib3.connection import HTTPConnection, VerifiedHTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from requests.packages.urllib3.util import connection
+
+from .utils import LRUCache
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidPattern(ValueError):
+    pass
+
+
+_patterns = LRUCache(settings.HTTP_CHECK_PATTERN_CACHE_SIZE)
+# Resolved on first use by regex_engine
+_engine = None
+
+
+def regex_engine():
+    """
+    The module used to compile text_match patterns. re2 matches in linear
+    time, so a pathological pattern can't tie up a worker, but it does not
+    support backreferences or lookaround.
+    """
+    global _engine
+    if _engine is None:
+        _engine = re
+        if settings.HTTP_CHECK_REGEX_ENGINE == 're2':
+            if re2 is not None:
+                _engine = re2
+            else:
+                logger.warning('HTTP_CHECK_REGEX_ENGINE is re2 but the re2 module is not installed, using re')
+    return _engine
+
+
+def compile_text_match(pattern, flags=0):
+    """
+    Compiles a text_match pattern, keeping the most recently used ones so
+    that they are not recompiled on every run.
+    """
+    engine = regex_engine()
+    key = (engine.__name__, pattern, flags)
+    compiled = _patterns.get(key)
+    if compiled is None:
+        try:
+            compiled = engine.compile(pattern, flags)
+        except Exception as e:
+            raise InvalidPattern(u'Invalid regular expression /%s/: %s' % (pattern, e))
+        _patterns.set(key, compiled)
+    return compiled
+
+
+class NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """
+    Stops pooled sessions from carrying cookies from one check to the next.
+    Cookies set during redirects within a single request still work, as
+    requests keeps those in a jar of its own.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+
+class TimedConnectionMixin(object):
+    """
+    Records how long resolving the host and connecting to it take, in
+    `phase_timings`. The host is resolved here and its addresses then tried
+    in turn, as urllib3 would do.
+    """
+    phase_timings = None
+
+    def _new_conn(self):
+        extra_kw = {}
+        if self.source_address:
+            extra_kw['source_address'] = self.source_address
+        if self.socket_options:
+            extra_kw['socket_options'] = self.socket_options
+
+        start = default_timer()
+        try:
+            addresses = socket.getaddrinfo(self.host.strip('[]'), self.port,
+                                           connection.allowed_gai_family(), socket.SOCK_STREAM)
+            if not addresses:
+                raise socket.error('getaddrinfo returns an empty list')
+            resolved = default_timer()
+            for i, address in enumerate(addresses):
+                try:
+                    conn = connection.create_connection(
+                        (address[4][0], self.port), self.timeout, **extra_kw)
+                    break
+                except socket.error:
+                    if i == len(addresses) - 1:
+                        raise
+        except socket.timeout:
+            raise ConnectTimeoutError(
+                self, "Connection to %s timed out. (connect timeout=%s)" %
+                (self.host, self.timeout))
+        except socket.error as e:
+            raise NewConnectionError(
+                self, "Failed to establish a new connection: %s" % e)
+
+        self.phase_timings = {
+            'dns': resolved - start,
+            'connect': default_timer() - resolved,
+        }
+        return conn
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, VerifiedHTTPSConnection):
+
+    def connect(self):
+        start = default_timer()
+        super(TimedHTTPSConnection, self).connect()
+        self.phase_timings['tls'] = (default_timer() - start -
+                                     self.phase_timings['dns'] - self.phase_timings['connect'])
+
+
+class TimedPoolMixin(object):
+    """
+    Attaches the timings of each request to its httplib response, as
+    `phase_timings`. Connections which are reused from the pool report no
+    time spent resolving, connecting or on the TLS handshake.
+    """
+
+    def _make_request(self, conn, *args, **kwargs):
+        start = default_timer()
+        response = super(TimedPoolMixin, self)._make_request(conn, *args, **kwargs)
+        elapsed = default_timer() - start
+        timings = conn.phase_timings or {'dns': 0, 'connect': 0, 'tls': 0}
+        conn.phase_timings = None
+        if self.scheme != 'https':
+            timings['tls'] = None
+        timings['ttfb'] = elapsed - sum(t for t in timings.values() if t)
+        response.phase_timings = timings
+        return response
+
+
+class TimedHTTPConnectionPool(TimedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(TimedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter whose connections record per-phase timings"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+def phase_timings(resp):
+    """
+    Seconds spent on DNS, connect, TLS and waiting for the first byte of
+    the (final) response, or an empty dict if they weren't recorded.
+    """
+    original = getattr(resp.raw, '_original_response', None)
+    return getattr(original, 'phase_timings', None) or {}
+
+
+class SessionRegistry(object):
+    """
+    Keeps a requests Session (and so a pool of keep-alive connections) per
+    scheme, host and TLS verification setting, so that checks against the
+    same host reuse connections rather than doing a TCP and TLS handshake
+    every time. Sessions unused for HTTP_POOL_IDLE_TIMEOUT seconds are closed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, url, verify=True):
+        parsed = urlparse(url)
+        key = (parsed.scheme.lower(), parsed.netloc.lower(), bool(verify))
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            if key not in self._sessions:
+                self._sessions[key] = [self._new_session(), now]
+            entry = self._sessions[key]
+            entry[1] = now
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            for session, last_used in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _new_session(self):
+        session = requests.Session()
+        session.cookies.set_policy(NoCookiesPolicy())
+        adapter = TimedHTTPAdapter(
+            pool_connections=1, pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _evict_idle(self, now):
+        idle_since = now - settings.HTTP_POOL_IDLE_TIMEOUT
+        for key, (session, last_used) in self._sessions.items():
+            if last_used < idle_since:
+                session.close()
+                del self._sessions[key]
+
+
+sessions = SessionRegistry()
+
+
+def pooled_get(url, verify=True, **kwargs):
+    """Like `requests.get`, but reusing connections to the url's host"""
+    return sessions.get(url, verify).get(url, verify=verify, **kwargs)
+
+
+# Size of the pieces in which streamed response bodies are read
+BODY_CHUNK_SIZE = 64 * 1024
+
+# How much of the text before each new chunk is searched along with it
+MATCH_OVERLAP = 4096  # characters
+
+
+def read_body(resp, pattern=None, max_bytes=None, max_chars=None):
+    """
+    Reads and decodes a streamed response body a chunk at a time, stopping
+    as soon as `pattern` (a compiled regex) matches, or once `max_bytes`
+    bytes have been read or `max_chars` characters decoded.
+
+    Each new chunk is searched along with the last MATCH_OVERLAP characters
+    before it, so that the cost stays linear in the size of the body.
+    Matches longer than that are still found, by a search of all the text
+    once reading stops, but don't stop reading early.
+
+    Returns a (text, match, complete) tuple, where `complete` is False if
+    reading stopped before the end of the body.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(resp.encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    chunks = []
+    length = 0
+    tail = u''
+    read = 0
+    complete = False
+    try:
+        for chunk in resp.iter_content(chunk_size=BODY_CHUNK_SIZE):
+            if max_bytes is not None:
+                chunk = chunk[:max_bytes - read]
+            read += len(chunk)
+            decoded = decoder.decode(chunk)
+            chunks.append(decoded)
+            length += len(decoded)
+            if pattern is not None and decoded:
+                window = tail + decoded
+                if pattern.search(window):
+                    # Search the real text, where anchors and lookbehinds
+                    # see what comes before the window
+                    text = u''.join(chunks)
+                    match = pattern.search(text, length - len(window))
+                    if match:
+                        return text, match, False
+                tail = window[-MATCH_OVERLAP:]
+            if max_chars is not None and length >= max_chars:
+                break
+            if max_bytes is not None and read >= max_bytes:
+                break
+        else:
+            chunks.append(decoder.decode(b'', final=True))
+            complete = True
+    finally:
+        resp.close()
+    text = u''.join(chunks)
+    match = pattern.search(text) if pattern is not None else None
+    return text, match, complete
+
+
+def discard_body(resp, max_bytes):
+    """
+    Reads and throws away up to `max_bytes` of a streamed response body, so
+    that its connection can go back to the pool, then closes it.
+    """
+    read = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=BODY_CHUNK_SIZE):
+            read += len(chunk)
+            if read >= max_bytes:
+                break
+    finally:
+        resp.close()
+
+
+class HostLimiter(object):
+    """Bounds how many requests may be in flight to any one host"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def for_url(self, url):
+        host = urlparse(url or '').netloc.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+
+def run_concurrently(checks):
+    """
+    Runs a list of HTTP checks on a pool of threads, so a batch takes about
+    as long as its slowest check rather than the sum of all of them.
+
+    Returns a list of (check, result, start, finish) tuples in the same
+    order as `checks`. Nothing is written to the database.
+    """
+    if not checks:
+        return []
+    limiter = HostLimiter(settings.HTTP_CHECK_HOST_CONCURRENCY)
+
+    def run_one(check):
+        with limiter.for_url(check.endpoint):
+            start = timezone.now()
+            result = check._run_catching_errors()
+            finish = timezone.now()
+        return check, result, start, finish
+
+    executor = ThreadPoolExecutor(max_workers=min(settings.HTTP_CHECK_CONCURRENCY, len(checks)))
+    try:
+        return list(executor.map(run_one, checks))
+    finally:
+        executor.shutdown()
@@ -0,0 +1,212 @@
+"""
+Pings many hosts at once from a single process.
+
+Uses Linux's unprivileged ICMP datagram sockets (which need the worker's
+group to be within net.ipv4.ping_group_range), so no raw socket capability
+or `ping` subprocess is needed. The kernel sets the echo identifier of each
+request to the socket's port, and replies are matched back to their
+requests by source address and sequence number.
+"""
+import errno
+import logging
+import select
+import socket
+import struct
+from collections import deque
+from timeit import default_timer
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+# Sequence numbers are 16 bit, so each socket can have this many probes
+# outstanding before they'd become ambiguous
+MAX_PROBES_PER_SOCKET = 0xffff
+
+PAYLOAD = b'cabot-ping'
+
+# Host names are looked up this many at a time, so that one slow DNS answer
+# doesn't hold up every other target's
+RESOLVER_THREADS = 8
+
+
+class ProbeResult(object):
+    """Outcome of pinging one address"""
+
+    def __init__(self, address):
+        self.address = address
+        self.sent = 0
+        self.rtts = []
+        self.error = None
+
+    @property
+    def received(self):
+        return len(self.rtts)
+
+    def __repr__(self):
+        return '<ProbeResult %s: %d/%d>' % (self.address, self.received, self.sent)
+
+
+def open_socket():
+    """An unprivileged ICMP socket, or None if the system doesn't allow them"""
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except (socket.error, AttributeError) as e:
+        logger.debug('ICMP datagram sockets are unavailable: %s', e)
+        return None
+    sock.bind(('', 0))
+    sock.setblocking(False)
+    return sock
+
+
+def is_available():
+    sock = open_socket()
+    if sock is None:
+        return False
+    sock.close()
+    return True
+
+
+def checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(ident, seq):
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum(header + PAYLOAD), ident, seq)
+    return header + PAYLOAD
+
+
+def resolve(targets):
+    """
+    Returns a dict of target -> IPv4 address, and a dict of target -> error
+    for targets which couldn't be resolved.
+    """
+    def resolve_one(target):
+        try:
+            return target, socket.getaddrinfo(target, None, socket.AF_INET)[0][4][0], None
+        except socket.error as e:
+            return target, None, u'ping: unknown host %s (%s)' % (target, e)
+
+    addresses = {}
+    errors = {}
+    targets = list(targets)
+    if not targets:
+        return addresses, errors
+    executor = ThreadPoolExecutor(max_workers=min(RESOLVER_THREADS, len(targets)))
+    try:
+        for target, address, error in executor.map(resolve_one, targets):
+            if error is None:
+                addresses[target] = address
+            else:
+                errors[target] = error
+    finally:
+        executor.shutdown()
+    return addresses, errors
+
+
+def ping(targets, count=1, interval=1.0, timeout=5.0):
+    """
+    Sends `count` echo requests, `interval` seconds apart, to each of
+    `targets` (host names or IPv4 addresses), and waits up to `timeout`
+    seconds after the last of them for replies.
+
+    Returns a dict of target -> ProbeResult. Raises socket.error if ICMP
+    datagram sockets are unavailable.
+    """
+    targets = set(targets)
+    addresses, errors = resolve(targets)
+    by_address = {}
+    for address in set(addresses.values()):
+        by_address[address] = ProbeResult(address)
+
+    # Keep each socket's probes within the sequence number space
+    per_socket = max(MAX_PROBES_PER_SOCKET // max(count, 1), 1)
+    unique = sorted(by_address)
+    for i in range(0, len(unique), per_socket):
+        _ping_addresses([by_address[a] for a in unique[i:i + per_socket]], count, interval, timeout)
+
+    results = {}
+    for target in targets:
+        if target in errors:
+            result = ProbeResult(None)
+            result.error = errors[target]
+        else:
+            result = by_address[addresses[target]]
+        results[target] = result
+    return results
+
+
+def _ping_addresses(probes, count, interval, timeout):
+    sock = open_socket()
+    if sock is None:
+        raise socket.error(errno.EPERM, 'ICMP datagram sockets are unavailable')
+    try:
+        ident = sock.getsockname()[1]
+        start = default_timer()
+        # (due time, probe number, result) of echo requests still to send
+        to_send = deque((start + n * interval, n, result) for n in range(count) for result in probes)
+        # (address, sequence number) -> (result, time sent)
+        in_flight = {}
+        seq = 0
+        deadline = start + max(count - 1, 0) * interval + timeout
+
+        while to_send or in_flight:
+            now = default_timer()
+            if now >= deadline:
+                break
+            blocked = False
+            while to_send and to_send[0][0] <= now:
+                due, n, result = to_send.popleft()
+                seq = (seq + 1) & 0xffff
+                try:
+                    sock.sendto(echo_request(ident, seq), (result.address, 0))
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.ENOBUFS):
+                        # Socket buffer is full, try again once some replies are read
+                        to_send.appendleft((due, n, result))
+                        blocked = True
+                        break
+                    result.sent += 1
+                    result.error = u'ping: %s: %s' % (result.address, e.strerror or e)
+                    continue
+                result.sent += 1
+                in_flight[(result.address, seq)] = (result, default_timer())
+
+            wait = deadline - default_timer()
+            if to_send and not blocked:
+                wait = min(wait, to_send[0][0] - default_timer())
+            readable, _, _ = select.select([sock], [sock] if blocked else [], [], max(wait, 0))
+            if readable:
+                _read_replies(sock, ident, in_flight)
+        return probes
+    finally:
+        sock.close()
+
+
+def _read_replies(sock, ident, in_flight):
+    while True:
+        try:
+            data, (address, _) = sock.recvfrom(1024)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        received = default_timer()
+        if len(data) < 8:
+            continue
+        icmp_type, code, _, reply_ident, seq = struct.unpack('!BBHHH', data[:8])
+        if icmp_type != ICMP_ECHO_REPLY or reply_ident != ident:
+            continue
+        sent = in_flight.pop((address, seq), None)
+        if sent is not None:
+            result, sent_at = sent
+            result.rtts.append(received - sent_at)
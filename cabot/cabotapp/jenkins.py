@@ -1,20 +1,37 @@
 from __future__ import absolute_import
 
+import hashlib
 from datetime import datetime
 
 import jenkins
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 
+from . import metrics
+from .utils import LRUCache
+
 logger = get_task_logger(__name__)
 
+# Completed builds don't change, so what's needed of them is kept for this
+# long, keyed by job, and only fetched again once a newer build completes
+BUILD_CACHE_TIMEOUT = 60 * 60 * 24
+
+# (Jenkins API, user) -> the jobs listed on it, for JENKINS_JOBS_CACHE_TTL seconds
+jobs_cache = LRUCache(100)
+
 
 def _get_jenkins_client(jenkins_config):
     return jenkins.Jenkins(jenkins_config.jenkins_api,
                            username=jenkins_config.jenkins_user,
                            password=jenkins_config.jenkins_pass)
 
+# Everything the checks need to know about every job, fetched in one request
+JOBS_TREE = ('jobs[name,color,inQueue,queueItem[inQueueSince],lastBuild[number],'
+             'lastCompletedBuild[number,result],lastSuccessfulBuild[number]]')
+
+
 def get_job_status(jenkins_config, jobname):
     ret = {
         'active': None,
@@ -28,26 +45,79 @@ def get_job_status(jenkins_config, jobname):
         last_completed_build = job['lastCompletedBuild']
         if not last_completed_build:
             raise Exception("job has no build")
-        last_build = client.get_build_info(jobname, last_completed_build['number'])
-
-        if job['lastSuccessfulBuild']:
-            last_good_build_number = job['lastSuccessfulBuild']['number']
-        else:
-            last_good_build_number = 0
-
-        ret['status_code'] = 200
-        ret['job_number'] = last_build['number']
-        ret['active'] = job['color'] != 'disabled'
-        ret['succeeded'] = ret['active'] and last_build['result'] == 'SUCCESS'
-        ret['consecutive_failures'] = last_build['number'] - last_good_build_number
-
-        if job['inQueue']:
-            in_queued_since = job['queueItem']['inQueueSince']
-            time_blocked_since = datetime.utcfromtimestamp(
-                float(in_queued_since) / 1000).replace(tzinfo=timezone.utc)
-            ret['blocked_build_time'] = (timezone.now() - time_blocked_since).total_seconds()
-            ret['queued_job_number'] = job['lastBuild']['number']
-        return ret
+        last_build = _get_completed_build(client, jenkins_config, jobname, last_completed_build['number'])
+        return _job_status(job, last_build)
     except jenkins.NotFoundException:
         ret['status_code'] = 404
         return ret
+
+
+def _build_cache_key(jenkins_config, jobname):
+    job = u'%s|%s' % (jenkins_config.jenkins_api, jobname)
+    return 'cabot-jenkins-build:%s' % hashlib.md5(job.encode('utf-8')).hexdigest()
+
+
+def _get_completed_build(client, jenkins_config, jobname, number):
+    key = _build_cache_key(jenkins_config, jobname)
+    build = cache.get(key)
+    if build is not None and build['number'] == number:
+        metrics.incr('jenkins.build_cache.hits')
+        return build
+    metrics.incr('jenkins.build_cache.misses')
+    build = client.get_build_info(jobname, number)
+    if build.get('result') is not None:
+        cache.set(key, {'number': build['number'], 'result': build['result']}, BUILD_CACHE_TIMEOUT)
+    return build
+
+
+def get_job_statuses(jenkins_config):
+    """
+    Fetches every top level job on a Jenkins server in a single request,
+    or reuses the jobs fetched in the last JENKINS_JOBS_CACHE_TTL seconds.
+    Returns a dict of job name -> status, as for `get_job_status`, or an
+    exception for jobs which have never been built.
+    """
+    key = (jenkins_config.jenkins_api, jenkins_config.jenkins_user)
+    jobs = jobs_cache.get(key)
+    if jobs is None:
+        metrics.incr('jenkins.jobs_cache.misses')
+        client = _get_jenkins_client(jenkins_config)
+        jobs = client.get_info(query='?tree=%s' % JOBS_TREE).get('jobs', [])
+        if settings.JENKINS_JOBS_CACHE_TTL > 0:
+            jobs_cache.set(key, jobs, settings.JENKINS_JOBS_CACHE_TTL)
+    else:
+        metrics.incr('jenkins.jobs_cache.hits')
+    statuses = {}
+    for job in jobs:
+        if not job.get('lastCompletedBuild'):
+            statuses[job['name']] = Exception("job has no build")
+        else:
+            statuses[job['name']] = _job_status(job, job['lastCompletedBuild'])
+    return statuses
+
+
+def _job_status(job, last_build):
+    ret = {
+        'active': None,
+        'succeeded': None,
+        'job_number': None,
+        'blocked_build_time': None,
+    }
+    if job['lastSuccessfulBuild']:
+        last_good_build_number = job['lastSuccessfulBuild']['number']
+    else:
+        last_good_build_number = 0
+
+    ret['status_code'] = 200
+    ret['job_number'] = last_build['number']
+    ret['active'] = job['color'] != 'disabled'
+    ret['succeeded'] = ret['active'] and last_build['result'] == 'SUCCESS'
+    ret['consecutive_failures'] = last_build['number'] - last_good_build_number
+
+    if job['inQueue']:
+        in_queued_since = job['queueItem']['inQueueSince']
+        time_blocked_since = datetime.utcfromtimestamp(
+            float(in_queued_since) / 1000).replace(tzinfo=timezone.utc)
+        ret['blocked_build_time'] = (timezone.now() - time_blocked_since).total_seconds()
+        ret['queued_job_number'] = job['lastBuild']['number']
+    return ret
@@ -0,0 +1,260 @@
+"""
+A local index of the metric names in Graphite, so that the check form's
+autocomplete can be answered without a metrics/find request per keystroke.
+
+The index is a sorted array of leaf metric paths. Glob queries are
+answered by bisecting to the query's literal prefix and skipping over
+whole subtrees which can't match, so only a few paths per matching node
+are looked at. It is built by crawling metrics/find a few nodes at a
+time, and refreshed a top level branch at a time: branches crawled less
+than GRAPHITE_METRIC_INDEX_MAX_AGE seconds ago are kept as they are.
+"""
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from fnmatch import translate
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+GLOB_CHARS = '*?[{'
+
+
+def expand_braces(pattern):
+    """Expands Graphite's {a,b} alternatives: 'x.{a,b}.y' -> ['x.a.y', 'x.b.y']"""
+    start = pattern.find('{')
+    end = pattern.find('}', start)
+    if start == -1 or end == -1:
+        return [pattern]
+    expanded = []
+    for option in pattern[start + 1:end].split(','):
+        expanded.extend(expand_braces(pattern[:start] + option + pattern[end + 1:]))
+    return expanded
+
+
+def literal_prefix(pattern):
+    for i, char in enumerate(pattern):
+        if char in GLOB_CHARS:
+            return pattern[:i]
+    return pattern
+
+
+def component_matcher(part):
+    """A function telling whether a path component matches one part of a pattern"""
+    if literal_prefix(part) == part:
+        return part.__eq__
+    return re.compile(translate(part)).match
+
+
+def completer_query(query):
+    """Graphite's handling of queries in the completer format"""
+    query = query.replace('..', '*.')
+    if not query.endswith('*'):
+        query += '*'
+    return query
+
+
+def after_subtree(node):
+    # '/' sorts straight after '.', so this is past every path below `node`
+    return node + '/'
+
+
+class MetricIndex(object):
+
+    def __init__(self, branches=None):
+        # Top level node path (ending in '.' for branches, as metrics/find
+        # gives them) -> {'crawled_at': timestamp, 'paths': [leaf paths]}
+        self.branches = branches or {}
+        self.paths = sorted(set(path for branch in self.branches.values() for path in branch['paths']))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def find(self, query):
+        """
+        Nodes matching `query`, in the same form as metrics/find's
+        completer format gives them.
+        """
+        nodes = set()
+        for pattern in expand_braces(completer_query(query)):
+            nodes.update(self._find(pattern))
+        return {'metrics': [
+            {'path': path if is_leaf else path + '.', 'name': path.rsplit('.', 1)[-1],
+             'is_leaf': str(int(is_leaf))}
+            for path, is_leaf in sorted(nodes)
+        ]}
+
+    def _find(self, pattern):
+        parts = pattern.split('.')
+        matchers = [component_matcher(part) for part in parts]
+        depth = len(matchers)
+        prefix = literal_prefix(pattern)
+        paths = self.paths
+        i = bisect.bisect_left(paths, prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            components = paths[i].split('.')
+            failed = None
+            for n, (matches, component) in enumerate(zip(matchers, components)):
+                if not matches(component):
+                    failed = n
+                    break
+            if failed is not None:
+                i = self._skip_mismatch(i, components, failed, parts[failed])
+            elif len(components) < depth:
+                i += 1
+            elif len(components) == depth:
+                yield paths[i], True
+                i += 1
+            else:
+                node = '.'.join(components[:depth])
+                yield node, False
+                i = bisect.bisect_left(paths, after_subtree(node), i + 1)
+
+    def _skip_mismatch(self, i, components, failed, part):
+        """
+        The index of the next path which could match, after the path at `i`
+        failed to because its component number `failed` didn't match `part`.
+        """
+        paths = self.paths
+        component = components[failed]
+        parent = '.'.join(components[:failed])
+        # Siblings which could match all start with the part's literal prefix
+        start = literal_prefix(part)
+        if start and component < start:
+            # so jump to where they would be
+            return bisect.bisect_left(paths, (parent + '.' if failed else '') + start, i + 1)
+        if start and failed and not component.startswith(start):
+            # or, if they sort before this one, past the rest of them
+            return bisect.bisect_left(paths, after_subtree(parent), i + 1)
+        if failed < len(components) - 1:
+            # Nothing else below the node that didn't match can match
+            return bisect.bisect_left(paths, after_subtree('.'.join(components[:failed + 1])), i + 1)
+        return i + 1
+
+    def save(self, path):
+        """Writes the index to `path`, replacing it all at once"""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'branches': self.branches}, f)
+        os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """The index saved at `path`, or None if there isn't a readable one"""
+        try:
+            with open(path) as f:
+                return cls(json.load(f)['branches'])
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug('No metric index at %s: %s', path, e)
+            return None
+
+
+def crawl(find, roots, max_workers):
+    """
+    Walks the metric tree below each of `roots` with `find` (metrics/find in
+    the completer format), with at most `max_workers` requests in flight.
+
+    Returns a dict of root -> list of leaf paths. Roots with any part of
+    their tree failing to load are left out.
+    """
+    leaves = dict((root, []) for root in roots)
+    failed = set()
+    if not roots:
+        return leaves
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        pending = dict((executor.submit(find, root), root) for root in roots)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root = pending.pop(future)
+                if root in failed:
+                    continue
+                try:
+                    nodes = future.result()['metrics']
+                except Exception as e:
+                    logger.warning('Failed to crawl metrics below %s: %s', root, e)
+                    failed.add(root)
+                    continue
+                for node in nodes:
+                    if int(node['is_leaf']):
+                        leaves[root].append(node['path'])
+                    else:
+                        pending[executor.submit(find, node['path'])] = root
+    finally:
+        executor.shutdown()
+    for root in failed:
+        del leaves[root]
+    return leaves
+
+
+def refresh(index, find, max_age=None, max_workers=None, now=None):
+    """
+    Returns a new index with the top level branches which are missing from
+    `index`, or were crawled more than `max_age` seconds ago, crawled again.
+    Branches which fail to crawl keep what they had.
+    """
+    if max_age is None:
+        max_age = settings.GRAPHITE_METRIC_INDEX_MAX_AGE
+    if max_workers is None:
+        max_workers = settings.GRAPHITE_METRIC_INDEX_CONCURRENCY
+    if now is None:
+        now = time.time()
+    old = index.branches if index is not None else {}
+    branches = {}
+    stale = []
+    for node in find('')['metrics']:
+        path = node['path']
+        if int(node['is_leaf']):
+            branches[path] = {'crawled_at': now, 'paths': [path]}
+        elif path in old and now - old[path]['crawled_at'] < max_age:
+            branches[path] = old[path]
+        else:
+            stale.append(path)
+    crawled = crawl(find, stale, max_workers)
+    for path in stale:
+        if path in crawled:
+            branches[path] = {'crawled_at': now, 'paths': crawled[path]}
+        elif path in old:
+            branches[path] = old[path]
+    return MetricIndex(branches)
+
+
+class IndexFile(object):
+    """The index saved at a path, reloaded whenever the file changes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._index = None
+
+    def get(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                self._index = MetricIndex.load(self.path)
+                self._mtime = mtime
+            return self._index
+
+
+_files = {}
+
+
+def current():
+    """The saved index, or None if there isn't one yet"""
+    path = settings.GRAPHITE_METRIC_INDEX_PATH
+    if not path:
+        return None
+    if path not in _files:
+        _files[path] = IndexFile(path)
+    return _files[path].get()
@@ -0,0 +1,103 @@
+"""
+Counters and gauges describing what Cabot's scheduler and workers are doing.
+
+Counts are added up in each process's memory, and written to the Django
+cache at most every METRICS_FLUSH_INTERVAL seconds, so counting an event
+costs no cache (or database) round trip. Values in the cache can be read
+back by any process which shares it. The default local memory cache is per
+process: set CACHE_BACKEND to a shared backend in production (see
+conf/production.env.example), or each process only sees its own values.
+
+The current values are served at /api/metrics and logged every
+METRICS_LOG_INTERVAL seconds by the `log_metrics` task. Counts a process
+hasn't flushed yet when it exits are lost.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'cabot-metrics:'
+NAMES_KEY = KEY_PREFIX + 'names'
+
+_lock = threading.Lock()
+# Counts and gauges of this process which haven't been written yet
+_counts = {}
+_gauges = {}
+_last_flush = time.time()
+
+
+def incr(name, delta=1):
+    with _lock:
+        _counts[name] = _counts.get(name, 0) + delta
+    _maybe_flush()
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+    _maybe_flush()
+
+
+def _maybe_flush():
+    if time.time() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Writes this process's counts and gauges to the cache"""
+    global _last_flush
+    with _lock:
+        counts = _counts.copy()
+        gauges = _gauges.copy()
+        _counts.clear()
+        _gauges.clear()
+        _last_flush = time.time()
+    if not counts and not gauges:
+        return
+    _register(set(counts) | set(gauges))
+    for name, delta in counts.items():
+        key = KEY_PREFIX + name
+        if cache.add(key, delta, timeout=None):
+            continue
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # Evicted between the add and the incr
+            cache.set(key, delta, timeout=None)
+    if gauges:
+        cache.set_many(dict((KEY_PREFIX + name, value) for name, value in gauges.items()), timeout=None)
+
+
+def _register(names):
+    listed = set(cache.get(NAMES_KEY) or [])
+    if not names <= listed:
+        cache.set(NAMES_KEY, sorted(listed | names), timeout=None)
+
+
+def get(name, default=0):
+    """The value of a metric, including this process's unflushed counts"""
+    with _lock:
+        if name in _gauges:
+            return _gauges[name]
+        pending = _counts.get(name)
+    value = cache.get(KEY_PREFIX + name)
+    if pending is None:
+        return default if value is None else value
+    return (value or 0) + pending
+
+
+def snapshot():
+    """Returns the current value of every metric, by name"""
+    flush()
+    names = cache.get(NAMES_KEY) or []
+    values = cache.get_many([KEY_PREFIX + name for name in names])
+    return dict((name, values[KEY_PREFIX + name]) for name in names if KEY_PREFIX + name in values)
+
+
+def reset():
+    """Forgets this process's unflushed values"""
+    with _lock:
+        _counts.clear()
+        _gauges.clear()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:02
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def populate_next_run_at(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+
+    StatusCheck = apps.get_model("cabotapp", "StatusCheck")
+    checks = StatusCheck.objects.using(db_alias)
+
+    checks.filter(last_run__isnull=True).update(next_run_at=timezone.now())
+    for check in checks.filter(last_run__isnull=False).only('id', 'last_run', 'frequency').iterator():
+        checks.filter(id=check.id).update(
+            next_run_at=check.last_run + timedelta(minutes=check.frequency))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0007_statuscheckresult_consecutive_failures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscheck',
+            name='next_run_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='statuscheck',
+            index_together=set([('active', 'next_run_at')]),
+        ),
+        migrations.RunPython(populate_next_run_at, migrations.RunPython.noop),
+    ]
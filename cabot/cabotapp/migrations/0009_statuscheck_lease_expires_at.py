@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0008_statuscheck_next_run_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscheck',
+            name='lease_expires_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0009_statuscheck_lease_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscheck',
+            name='max_total_time',
+            field=models.PositiveIntegerField(blank=True, help_text=b'Fail if the whole request takes longer than this many milliseconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheck',
+            name='max_ttfb',
+            field=models.PositiveIntegerField(blank=True, help_text=b'Fail if the first byte of the response takes longer than this many milliseconds to arrive.', null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='body_time',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='connect_time',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='dns_time',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='tls_time',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='total_time',
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='ttfb',
+            field=models.PositiveIntegerField(null=True),
+        ),
+    ]
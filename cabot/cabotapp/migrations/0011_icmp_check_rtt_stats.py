@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:25
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0010_http_check_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscheck',
+            name='max_packet_loss',
+            field=models.PositiveIntegerField(default=0, help_text=b'Fail if more than this percentage of packets are lost.', validators=[django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='statuscheck',
+            name='max_rtt',
+            field=models.PositiveIntegerField(blank=True, help_text=b'Fail if the average round trip time is more than this many milliseconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheck',
+            name='packet_count',
+            field=models.PositiveIntegerField(default=1, help_text=b'Number of packets to send each time the check runs.', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='statuscheck',
+            name='packet_interval',
+            field=models.FloatField(default=1.0, help_text=b'Seconds to wait between sending packets.', validators=[django.core.validators.MinValueValidator(0.2)]),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='packet_loss',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='rtt_avg',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='rtt_max',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='rtt_min',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='statuscheckresult',
+            name='rtt_stddev',
+            field=models.FloatField(null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 19:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0011_icmp_check_rtt_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statuscheck',
+            name='aggregate_in_graphite',
+            field=models.BooleanField(default=False, help_text=b'Have Graphite reduce the series to their maximum (or minimum, for < checks) before sending them, which is quicker for metrics with many series. Failures then name the aggregate rather than the series which failed. Only used when no failures are allowed and the check type is not ==.'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 21:12
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabotapp', '0012_graphite_check_aggregate_in_graphite'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='statuscheck',
+            name='endpoint',
+            field=models.TextField(help_text=b'HTTP(S) endpoint to poll.', null=True, validators=[django.core.validators.URLValidator()]),
+        ),
+    ]
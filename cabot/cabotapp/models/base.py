@@ -1,29 +1,43 @@
+import functools
 import itertools
 import json
+import math
 import re
+import socket
 import subprocess
 import time
 from datetime import timedelta
+from timeit import default_timer
 
 import requests
 
 from celery.exceptions import SoftTimeLimitExceeded
+from concurrent.futures import ThreadPoolExecutor
 from celery.utils.log import get_task_logger
-from django.core.validators import URLValidator
+from django.core.validators import MaxValueValidator, MinValueValidator, URLValidator
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.utils import timezone
 from polymorphic.models import PolymorphicModel
 
 from ..alert import AlertPluginUserData, send_alert, send_alert_update
-from ..calendar import get_events
-from ..graphite import parse_metric
-from ..tasks import update_instance, update_service
+from ..calendar import ensure_tzaware, get_changed_events, save_feed_state
+from .. import icmp, rota
+from ..graphite import (get_data_many, get_from, metric_target, parse_aggregated_data, parse_data, parse_metric,
+                        series_failures, window_minutes)
+from ..http_checks import (compile_text_match, discard_body, phase_timings, pooled_get, read_body,
+                           run_concurrently)
+from ..scheduling import next_slot
+from ..tasks import schedule_instance_update, schedule_service_update
 
 RAW_DATA_LIMIT = 5000
 
+# Summary lines of `ping` output, from iputils and busybox
+PING_SUMMARY = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+PING_RTT = re.compile(r'(?:rtt|round-trip) min/avg/max(?:/mdev)? = ([\d.]+)/([\d.]+)/([\d.]+)(?:/([\d.]+))? ms')
+
 logger = get_task_logger(__name__)
 
 CHECK_TYPES = (
@@ -367,6 +381,18 @@ class Instance(CheckGroupMixin):
     def icmp_status_checks(self):
         return self.status_checks.filter(polymorphic_ctype__model='icmpstatuscheck')
 
+    @property
+    def recent_latency(self):
+        results = StatusCheckResult.objects.filter(
+            status_check__in=self.icmp_status_checks(),
+            time_complete__gt=(timezone.now() - timedelta(minutes=60 * 24)),
+            packet_loss__isnull=False,
+        ).order_by('time_complete').values('time_complete', 'rtt_avg', 'rtt_max', 'packet_loss')
+        latency = list(results)
+        for r in latency:
+            r['time'] = time.mktime(r.pop('time_complete').timetuple())
+        return latency
+
     def active_icmp_status_checks(self):
         return self.icmp_status_checks().filter(active=True)
 
@@ -440,6 +466,8 @@ class StatusCheck(PolymorphicModel):
     calculated_status = models.CharField(
         max_length=50, choices=Service.STATUSES, default=Service.CALCULATED_PASSING_STATUS, blank=True)
     last_run = models.DateTimeField(null=True)
+    next_run_at = models.DateTimeField(null=True, editable=False)
+    lease_expires_at = models.DateTimeField(null=True, editable=False)
     cached_health = models.TextField(editable=False, null=True)
 
     # Graphite checks
@@ -468,6 +496,12 @@ class StatusCheck(PolymorphicModel):
         help_text='The maximum number of data series (metrics) you expect to fail. For example, you might be OK with '
                   '2 out of 3 webservers having OK load (1 failing), but not 1 out of 3 (2 failing).',
     )
+    aggregate_in_graphite = models.BooleanField(
+        default=False,
+        help_text='Have Graphite reduce the series to their maximum (or minimum, for < checks) before sending them, '
+                  'which is quicker for metrics with many series. Failures then name the aggregate rather than the '
+                  'series which failed. Only used when no failures are allowed and the check type is not ==.',
+    )
 
     # HTTP checks
     endpoint = models.TextField(
@@ -504,6 +538,38 @@ class StatusCheck(PolymorphicModel):
         default=True,
         help_text='Set to false to allow not try to verify ssl certificates (default True)',
     )
+    max_ttfb = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Fail if the first byte of the response takes longer than this many milliseconds to arrive.',
+    )
+    max_total_time = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Fail if the whole request takes longer than this many milliseconds.',
+    )
+
+    # ICMP checks
+    packet_count = models.PositiveIntegerField(
+        default=1,
+        validators=[MinValueValidator(1), MaxValueValidator(100)],
+        help_text='Number of packets to send each time the check runs.',
+    )
+    packet_interval = models.FloatField(
+        default=1.0,
+        validators=[MinValueValidator(0.2)],
+        help_text='Seconds to wait between sending packets.',
+    )
+    max_packet_loss = models.PositiveIntegerField(
+        default=0,
+        validators=[MaxValueValidator(100)],
+        help_text='Fail if more than this percentage of packets are lost.',
+    )
+    max_rtt = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='Fail if the average round trip time is more than this many milliseconds.',
+    )
 
     # Jenkins checks
     max_queued_build_time = models.IntegerField(
@@ -514,6 +580,9 @@ class StatusCheck(PolymorphicModel):
 
     class Meta(PolymorphicModel.Meta):
         ordering = ['name']
+        index_together = (
+            ('active', 'next_run_at'),  # used by the scheduler to find due checks
+        )
 
     def __unicode__(self):
         return self.name
@@ -531,8 +600,47 @@ class StatusCheck(PolymorphicModel):
 
     def run(self):
         start = timezone.now()
+        result = self._run_catching_errors()
+        finish = timezone.now()
+        result.time = start
+        result.time_complete = finish
+        result.save()
+        self.finish_run(finish)
+
+    @classmethod
+    def run_batch(cls, checks):
+        """
+        Runs several checks of this type. Check types which can share work
+        between checks override this; by default they run one at a time.
+        """
+        for check in checks:
+            try:
+                check.run()
+            except Exception as e:
+                logger.exception(u"Error running check %s: %s" % (check.id, e))
+
+    @classmethod
+    def save_batch_results(cls, runs):
+        """
+        Writes back the results of a batch of checks, given as a list of
+        (check, result, start, finish) tuples, in bulk.
+        """
+        results = []
+        for check, result, start, finish in runs:
+            result.time = start
+            result.time_complete = finish
+            result.truncate_raw_data()
+            results.append(result)
+        StatusCheckResult.objects.bulk_create(results)
+        for check, result, start, finish in runs:
+            try:
+                check.finish_run(finish)
+            except Exception as e:
+                logger.exception(u"Error saving check %s: %s" % (check.id, e))
+
+    def _run_catching_errors(self, run=None):
         try:
-            result = self._run()
+            return (run or self._run)()
         except SoftTimeLimitExceeded as e:
             result = StatusCheckResult(status_check=self)
             result.error = u'Error in performing check: Celery soft time limit exceeded'
@@ -542,11 +650,12 @@ class StatusCheck(PolymorphicModel):
             logger.error(u"Error performing check: %s" % (e.message,))
             result.error = u'Error in performing check: %s' % (e.message,)
             result.succeeded = False
-        finish = timezone.now()
-        result.time = start
-        result.time_complete = finish
-        result.save()
+        return result
+
+    def finish_run(self, finish):
+        """Called once the result of a run has been saved"""
         self.last_run = finish
+        self.lease_expires_at = None
         self.save()
 
     def _run(self):
@@ -555,7 +664,24 @@ class StatusCheck(PolymorphicModel):
         """
         raise NotImplementedError('Subclasses should implement')
 
+    def calculate_next_run(self):
+        """
+        Checks which have never run are due straight away, otherwise they
+        are due at their next slot (see `scheduling.next_slot`) at least
+        half a period after they last finished. A check which has just run
+        for its slot is due a period after that slot however long the run
+        took, or at the first slot after it finished if it overran.
+        """
+        if self.last_run:
+            period = timedelta(minutes=max(int(self.frequency), 1))
+            earliest = self.last_run + period / 2
+            if self.next_run_at and self.next_run_at <= self.last_run:
+                earliest = min(earliest, max(self.next_run_at + period, self.last_run))
+            return next_slot(self.id, self.frequency, earliest)
+        return timezone.now()
+
     def save(self, *args, **kwargs):
+        self.next_run_at = self.calculate_next_run()
         if self.last_run:
             recent_results = list(self.recent_results())
             if self.calculate_debounced_passing(recent_results, self.debounce):
@@ -590,14 +716,12 @@ class StatusCheck(PolymorphicModel):
         return new_check.pk
 
     def update_related_services(self):
-        services = self.service_set.all()
-        for service in services:
-            update_service.delay(service.id)
+        for service_id in self.service_set.values_list('id', flat=True):
+            schedule_service_update(service_id)
 
     def update_related_instances(self):
-        instances = self.instance_set.all()
-        for instance in instances:
-            update_instance.delay(instance.id)
+        for instance_id in self.instance_set.values_list('id', flat=True):
+            schedule_instance_update(instance_id)
 
 
 class ICMPStatusCheck(StatusCheck):
@@ -609,21 +733,135 @@ class ICMPStatusCheck(StatusCheck):
         return "ICMP/Ping Check"
 
     def _run(self):
-        result = StatusCheckResult(status_check=self)
-        instances = self.instance_set.all()
         target = self.instance_set.get().address
+        if use_native_icmp():
+            try:
+                probe = icmp.ping([target], count=self.packet_count, interval=self.packet_interval,
+                                  timeout=settings.ICMP_TIMEOUT)[target]
+            except socket.error as e:
+                logger.warning(u"Native ping failed, running `ping` instead: %s" % e)
+            else:
+                return self._result_from_probe(probe)
 
-        args = ['ping', '-c', '1', target]
+        args = ['ping', '-c', str(self.packet_count)]
+        if self.packet_count > 1:
+            args += ['-i', str(self.packet_interval)]
+        args.append(target)
         try:
             # We redirect stderr to STDOUT because ping can write to both, depending on the kind of error.
-            subprocess.check_output(args, stderr=subprocess.STDOUT, shell=False)
-            result.succeeded = True
+            output = subprocess.check_output(args, stderr=subprocess.STDOUT, shell=False)
+            error = None
         except subprocess.CalledProcessError as e:
-            result.succeeded = False
-            result.error = e.output
+            output = error = e.output
+
+        result = StatusCheckResult(status_check=self)
+        summary = PING_SUMMARY.search(output or '')
+        if not summary:
+            result.succeeded = error is None
+            result.error = error
+            return result
+        rtt = PING_RTT.search(output)
+        rtt_stats = None
+        if rtt:
+            rtt_stats = tuple(float(value) if value else None for value in rtt.groups())
+        return self._record_ping(result, target, int(summary.group(1)), int(summary.group(2)),
+                                 rtt_stats, error)
+
+    def _result_from_probe(self, probe):
+        result = StatusCheckResult(status_check=self)
+        rtt_stats = None
+        if probe.rtts:
+            rtts = [rtt * 1000 for rtt in probe.rtts]
+            mean = sum(rtts) / len(rtts)
+            stddev = math.sqrt(sum((rtt - mean) ** 2 for rtt in rtts) / len(rtts))
+            rtt_stats = (min(rtts), mean, max(rtts), stddev)
+        return self._record_ping(result, probe.address, probe.sent, probe.received, rtt_stats, probe.error)
+
+    def _record_ping(self, result, address, sent, received, rtt_stats, error=None):
+        """
+        Stores packet loss and round trip times (a (min, avg, max, stddev)
+        tuple in ms, or None) on the result, and fails it if they are over
+        the check's limits.
+        """
+        if sent:
+            result.packet_loss = 100.0 * (sent - received) / sent
+        if rtt_stats:
+            result.rtt_min, result.rtt_avg, result.rtt_max, result.rtt_stddev = rtt_stats
 
+        if not received:
+            result.error = error or u'No reply from %s (%d packets sent)' % (address, sent)
+            result.succeeded = False
+        elif result.packet_loss > self.max_packet_loss:
+            result.error = u'%g%% packet loss to %s (limit %s%%)' % (
+                round(result.packet_loss, 1), address, self.max_packet_loss)
+            result.succeeded = False
+        elif self.max_rtt is not None and result.rtt_avg is not None and result.rtt_avg > self.max_rtt:
+            result.error = u'Average round trip time to %s %.1fms (limit %sms)' % (
+                address, result.rtt_avg, self.max_rtt)
+            result.succeeded = False
+        else:
+            result.succeeded = True
         return result
 
+    @classmethod
+    def run_batch(cls, checks):
+        """
+        Pings the instances of all the checks at once from this process,
+        rather than running `ping` for each one. Checks sending a different
+        number of packets or at a different interval are pinged separately,
+        at the same time as each other.
+        """
+        if not use_native_icmp():
+            return super(ICMPStatusCheck, cls).run_batch(checks)
+
+        check_ids = [check.id for check in checks]
+        addresses = {}
+        for check_id, address in Instance.objects.filter(status_checks__in=check_ids).values_list(
+                'status_checks', 'address'):
+            addresses.setdefault(check_id, []).append(address)
+
+        groups = {}
+        for check in checks:
+            groups.setdefault((check.packet_count, check.packet_interval), []).append(check)
+        if not groups:
+            return
+
+        def ping_group(item):
+            (count, interval), group = item
+            targets = [addresses[check.id][0] for check in group if len(addresses.get(check.id, [])) == 1]
+            start = timezone.now()
+            try:
+                probes = icmp.ping(targets, count=count, interval=interval, timeout=settings.ICMP_TIMEOUT)
+            except socket.error as e:
+                logger.warning(u"Batched ping failed, running checks one at a time: %s" % e)
+                return group, None, start, None
+            return group, probes, start, timezone.now()
+
+        executor = ThreadPoolExecutor(max_workers=len(groups))
+        try:
+            pinged = list(executor.map(ping_group, sorted(groups.items())))
+        finally:
+            executor.shutdown()
+
+        runs = []
+        for group, probes, start, finish in pinged:
+            if probes is None:
+                super(ICMPStatusCheck, cls).run_batch(group)
+                continue
+            for check in group:
+                if len(addresses.get(check.id, [])) == 1:
+                    result = check._result_from_probe(probes[addresses[check.id][0]])
+                else:
+                    result = StatusCheckResult(status_check=check, succeeded=False)
+                    result.error = u'Error in performing check: ICMP checks need exactly one instance'
+                runs.append((check, result, start, finish))
+        cls.save_batch_results(runs)
+
+
+def use_native_icmp():
+    """Whether ICMP checks can be run without spawning `ping`"""
+    return settings.ICMP_NATIVE_PROBER and icmp.is_available()
+
 
 def minimize_targets(targets):
     split = [target.split(".") for target in targets]
@@ -669,22 +907,76 @@ class GraphiteStatusCheck(StatusCheck):
             target, value = failures[0]
             return "%s %s %0.1f" % (value, self.check_type, float(self.value))
 
+    def time_to_check(self):
+        """Minutes of data to look at, covering everything since the last run"""
+        last_result = self.last_result()
+        return window_minutes(self.frequency, last_result.time if last_result else None, timezone.now())
+
+    # Graphite functions giving the one series that decides each check type,
+    # when no failures are allowed
+    AGGREGATES = {
+        '>': 'maxSeries',
+        '>=': 'maxSeries',
+        '<': 'minSeries',
+        '<=': 'minSeries',
+    }
+
+    def aggregate(self):
+        """The function Graphite should reduce the metric's series with, if any"""
+        if not self.aggregate_in_graphite or self.allowed_num_failures:
+            return None
+        return self.AGGREGATES.get(self.check_type)
+
+    def _parse_data(self, data, time_to_check):
+        aggregate = self.aggregate()
+        if aggregate:
+            return parse_aggregated_data(data, self.metric, aggregate, time_to_check, self.utcnow)
+        return parse_data(data, time_to_check, self.utcnow)
+
     def _run(self):
         if not hasattr(self, 'utcnow'):
             self.utcnow = None
+        graphite_output = parse_metric(self.metric, mins_to_check=self.time_to_check(), utcnow=self.utcnow,
+                                       aggregate=self.aggregate())
+        return self._result_from_output(graphite_output)
+
+    @classmethod
+    def run_batch(cls, checks):
+        """
+        Fetches the metrics of all checks looking at the same window in one
+        render request. If that fails (one bad target is enough) the checks
+        in it are run one at a time instead. `run_all_checks` sends the checks
+        due in a tick which share a window in the same batch.
+        """
+        windows = {}
+        for check in checks:
+            if not hasattr(check, 'utcnow'):
+                check.utcnow = None
+            time_to_check = check.time_to_check()
+            windows.setdefault(get_from(time_to_check), []).append((check, time_to_check))
+
+        runs = []
+        for _from, group in sorted(windows.items()):
+            start = timezone.now()
+            try:
+                fetched = get_data_many([metric_target(check.metric, check.aggregate()) for check, _ in group],
+                                        group[0][1])
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(u"Batched Graphite request failed, running checks one at a time: %s" % e)
+                super(GraphiteStatusCheck, cls).run_batch([check for check, _ in group])
+                continue
+            finish = timezone.now()
+            for (check, time_to_check), data in zip(group, fetched):
+                result = check._run_catching_errors(functools.partial(
+                    check._result_from_output, check._parse_data(data, time_to_check)))
+                runs.append((check, result, start, finish))
+        cls.save_batch_results(runs)
+
+    def _result_from_output(self, graphite_output):
         result = StatusCheckResult(status_check=self)
 
         failures = []
 
-        last_result = self.last_result()
-        if last_result:
-            last_result_started = last_result.time
-            time_to_check = max(self.frequency, ((timezone.now() - last_result_started).total_seconds() / 60) + 1)
-        else:
-            time_to_check = self.frequency
-
-        graphite_output = parse_metric(self.metric, mins_to_check=time_to_check, utcnow=self.utcnow)
-
         try:
             result.raw_data = json.dumps(graphite_output['raw'])
         except:
@@ -697,31 +989,8 @@ class GraphiteStatusCheck(StatusCheck):
 
         if graphite_output['num_series_with_data'] > 0:
             result.average_value = graphite_output['average_value']
-            for s in graphite_output['series']:
-                if not s["values"]:
-                    continue
-                failure_value = None
-                if self.check_type == '<':
-                    if float(s['min']) < float(self.value):
-                        failure_value = s['min']
-                elif self.check_type == '<=':
-                    if float(s['min']) <= float(self.value):
-                        failure_value = s['min']
-                elif self.check_type == '>':
-                    if float(s['max']) > float(self.value):
-                        failure_value = s['max']
-                elif self.check_type == '>=':
-                    if float(s['max']) >= float(self.value):
-                        failure_value = s['max']
-                elif self.check_type == '==':
-                    if float(self.value) in s['values']:
-                        failure_value = float(self.value)
-                else:
-                    raise Exception(u'Check type %s not supported' %
-                                    self.check_type)
-
-                if not failure_value is None:
-                    failures.append((s["target"], failure_value))
+            failures = series_failures([s for s in graphite_output['series'] if len(s['values'])],
+                                       self.check_type, float(self.value))
 
         if len(failures) > self.allowed_num_failures:
             result.succeeded = False
@@ -755,7 +1024,7 @@ class HttpStatusCheck(StatusCheck):
     @classmethod
     def _check_content_pattern(self, text_match, content):
         content = content if isinstance(content, unicode) else unicode(content, "UTF-8")
-        return re.search(text_match, content)
+        return compile_text_match(text_match).search(content)
 
     def _run(self):
         result = StatusCheckResult(status_check=self)
@@ -765,8 +1034,10 @@ class HttpStatusCheck(StatusCheck):
             auth = (self.username if self.username is not None else '',
                     self.password if self.password is not None else '')
 
+        stream = settings.HTTP_CHECK_STREAM_BODY
+        start = default_timer()
         try:
-            resp = requests.get(
+            resp = pooled_get(
                 self.endpoint,
                 timeout=self.timeout,
                 verify=self.verify_ssl_certificate,
@@ -774,27 +1045,88 @@ class HttpStatusCheck(StatusCheck):
                 headers={
                     "User-Agent": settings.HTTP_USER_AGENT,
                 },
+                stream=stream,
             )
         except requests.RequestException as e:
             result.error = u'Request error occurred: %s' % (e.message,)
             result.succeeded = False
-        else:
+            return result
+
+        received = default_timer()
+        try:
             if self.status_code and resp.status_code != int(self.status_code):
                 result.error = u'Wrong code: got %s (expected %s)' % (
                     resp.status_code, int(self.status_code))
                 result.succeeded = False
-                result.raw_data = resp.text
+                result.raw_data = self._read_body(resp, max_chars=RAW_DATA_LIMIT)[0]
             elif self.text_match:
-                if not self._check_content_pattern(self.text_match, resp.text):
-                    result.error = u'Failed to find match regex /%s/ in response body' % self.text_match
-                    result.raw_data = resp.text
+                text, match, complete = self._read_body(resp, pattern=compile_text_match(self.text_match))
+                if not match:
+                    if complete:
+                        result.error = u'Failed to find match regex /%s/ in response body' % self.text_match
+                    else:
+                        result.error = u'Failed to find match regex /%s/ in first %d bytes of response body' % (
+                            self.text_match, settings.HTTP_CHECK_MAX_BODY_BYTES)
+                    result.raw_data = text
                     result.succeeded = False
                 else:
                     result.succeeded = True
             else:
+                if stream:
+                    discard_body(resp, settings.HTTP_CHECK_MAX_BODY_BYTES)
                 result.succeeded = True
+        except requests.RequestException as e:
+            # A streamed body can fail part way through, e.g. with a
+            # ChunkedEncodingError or a ReadTimeout
+            result.error = u'Request error occurred: %s' % (e.message,)
+            result.succeeded = False
+
+        self._record_timings(result, resp, start, received, default_timer())
+        if result.succeeded:
+            if self.max_ttfb is not None and result.ttfb is not None and result.ttfb > self.max_ttfb:
+                result.error = u'Slow response: first byte after %sms (limit %sms)' % (result.ttfb, self.max_ttfb)
+                result.succeeded = False
+            elif self.max_total_time is not None and result.total_time > self.max_total_time:
+                result.error = u'Slow response: took %sms (limit %sms)' % (result.total_time, self.max_total_time)
+                result.succeeded = False
         return result
 
+    def _record_timings(self, result, resp, start, received, finished):
+        """
+        Stores how long each phase of the request took on the result, in ms.
+        The body is only timed on its own when it is streamed, and redirects
+        count towards the total but not the other phases.
+        """
+        def ms(seconds):
+            return int(round(seconds * 1000)) if seconds is not None else None
+
+        timings = phase_timings(resp)
+        result.dns_time = ms(timings.get('dns'))
+        result.connect_time = ms(timings.get('connect'))
+        result.tls_time = ms(timings.get('tls'))
+        result.ttfb = ms(timings.get('ttfb'))
+        if settings.HTTP_CHECK_STREAM_BODY:
+            result.body_time = ms(finished - received)
+        result.total_time = ms(finished - start)
+
+    def _read_body(self, resp, pattern=None, max_chars=None):
+        """
+        Returns (text, match, complete) for the response body. When streaming,
+        only as much of the body as is needed is downloaded.
+        """
+        if not settings.HTTP_CHECK_STREAM_BODY:
+            return resp.text, pattern.search(resp.text) if pattern else None, True
+        return read_body(resp, pattern=pattern, max_chars=max_chars,
+                         max_bytes=settings.HTTP_CHECK_MAX_BODY_BYTES)
+
+    @classmethod
+    def run_batch(cls, checks):
+        """
+        Makes the requests for all the checks concurrently, then writes the
+        results back in bulk.
+        """
+        cls.save_batch_results(run_concurrently(checks))
+
 
 class StatusCheckResult(models.Model):
     """
@@ -815,6 +1147,21 @@ class StatusCheckResult(models.Model):
     job_number = models.PositiveIntegerField(null=True)
     consecutive_failures = models.PositiveIntegerField(null=True)
 
+    # ICMP specific, round trip times in milliseconds
+    rtt_min = models.FloatField(null=True)
+    rtt_avg = models.FloatField(null=True)
+    rtt_max = models.FloatField(null=True)
+    rtt_stddev = models.FloatField(null=True)
+    packet_loss = models.FloatField(null=True)
+
+    # HTTP specific, in milliseconds
+    dns_time = models.PositiveIntegerField(null=True)
+    connect_time = models.PositiveIntegerField(null=True)
+    tls_time = models.PositiveIntegerField(null=True)
+    ttfb = models.PositiveIntegerField(null=True)
+    body_time = models.PositiveIntegerField(null=True)
+    total_time = models.PositiveIntegerField(null=True)
+
     class Meta:
         ordering = ['-time_complete']
         index_together = (
@@ -843,6 +1190,15 @@ class StatusCheckResult(models.Model):
         except:
             return None
 
+    @property
+    def phase_timings(self):
+        """
+        DNS, connect, TLS, first byte, body and total times of an HTTP
+        check in ms
+        """
+        return [self.dns_time, self.connect_time, self.tls_time,
+                self.ttfb, self.body_time, self.total_time]
+
     @property
     def short_error(self):
         snippet_len = 30
@@ -851,9 +1207,12 @@ class StatusCheckResult(models.Model):
         else:
             return self.error
 
-    def save(self, *args, **kwargs):
+    def truncate_raw_data(self):
         if isinstance(self.raw_data, basestring):
             self.raw_data = self.raw_data[:RAW_DATA_LIMIT]
+
+    def save(self, *args, **kwargs):
+        self.truncate_raw_data()
         return super(StatusCheckResult, self).save(*args, **kwargs)
 
 class AlertAcknowledgement(models.Model):
@@ -923,11 +1282,34 @@ class Shift(models.Model):
         return "%s: %s to %s%s" % (self.user.username, self.start, self.end, deleted)
 
 
+def _load_current_shifts(now):
+    return [(shift.start, shift.end, shift.user) for shift in
+            Shift.objects.filter(deleted=False, end__gt=now).select_related('user').order_by('start', 'id')]
+
+
+def _load_fallback_officers():
+    try:
+        return [UserProfile.objects.select_related('user').get(fallback_alert_user=True).user]
+    except UserProfile.DoesNotExist:
+        return []
+
+
+duty_officer_resolver = rota.DutyOfficerResolver(_load_current_shifts, _load_fallback_officers)
+
+post_save.connect(rota.invalidate, sender=Shift)
+post_delete.connect(rota.invalidate, sender=Shift)
+post_save.connect(rota.invalidate, sender=UserProfile)
+post_delete.connect(rota.invalidate, sender=UserProfile)
+post_save.connect(rota.invalidate, sender=settings.AUTH_USER_MODEL)
+post_delete.connect(rota.invalidate, sender=settings.AUTH_USER_MODEL)
+
+
 def get_duty_officers(at_time=None):
     """Returns a list of duty officers for a given time or now if none given"""
-    duty_officers = []
-    if not at_time:
-        at_time = timezone.now()
+    duty_officers = duty_officer_resolver.get(at_time)
+    if duty_officers is not None:
+        return duty_officers
+    # A time before the resolver's shifts were loaded
     current_shifts = Shift.objects.filter(
         deleted=False,
         start__lt=at_time,
@@ -945,25 +1327,78 @@ def get_duty_officers(at_time=None):
 
 
 def update_shifts():
-    events = get_events()
-    users = User.objects.filter(is_active=True)
-    user_lookup = {}
-    for u in users:
-        user_lookup[u.username.lower()] = u
-    future_shifts = Shift.objects.filter(start__gt=timezone.now())
-    future_shifts.update(deleted=True)
-
+    """
+    Brings the shifts which haven't ended yet into line with the rota feed.
+    Returns how many rows were created, updated, marked deleted, undeleted
+    and removed as duplicates, or None if the feed hasn't changed.
+    """
+    events, feed_state = get_changed_events()
+    if events is None:
+        return None
+    user_lookup = dict((username.lower(), user_id) for username, user_id in
+                       User.objects.filter(is_active=True).values_list('username', 'id'))
+    now = timezone.now()
+
+    # (uid, start) -> (end, last modified, user id) of the shifts the feed gives
+    desired = {}
     for event in events:
-        e = event['summary'].lower().strip()
-        if e in user_lookup:
-            user = user_lookup[e]
-            # Delete any events that have been updated in ical
-            Shift.objects.filter(uid=event['uid'],
-                last_modified__lt=event['last_modified']).delete()
-            Shift.objects.get_or_create(
-                uid=event['uid'],
-                start=event['start'],
-                end=event['end'],
-                last_modified=event['last_modified'],
-                user=user,
-                deleted=False)
+        user_id = user_lookup.get(event['summary'].lower().strip())
+        end = ensure_tzaware(event['end'])
+        if user_id and end > now:
+            desired[(event['uid'], ensure_tzaware(event['start']))] = (
+                end, ensure_tzaware(event['last_modified']), user_id)
+
+    with transaction.atomic():
+        # Earlier versions could store a shift more than once, so keep the
+        # newest live row for each (uid, start) and remove the rest
+        existing = {}
+        duplicates = []
+        for row in Shift.objects.filter(end__gt=now).order_by('deleted', '-id').values_list(
+                'id', 'uid', 'start', 'end', 'last_modified', 'user_id', 'deleted'):
+            if (row[1], row[2]) in existing:
+                duplicates.append(row[0])
+            else:
+                existing[(row[1], row[2])] = row
+
+        to_remove = list(duplicates)
+        to_create = []
+        to_undelete = []
+        updated = 0
+        for (uid, start), (end, last_modified, user_id) in desired.items():
+            row = existing.pop((uid, start), None)
+            if row is not None and row[3:6] == (end, last_modified, user_id):
+                if row[6]:
+                    to_undelete.append(row[0])
+                continue
+            if row is not None:
+                to_remove.append(row[0])
+                updated += 1
+            to_create.append(Shift(uid=uid, start=start, end=end, last_modified=last_modified, user_id=user_id))
+        to_delete = [row[0] for row in existing.values() if not row[6]]
+
+        for ids in chunks(to_remove):
+            Shift.objects.filter(id__in=ids).delete()
+        Shift.objects.bulk_create(to_create)
+        for ids in chunks(to_delete):
+            Shift.objects.filter(id__in=ids).update(deleted=True)
+        for ids in chunks(to_undelete):
+            Shift.objects.filter(id__in=ids).update(deleted=False)
+
+    save_feed_state(feed_state)
+    changes = {
+        'created': len(to_create) - updated,
+        'updated': updated,
+        'deleted': len(to_delete),
+        'undeleted': len(to_undelete),
+        'duplicates_removed': len(duplicates),
+    }
+    logger.info(u'Updated shifts: %s' % ', '.join('%d %s' % (changes[k], k) for k in sorted(changes)))
+    if any(changes.values()):
+        rota.invalidate()
+    return changes
+
+
+def chunks(ids, size=500):
+    """Splits a list of ids to keep `id__in` lookups within database parameter limits"""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
@@ -1,10 +1,15 @@
+import functools
+import logging
 import os
 
 from django.db import models
+from django.utils import timezone
 
-from ..jenkins import get_job_status
+from ..jenkins import get_job_status, get_job_statuses
 from .base import StatusCheck, StatusCheckResult
 
+logger = logging.getLogger(__name__)
+
 
 class JenkinsStatusCheck(StatusCheck):
     jenkins_config = models.ForeignKey('JenkinsConfig')
@@ -17,10 +22,44 @@ class JenkinsStatusCheck(StatusCheck):
     def failing_short_status(self):
         return 'Job failing on Jenkins'
 
-    def _run(self):
+    @classmethod
+    def run_batch(cls, checks):
+        """
+        Fetches the status of every job on each Jenkins server once, rather
+        than two requests per check. Jobs missing from that (such as those in
+        folders), and all jobs if it fails, are fetched one at a time.
+        """
+        by_config = {}
+        for check in checks:
+            by_config.setdefault(check.jenkins_config_id, []).append(check)
+
+        runs = []
+        for config_checks in by_config.values():
+            start = timezone.now()
+            try:
+                statuses = get_job_statuses(config_checks[0].jenkins_config)
+            except Exception as e:
+                logger.warning(u'Failed to fetch all jobs from Jenkins, fetching them one at a time: %s' % e)
+                statuses = {}
+            finish = timezone.now()
+            for check in config_checks:
+                if check.name in statuses:
+                    result = check._run_catching_errors(functools.partial(check._run, statuses[check.name]))
+                    runs.append((check, result, start, finish))
+                else:
+                    check_start = timezone.now()
+                    result = check._run_catching_errors()
+                    runs.append((check, result, check_start, timezone.now()))
+        cls.save_batch_results(runs)
+
+    def _run(self, status=None):
+        """Evaluates `status` (or an exception raised fetching it) if given, otherwise fetches it"""
         result = StatusCheckResult(status_check=self)
         try:
-            status = get_job_status(self.jenkins_config, self.name)
+            if isinstance(status, Exception):
+                raise status
+            if status is None:
+                status = get_job_status(self.jenkins_config, self.name)
             active = status['active']
             result.job_number = status['job_number']
             result.consecutive_failures = status['consecutive_failures']
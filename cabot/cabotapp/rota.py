@@ -0,0 +1,119 @@
+"""
+Who is on duty, answered from memory rather than a Shift query per alert
+and per /api/oncall request.
+
+The shifts which haven't ended yet are loaded into a ShiftIndex, which
+answers for any time by bisecting the sorted shift boundaries. The answer
+for now is kept until the next boundary. Everything is reloaded when
+`invalidate` bumps the version in Django's cache (update_shifts and saves
+of shifts and users do), or DUTY_OFFICER_CACHE_MAX_AGE seconds after it was
+loaded, which covers caches that aren't shared between processes.
+"""
+import bisect
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+VERSION_KEY = 'cabot-duty-officers-version'
+
+
+class ShiftIndex(object):
+    """
+    The users on duty at any time, for a list of (start, end, user) shifts.
+    A shift covers the times strictly between its start and end.
+    """
+
+    def __init__(self, shifts):
+        self.users = [user for _, _, user in shifts]
+        self.boundaries = sorted(set(t for start, end, _ in shifts for t in (start, end)))
+        starting = {}
+        ending = {}
+        for n, (start, end, _) in enumerate(shifts):
+            starting.setdefault(start, []).append(n)
+            ending.setdefault(end, []).append(n)
+        # segments[i] is the shifts covering the times between boundaries i and i + 1
+        self.segments = []
+        active = set()
+        for boundary in self.boundaries[:-1]:
+            active.difference_update(ending.get(boundary, ()))
+            active.update(starting.get(boundary, ()))
+            self.segments.append(tuple(sorted(active)))
+
+    def _segment(self, i):
+        return self.segments[i] if 0 <= i < len(self.segments) else ()
+
+    def at(self, at_time):
+        """
+        Returns the users on duty at `at_time`, and the times between which
+        that answer holds (None where it holds indefinitely).
+        """
+        i = bisect.bisect_right(self.boundaries, at_time) - 1
+        if i >= 0 and self.boundaries[i] == at_time:
+            # Only shifts running across the boundary cover it
+            after = set(self._segment(i))
+            shifts = [n for n in self._segment(i - 1) if n in after]
+            return [self.users[n] for n in shifts], at_time, at_time
+        after = self.boundaries[i] if i >= 0 else None
+        before = self.boundaries[i + 1] if i + 1 < len(self.boundaries) else None
+        return [self.users[n] for n in self._segment(i)], after, before
+
+
+class DutyOfficerResolver(object):
+    """
+    Answers `get_duty_officers` from a ShiftIndex of the shifts returned by
+    `load_shifts(now)`, falling back to `load_fallback()`'s users when no one
+    is on duty. Returns None for times before the index was loaded, which
+    it doesn't hold the shifts for.
+    """
+
+    def __init__(self, load_shifts, load_fallback):
+        self.load_shifts = load_shifts
+        self.load_fallback = load_fallback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._index = None
+            self._current = None
+
+    def _stale(self, now, version):
+        if self._index is None or version != self._version:
+            return True
+        age = (now - self._loaded_at).total_seconds()
+        return not 0 <= age < settings.DUTY_OFFICER_CACHE_MAX_AGE
+
+    def get(self, at_time=None):
+        now = timezone.now()
+        version = cache.get(VERSION_KEY)
+        with self._lock:
+            if self._stale(now, version):
+                self._index = ShiftIndex(self.load_shifts(now))
+                self._fallback = self.load_fallback()
+                self._loaded_at = now
+                self._version = version
+                self._current = None
+            if at_time is None:
+                at_time = now
+            if at_time < self._loaded_at:
+                return None
+            if self._current is not None and _between(at_time, *self._current[1:]):
+                return list(self._current[0])
+            officers, after, before = self._index.at(at_time)
+            officers = officers or self._fallback
+            if at_time == now:
+                # Good until the next shift starts or ends
+                self._current = (officers, after, before)
+            return list(officers)
+
+
+def _between(t, after, before):
+    return (after is None or after < t) and (before is None or t < before)
+
+
+def invalidate(**kwargs):
+    """Makes every process reload the duty officers on their next lookup"""
+    cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
@@ -0,0 +1,132 @@
+"""
+Helpers for spreading status check runs evenly over time.
+
+Every check gets a fixed phase within its frequency period, derived from a
+hash of its id, so it fires at the same second every cycle. When a batch of
+due checks is dispatched the phases are used as preferred countdowns, and
+checks are nudged to later seconds where needed so that the expected cost
+of the work started in each second stays flat.
+"""
+import hashlib
+import math
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+# Matches the run-all-checks beat interval in cabot.celery
+SCHEDULE_WINDOW = 60  # seconds
+
+DEFAULT_HTTP_COST = 30
+
+# Checks are routed to a queue per check type, with critical checks of any
+# type sharing a queue of their own, so that each can have its own workers.
+CHECK_QUEUES = {
+    'httpstatuscheck': 'checks.http',
+    'graphitestatuscheck': 'checks.graphite',
+    'jenkinsstatuscheck': 'checks.jenkins',
+    'icmpstatuscheck': 'checks.icmp',
+}
+PLUGIN_CHECK_QUEUE = 'checks.plugin'
+CRITICAL_CHECK_QUEUE = 'checks.critical'
+ALL_CHECK_QUEUES = sorted(CHECK_QUEUES.values()) + [PLUGIN_CHECK_QUEUE, CRITICAL_CHECK_QUEUE]
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def check_phase(check_id, period):
+    """Stable offset (in seconds) of a check within a period of `period` seconds"""
+    digest = hashlib.md5(str(check_id)).hexdigest()
+    return int(digest[:8], 16) % period
+
+
+def next_slot(check_id, frequency, earliest):
+    """
+    Returns the first time at or after `earliest` which falls on the
+    check's phase within its `frequency` (minutes) period.
+    """
+    period = max(int(frequency), 1) * 60
+    phase = check_phase(check_id, period)
+    since_epoch = int(math.ceil((earliest - EPOCH).total_seconds()))
+    cycle_start = since_epoch - (since_epoch % period)
+    slot = cycle_start + phase
+    if slot < since_epoch:
+        slot += period
+    return EPOCH + timedelta(seconds=slot)
+
+
+def expected_cost(check_type, timeout=None, frequency=None, packet_count=None, packet_interval=None):
+    """
+    Rough relative cost of running a check, used to balance slot
+    occupancy. HTTP checks can hold a worker for up to their timeout,
+    Graphite checks render a window as long as their frequency and ICMP
+    checks send their packets an interval apart, then wait for replies.
+    """
+    if check_type == 'httpstatuscheck':
+        return float(timeout or DEFAULT_HTTP_COST)
+    if check_type == 'graphitestatuscheck':
+        return float(max(frequency or 1, 1))
+    if check_type == 'icmpstatuscheck':
+        return (packet_count or 1) * (packet_interval or 1.0) + settings.ICMP_TIMEOUT
+    return 1.0
+
+
+def check_queue(check_type, critical=False):
+    """Name of the queue a check should be run from"""
+    if critical:
+        return CRITICAL_CHECK_QUEUE
+    return CHECK_QUEUES.get(check_type, PLUGIN_CHECK_QUEUE)
+
+
+def preferred_countdown(check_id, frequency, next_run_at, now, window=SCHEDULE_WINDOW):
+    """
+    Second within this scheduling window at which a due check should fire.
+    Overdue checks (including ones which have never run) fall back to their
+    phase so that they do not all fire at once.
+    """
+    countdown = int((next_run_at - now).total_seconds()) if next_run_at else -1
+    if countdown < 0:
+        period = max(int(frequency), 1) * 60
+        countdown = check_phase(check_id, period)
+    return min(countdown, window - 1)
+
+
+def spread_countdowns(checks, window=SCHEDULE_WINDOW):
+    """
+    `checks` is an iterable of (check_id, preferred_countdown, cost) tuples.
+
+    Returns a dict of check_id -> countdown. Checks keep their preferred
+    countdown unless the seconds budget is used up, in which case they move
+    to the next later second with room (or the least loaded one if there is
+    none), so the result is deterministic for a given set of checks.
+    """
+    checks = sorted(checks, key=lambda c: (c[1], c[0]))
+    if not checks:
+        return {}
+    total_cost = sum(cost for _, _, cost in checks)
+    capacity = max(total_cost / window, max(cost for _, _, cost in checks))
+
+    load = [0.0] * window
+    countdowns = {}
+    for check_id, preferred, cost in checks:
+        for second in range(preferred, window):
+            if load[second] + cost <= capacity:
+                break
+        else:
+            second = min(range(window), key=lambda s: load[s])
+        load[second] += cost
+        countdowns[check_id] = second
+    return countdowns
+
+
+def gather(countdowns, keys):
+    """
+    `keys` maps check ids to a key. Moves the checks sharing a key to the
+    latest of their countdowns, so that they are sent in the same batch.
+    """
+    latest = {}
+    for check_id, key in keys.items():
+        latest[key] = max(latest.get(key, 0), countdowns[check_id])
+    for check_id, key in keys.items():
+        countdowns[check_id] = latest[key]
+    return countdowns
@@ -1,8 +1,8 @@
 import logging
-import random
 
 from celery.task import task
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
 from datetime import timedelta
 
@@ -21,18 +21,132 @@ def run_status_check(check_or_id):
 
 
 @task(ignore_result=True)
-def run_all_checks():
+def run_status_checks(check_ids):
+    from . import metrics
     from .models import StatusCheck
-    from datetime import timedelta
-    checks = StatusCheck.objects.all()
-    seconds = range(60)
+    # Polymorphic querysets load the checks with one query per check type
+    checks = list(StatusCheck.objects.filter(id__in=check_ids))
+    if len(checks) < len(check_ids):
+        logger.info('%d checks were deleted before they could run' % (len(check_ids) - len(checks)))
+    # Check types can share work between the checks in a batch
+    checks_by_type = {}
     for check in checks:
-        if check.last_run:
-            next_schedule = check.last_run + timedelta(minutes=check.frequency)
-        if (not check.last_run) or timezone.now() > next_schedule:
-            delay = random.choice(seconds)
-            logger.debug('Scheduling task for %s seconds from now' % delay)
-            run_status_check.apply_async((check.id,), countdown=delay)
+        checks_by_type.setdefault(type(check), []).append(check)
+    for check_type, type_checks in checks_by_type.items():
+        # One broken check type shouldn't stop the rest of the batch from running
+        try:
+            check_type.run_batch(type_checks)
+        except Exception as e:
+            logger.exception('Error running %s checks: %s' % (check_type.__name__, e))
+            metrics.incr('checks.batch_failures')
+            # Let the next tick dispatch the checks which didn't finish,
+            # rather than waiting for their leases to expire
+            StatusCheck.objects.non_polymorphic().filter(
+                id__in=[check.id for check in type_checks], lease_expires_at__isnull=False,
+            ).update(lease_expires_at=None)
+
+
+@task(ignore_result=True)
+def run_all_checks():
+    from django.contrib.contenttypes.models import ContentType
+    from . import metrics
+    from .graphite import get_from, window_minutes
+    from .models import Service, StatusCheck
+    from .scheduling import (ALL_CHECK_QUEUES, SCHEDULE_WINDOW, check_queue, expected_cost, gather,
+                             preferred_countdown, spread_countdowns)
+
+    now = timezone.now()
+    # Only fetch what we need to schedule the checks falling due before the
+    # next tick; this is answered from the (active, next_run_at) index
+    # rather than loading every check.
+    due_checks = StatusCheck.objects.non_polymorphic().filter(
+        active=True,
+        next_run_at__lt=now + timedelta(seconds=SCHEDULE_WINDOW),
+    ).order_by().values_list('id', 'polymorphic_ctype_id', 'importance', 'frequency', 'timeout',
+                             'packet_count', 'packet_interval', 'next_run_at', 'lease_expires_at', 'last_run')
+
+    # Checks still holding a lease were dispatched by an earlier tick and
+    # haven't finished yet, so don't queue them up again.
+    to_schedule = []
+    queues = {}
+    graphite_checks = {}
+    in_flight = 0
+    for (check_id, ctype_id, importance, frequency, timeout, packet_count, packet_interval, next_run_at,
+         lease_expires_at, last_run) in due_checks:
+        if lease_expires_at and lease_expires_at > now:
+            in_flight += 1
+            continue
+        check_type = ContentType.objects.get_for_id(ctype_id).model
+        to_schedule.append((
+            check_id,
+            preferred_countdown(check_id, frequency, next_run_at, now),
+            expected_cost(check_type, timeout=timeout, frequency=frequency, packet_count=packet_count,
+                          packet_interval=packet_interval),
+        ))
+        if settings.CELERY_ROUTE_CHECKS_BY_TYPE:
+            queues[check_id] = check_queue(check_type, critical=importance == Service.CRITICAL_STATUS)
+        else:
+            queues[check_id] = run_status_checks.app.conf.task_default_queue
+        if check_type == 'graphitestatuscheck':
+            graphite_checks[check_id] = (frequency, last_run)
+    countdowns = spread_countdowns(to_schedule)
+
+    # Graphite checks on a queue which look at the same window are sent
+    # together, so that the worker fetches all their metrics in one render
+    # request. The window is reckoned from when they last finished, as of
+    # the end of this tick, which is near enough to the start of their last
+    # run for the grouping.
+    until = now + timedelta(seconds=SCHEDULE_WINDOW)
+    gather(countdowns, dict(
+        (check_id, (queues[check_id], get_from(window_minutes(frequency, last_run, until))))
+        for check_id, (frequency, last_run) in graphite_checks.items()))
+
+    StatusCheck.objects.non_polymorphic().filter(id__in=countdowns.keys()).update(
+        lease_expires_at=now + timedelta(seconds=SCHEDULE_WINDOW + settings.CHECK_LEASE_EXPIRY))
+
+    # Checks starting in the same second on the same queue are sent together in chunks
+    batches = {}
+    for check_id, delay in countdowns.items():
+        batches.setdefault((delay, queues[check_id]), []).append(check_id)
+    dispatched = {}
+    for (delay, queue), check_ids in sorted(batches.items()):
+        check_ids.sort()
+        for i in range(0, len(check_ids), settings.CHECK_BATCH_SIZE):
+            chunk = check_ids[i:i + settings.CHECK_BATCH_SIZE]
+            logger.debug('Scheduling %d checks on %s for %s seconds from now' % (len(chunk), queue, delay))
+            run_status_checks.apply_async((chunk,), countdown=delay, queue=queue)
+        dispatched[queue] = dispatched.get(queue, 0) + len(check_ids)
+
+    if in_flight:
+        logger.info('Skipped %d due checks which are still in flight' % in_flight)
+    metrics.incr('scheduler.checks_dispatched', len(countdowns))
+    metrics.incr('scheduler.duplicate_dispatches_prevented', in_flight)
+    metrics.gauge('scheduler.due_checks_in_flight', in_flight)
+    for queue, count in dispatched.items():
+        metrics.incr('scheduler.checks_dispatched.%s' % queue, count)
+
+    if settings.CELERY_ROUTE_CHECKS_BY_TYPE:
+        _record_queue_backlogs(ALL_CHECK_QUEUES)
+    else:
+        _record_queue_backlogs([run_status_checks.app.conf.task_default_queue])
+
+
+def _record_queue_backlogs(queues):
+    """Record how many messages are waiting on each queue"""
+    from . import metrics
+    with run_all_checks.app.connection_or_acquire() as conn:
+        for queue in queues:
+            # Passive declares fail (and can close the channel) if the queue
+            # doesn't exist yet, so use a channel each.
+            channel = conn.channel()
+            try:
+                backlog = channel.queue_declare(queue=queue, passive=True).message_count
+            except Exception as e:
+                logger.debug('Could not get backlog of queue %s: %s' % (queue, e))
+                continue
+            finally:
+                channel.close()
+            metrics.gauge('queue.%s.backlog' % queue, backlog)
 
 
 @task(ignore_result=True)
@@ -41,6 +155,40 @@ def update_services(ignore_result=True):
     return
 
 
+def _pending_update_key(kind, obj_id):
+    return 'cabot-pending-update:%s:%s' % (kind, obj_id)
+
+
+def _schedule_update(update_task, kind, obj_id):
+    """
+    Queues `update_task` for the object, unless an update of it is already
+    waiting to run, in which case that one will see this change too.
+
+    The pending key lapses when the queued update is due, rather than being
+    cleared by the worker that runs it, since with a per-process cache that
+    may not be the worker which added it.
+    """
+    from . import metrics
+    window = settings.STATUS_UPDATE_COALESCE_WINDOW
+    # Eager tasks run straight away, so there is nothing pending to join
+    if window <= 0 or update_task.app.conf.task_always_eager:
+        update_task.delay(obj_id)
+        return
+    if cache.add(_pending_update_key(kind, obj_id), True, timeout=window):
+        metrics.incr('status_updates.%s.scheduled' % kind)
+        update_task.apply_async((obj_id,), countdown=window)
+    else:
+        metrics.incr('status_updates.%s.collapsed' % kind)
+
+
+def schedule_service_update(service_id):
+    _schedule_update(update_service, 'service', service_id)
+
+
+def schedule_instance_update(instance_id):
+    _schedule_update(update_instance, 'instance', instance_id)
+
+
 @task(ignore_result=True)
 def update_service(service_or_id):
     from .models import Service
@@ -67,6 +215,22 @@ def update_shifts():
     _update_shifts()
 
 
+@task(ignore_result=True)
+def update_metric_index():
+    from .graphite import update_metric_index as _update_metric_index
+    if not settings.GRAPHITE_API or not settings.GRAPHITE_METRIC_INDEX_PATH:
+        return
+    index = _update_metric_index()
+    logger.info('Metric index holds %d metrics' % len(index))
+
+
+@task(ignore_result=True)
+def log_metrics():
+    from . import metrics
+    values = metrics.snapshot()
+    logger.info('Metrics: %s' % ', '.join('%s=%s' % item for item in sorted(values.items())))
+
+
 @task(ignore_result=True)
 def clean_db(days_to_retain=7, batch_size=10000):
     """
@@ -7,20 +7,21 @@ from datetime import timedelta, date
 
 import os
 import requests
-from cabot.cabotapp.graphite import parse_metric
+from cabot.cabotapp.graphite import parse_metric, render_cache
 from cabot.cabotapp.alert import update_alert_plugins, AlertPlugin
 from cabot.cabotapp.models import (
     GraphiteStatusCheck, JenkinsStatusCheck, JenkinsConfig,
     HttpStatusCheck, ICMPStatusCheck, Service, Instance,
     StatusCheckResult, minimize_targets, ServiceStatusSnapshot,
-    get_custom_check_plugins, create_default_jenkins_config)
+    get_custom_check_plugins, create_default_jenkins_config, duty_officer_resolver)
 from cabot.cabotapp.calendar import get_events
 from cabot.cabotapp.views import StatusCheckReportForm
-from cabot.cabotapp import tasks
+from cabot.cabotapp import metrics, tasks
 from django.conf import settings
 from django.contrib.auth.models import Permission
 from django.contrib.auth.models import User
 from django.core import mail
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from django.test.utils import override_settings
@@ -50,6 +51,8 @@ class LocalTestCase(APITestCase):
     def setUp(self):
         requests.get = Mock()
         requests.post = Mock()
+        render_cache.clear()
+        duty_officer_resolver.reset()
         rest.TwilioRestClient = Mock()
         mail.send_mail = Mock()
         self.create_dummy_data()
@@ -175,20 +178,29 @@ def jenkins_blocked_response(*args, **kwargs):
     }
 
 
-def fake_http_200_response(*args, **kwargs):
+def fake_http_response(content, status_code, chunk_size=1024):
     resp = Mock()
-    resp.content = get_content('http_response.html')
+    resp.content = content
     resp.text = unicode(resp.content, 'utf-8')
-    resp.status_code = 200
+    resp.encoding = 'utf-8'
+    resp.status_code = status_code
+    resp.raw._original_response.phase_timings = {'dns': 0.002, 'connect': 0.01, 'tls': 0.03, 'ttfb': 0.1}
+    resp.chunks_read = 0
+
+    def iter_content(*args, **kwargs):
+        for i in range(0, len(content), chunk_size):
+            resp.chunks_read += 1
+            yield content[i:i + chunk_size]
+    resp.iter_content = iter_content
     return resp
 
 
+def fake_http_200_response(*args, **kwargs):
+    return fake_http_response(get_content('http_response.html'), 200)
+
+
 def fake_http_404_response(*args, **kwargs):
-    resp = Mock()
-    resp.content = get_content('http_response.html')
-    resp.text = unicode(resp.content, 'utf-8')
-    resp.status_code = 404
-    return resp
+    return fake_http_response(get_content('http_response.html'), 404)
 
 
 def fake_gcal_response(*args, **kwargs):
@@ -438,7 +450,7 @@ class TestCheckRun(LocalTestCase):
         self.assertIn(u'Error fetching from Jenkins - фиктивная ошибка',
                       self.jenkins_check.last_result().error)
 
-    @patch('cabot.cabotapp.models.requests.get', fake_http_200_response)
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
     def test_http_run(self):
         checkresults = self.http_check.statuscheckresult_set.all()
         self.assertEqual(len(checkresults), 0)
@@ -464,7 +476,7 @@ class TestCheckRun(LocalTestCase):
         self.assertIn(u'Failed to find match regex',
             self.http_check.last_result().error)
 
-    @patch('cabot.cabotapp.models.requests.get', throws_timeout)
+    @patch('cabot.cabotapp.models.base.pooled_get', throws_timeout)
     def test_timeout_handling_in_http(self):
         checkresults = self.http_check.statuscheckresult_set.all()
         self.assertEqual(len(checkresults), 0)
@@ -475,7 +487,7 @@ class TestCheckRun(LocalTestCase):
         self.assertIn(u'Request error occurred: фиктивная ошибка innit',
                       self.http_check.last_result().error)
 
-    @patch('cabot.cabotapp.models.requests.get', fake_http_404_response)
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_404_response)
     def test_http_run_bad_resp(self):
         checkresults = self.http_check.statuscheckresult_set.all()
         self.assertEqual(len(checkresults), 0)
@@ -779,6 +791,7 @@ class TestAPI(LocalTestCase):
                     'value': u'9.0',
                     'expected_num_hosts': 0,
                     'allowed_num_failures': 0,
+                    'aggregate_in_graphite': False,
                     'id': self.graphite_check.id,
                     'calculated_status': u'passing',
                 },
@@ -797,6 +810,8 @@ class TestAPI(LocalTestCase):
                     'status_code': u'200',
                     'timeout': 10,
                     'verify_ssl_certificate': True,
+                    'max_ttfb': None,
+                    'max_total_time': None,
                     'id': self.http_check.id,
                     'calculated_status': u'passing',
                 },
@@ -821,6 +836,10 @@ class TestAPI(LocalTestCase):
                     'importance': u'ERROR',
                     'frequency': 5,
                     'debounce': 0,
+                    'packet_count': 1,
+                    'packet_interval': 1.0,
+                    'max_packet_loss': 0,
+                    'max_rtt': None,
                     'id': pingcheck.id,
                     'calculated_status': u'passing',
                 },
@@ -866,6 +885,7 @@ class TestAPI(LocalTestCase):
                     'value': u'2',
                     'expected_num_hosts': 0,
                     'allowed_num_failures': 0,
+                    'aggregate_in_graphite': False,
                     'id': self.graphite_check.id,
                     'calculated_status': u'passing',
                 },
@@ -884,6 +904,8 @@ class TestAPI(LocalTestCase):
                     'status_code': u'201',
                     'timeout': 30,
                     'verify_ssl_certificate': True,
+                    'max_ttfb': 500,
+                    'max_total_time': 2000,
                     'id': self.http_check.id,
                     'calculated_status': u'passing',
                 },
@@ -908,6 +930,10 @@ class TestAPI(LocalTestCase):
                     'importance': u'CRITICAL',
                     'frequency': 5,
                     'debounce': 0,
+                    'packet_count': 5,
+                    'packet_interval': 0.5,
+                    'max_packet_loss': 20,
+                    'max_rtt': 100,
                     'id': pingcheck.id,
                     'calculated_status': u'passing',
                 },
@@ -918,6 +944,46 @@ class TestAPI(LocalTestCase):
         response = self.client.get(api_reverse('statuscheck-list'))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
 
+    def test_metrics_are_served_and_logged(self):
+        cache.clear()
+        metrics.reset()
+        metrics.incr('checks.dispatched', 3)
+        metrics.incr('checks.dispatched')
+        metrics.gauge('queue.backlog', 7)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(response.data, {'checks.dispatched': 4, 'queue.backlog': 7})
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 401)
+
+        with patch('cabot.cabotapp.tasks.logger') as mock_logger:
+            tasks.log_metrics()
+        mock_logger.info.assert_called_once_with('Metrics: checks.dispatched=4, queue.backlog=7')
+
+    @override_settings(METRICS_FLUSH_INTERVAL=30)
+    def test_metrics_are_counted_in_memory(self):
+        cache.clear()
+        metrics.flush()
+        with patch('cabot.cabotapp.metrics.cache') as mock_cache:
+            for _ in range(100):
+                metrics.incr('checks.dispatched')
+        self.assertFalse(mock_cache.method_calls)
+        self.assertEqual(metrics.get('checks.dispatched'), 100)
+        with freeze_time(timezone.now() + timedelta(seconds=31)):
+            metrics.incr('checks.dispatched')
+        self.assertEqual(cache.get(metrics.KEY_PREFIX + 'checks.dispatched'), 101)
+
+    def test_status_check_results_are_paginated(self):
+        StatusCheckResult.objects.bulk_create([
+            StatusCheckResult(status_check=self.http_check, time=timezone.now(), time_complete=timezone.now(),
+                              succeeded=True)
+            for _ in range(150)])
+        total = StatusCheckResult.objects.count()
+        response = self.client.get(api_reverse('statuscheckresult-list'), format='json',
+                                   HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(len(response.data['results']), 100)
+        response = self.client.get(response.data['next'], format='json', HTTP_AUTHORIZATION=self.basic_auth)
+        self.assertEqual(len(response.data['results']), total - 100)
+        self.assertIsNone(response.data['next'])
+
     def normalize_dict(self, operand):
         for key, val in operand.items():
             if isinstance(val, list):
@@ -0,0 +1,184 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.utils import timezone
+from freezegun import freeze_time
+from icalendar import Calendar
+from mock import Mock, patch
+
+from cabot.cabotapp import calendar, metrics
+from cabot.cabotapp.models import Shift, update_shifts
+
+from .tests_basic import LocalTestCase, get_content
+
+
+class FakeFeed(object):
+    """A calendar feed server, which may support conditional requests"""
+
+    def __init__(self, fixture='recurring_response.ics', etag=None, last_modified=None):
+        self.content = get_content(fixture)
+        self.etag = etag
+        self.last_modified = last_modified
+        self.requests = []
+
+    def __call__(self, url, headers=None, **kwargs):
+        headers = headers or {}
+        self.requests.append(headers)
+        resp = Mock()
+        resp.headers = {}
+        if self.etag:
+            resp.headers['ETag'] = self.etag
+        if self.last_modified:
+            resp.headers['Last-Modified'] = self.last_modified
+        not_modified = (
+            (self.etag and headers.get('If-None-Match') == self.etag) or
+            (self.last_modified and headers.get('If-Modified-Since') == self.last_modified))
+        resp.status_code = 304 if not_modified else 200
+        resp.content = '' if not_modified else self.content
+        return resp
+
+
+@freeze_time('2016-12-01 12:00')
+class TestUpdateShifts(LocalTestCase):
+
+    def setUp(self):
+        super(TestUpdateShifts, self).setUp()
+        cache.delete(calendar.FEED_STATE_KEY)
+        calendar.occurrence_cache.clear()
+        self.foo = User.objects.create(username='foo')
+        self.bar = User.objects.create(username='bar')
+
+    def shifts(self):
+        return sorted(Shift.objects.values_list('id', 'uid', 'start', 'deleted'))
+
+    def test_creates_shifts(self):
+        with patch('cabot.cabotapp.calendar.requests.get', FakeFeed()):
+            update_shifts()
+        shifts = Shift.objects.filter(deleted=False)
+        self.assertEqual(shifts.filter(user=self.foo).count(), 30)
+        self.assertEqual(shifts.filter(user=self.bar).count(), 30)
+        self.assertTrue(all(shift.start > timezone.now() for shift in shifts))
+
+    def test_not_modified_feed_costs_one_request(self):
+        feed = FakeFeed(etag='"v1"', last_modified='Thu, 01 Dec 2016 10:00:00 GMT')
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            update_shifts()
+            before = self.shifts()
+            not_modified = metrics.get('calendar.not_modified')
+            update_shifts()
+        self.assertEqual(feed.requests[1], {'If-None-Match': '"v1"',
+                                            'If-Modified-Since': 'Thu, 01 Dec 2016 10:00:00 GMT'})
+        self.assertEqual(metrics.get('calendar.not_modified'), not_modified + 1)
+        self.assertEqual(self.shifts(), before)
+
+    def test_unchanged_content_is_not_processed(self):
+        feed = FakeFeed()
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            update_shifts()
+            before = self.shifts()
+            with patch('cabot.cabotapp.models.base.Shift.objects') as mock_shifts:
+                update_shifts()
+        self.assertFalse(mock_shifts.method_calls)
+        self.assertEqual(self.shifts(), before)
+
+    def test_only_changed_events_are_processed(self):
+        feed = FakeFeed()
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            update_shifts()
+            foo_shifts = list(Shift.objects.filter(user=self.foo).values_list('id', flat=True))
+            bar_shifts = list(Shift.objects.filter(user=self.bar).values_list('id', flat=True))
+
+            # bar's shifts are given to foo
+            feed.content = feed.content.replace(
+                'LAST-MODIFIED:20161128T203947Z', 'LAST-MODIFIED:20161201T100000Z').replace(
+                'SUMMARY:bar', 'SUMMARY:foo')
+            update_shifts()
+
+        # foo's own shifts weren't touched
+        self.assertEqual(list(Shift.objects.filter(user=self.foo, id__in=foo_shifts, deleted=False)
+                              .values_list('id', flat=True)), foo_shifts)
+        self.assertFalse(Shift.objects.filter(id__in=bar_shifts, deleted=False).exists())
+        self.assertEqual(Shift.objects.filter(user=self.foo, deleted=False).count(), 60)
+
+    def test_unchanged_feed_is_processed_again_eventually(self):
+        feed = FakeFeed(etag='"v1"')
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            update_shifts()
+            with freeze_time(timezone.now() + calendar.REPROCESS_INTERVAL + timedelta(minutes=1)):
+                update_shifts()
+        self.assertEqual(feed.requests[1], {})
+        # New occurrences have come into the window
+        self.assertEqual(Shift.objects.filter(deleted=False, start__gt=timezone.now() + timedelta(days=60)).count(),
+                         1)
+
+    def test_reports_changes(self):
+        feed = FakeFeed()
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            self.assertEqual(update_shifts(), {'created': 60, 'updated': 0, 'deleted': 0, 'undeleted': 0,
+                                               'duplicates_removed': 0})
+            feed.content = feed.content.replace('SUMMARY:bar', 'SUMMARY:nobody')
+            self.assertEqual(update_shifts(), {'created': 0, 'updated': 0, 'deleted': 30, 'undeleted': 0,
+                                               'duplicates_removed': 0})
+
+    def test_reprocessing_writes_nothing(self):
+        feed = FakeFeed()
+        with patch('cabot.cabotapp.calendar.requests.get', feed):
+            update_shifts()
+            before = self.shifts()
+            cache.delete(calendar.FEED_STATE_KEY)
+            with patch('cabot.cabotapp.models.base.Shift.objects.bulk_create') as mock_create:
+                changes = update_shifts()
+        self.assertEqual(mock_create.call_args[0][0], [])
+        self.assertEqual(set(changes.values()), {0})
+        self.assertEqual(self.shifts(), before)
+
+    def test_duplicates_are_removed_and_deleted_shifts_restored(self):
+        with patch('cabot.cabotapp.calendar.requests.get', FakeFeed()):
+            update_shifts()
+            shift = Shift.objects.filter(user=self.foo).earliest('start')
+            Shift.objects.filter(user=self.bar).update(deleted=True)
+            Shift.objects.create(uid=shift.uid, start=shift.start, end=shift.end,
+                                 last_modified=shift.last_modified, user=self.foo)
+            cache.delete(calendar.FEED_STATE_KEY)
+            changes = update_shifts()
+        self.assertEqual(changes['duplicates_removed'], 1)
+        self.assertEqual(changes['undeleted'], 30)
+        self.assertEqual(Shift.objects.filter(uid=shift.uid, start=shift.start).count(), 1)
+        self.assertEqual(Shift.objects.filter(deleted=False).count(), 60)
+
+
+@freeze_time('2016-12-01 12:00')
+class TestRecurringEvents(LocalTestCase):
+
+    def setUp(self):
+        super(TestRecurringEvents, self).setUp()
+        calendar.occurrence_cache.clear()
+        self.calendar = Calendar.from_ical(get_content('recurring_response.ics'))
+
+    def starts(self):
+        return sorted(event['start'] for event in calendar.get_events(self.calendar))
+
+    def test_expansion_is_reused_as_the_window_moves(self):
+        first = self.starts()
+        for days in [0, 1, 2, 5, 59, 61, 200]:
+            with freeze_time(timezone.now() + timedelta(days=days, hours=3)):
+                cached = self.starts()
+                calendar.occurrence_cache.clear()
+                self.assertEqual(cached, self.starts(), days)
+        self.assertEqual(len(first), 60)
+
+    def test_unchanged_events_are_not_expanded_again(self):
+        self.starts()
+        with patch('cabot.cabotapp.calendar.rrule.rrulestr') as mock_rrulestr:
+            with freeze_time(timezone.now() + timedelta(days=1)):
+                self.starts()
+        self.assertFalse(mock_rrulestr.called)
+
+    def test_edited_events_are_expanded_again(self):
+        before = self.starts()
+        edited = get_content('recurring_response.ics').replace(
+            'LAST-MODIFIED:20161128T203947Z', 'LAST-MODIFIED:20161201T100000Z').replace(
+            'INTERVAL=2\nDTSTAMP:20161128T214445Z\nUID:s4ft', 'INTERVAL=4\nDTSTAMP:20161128T214445Z\nUID:s4ft')
+        self.calendar = Calendar.from_ical(edited)
+        self.assertEqual((len(before), len(self.starts())), (60, 45))
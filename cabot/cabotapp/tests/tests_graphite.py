@@ -0,0 +1,368 @@
+import json
+import re
+import unittest
+
+import requests
+from django.test.utils import override_settings
+from mock import Mock, patch
+
+from cabot.cabotapp import graphite, metrics
+from cabot.cabotapp.graphite import (cache_ttl, get_data, get_data_many, normalize_target, parse_data,
+                                     series_from_raw, unsupported_formats)
+from cabot.cabotapp.models import GraphiteStatusCheck, Service
+
+from .tests_basic import LocalTestCase, fake_graphite_response, get_content
+
+# see graphite_response.json for this magic timestamp
+UTCNOW = 1387818601
+
+
+def fake_batched_render(url, data=None, **kwargs):
+    """Answers a batched render request with the series in graphite_response.json for each target"""
+    series = []
+    for target in data['target']:
+        tag = re.search(r"'(__cabot_\d+__)'\)$", target).group(1)
+        for s in json.loads(get_content('graphite_response.json')):
+            s['target'] = tag + s['target']
+            series.append(s)
+    resp = Mock()
+    resp.json = lambda: series
+    return resp
+
+
+def to_raw(data):
+    """Graphite's raw rendering of series, as a list of lines"""
+    lines = []
+    for series in data:
+        timestamps = [t for _, t in series['datapoints']]
+        step = timestamps[1] - timestamps[0]
+        lines.append('%s,%d,%d,%d|%s' % (series['target'], timestamps[0], timestamps[-1] + step, step,
+                                         ','.join(repr(v) for v, _ in series['datapoints'])))
+    return lines
+
+
+def to_msgpack(data):
+    """Graphite's msgpack rendering of series"""
+    series = []
+    for s in data:
+        timestamps = [t for _, t in s['datapoints']]
+        step = timestamps[1] - timestamps[0]
+        series.append({'name': s['target'], 'start': timestamps[0], 'end': timestamps[-1] + step,
+                       'step': step, 'values': [v for v, _ in s['datapoints']]})
+    return graphite.msgpack.packb(series, use_bin_type=True)
+
+
+def fake_render_response(content_type, lines=None, content=None):
+    resp = Mock()
+    resp.headers = {'content-type': content_type}
+    resp.iter_lines.return_value = lines or []
+    resp.content = content
+    resp.json = lambda: json.loads(get_content('graphite_response.json'))
+    return resp
+
+
+class TestGraphiteBatch(LocalTestCase):
+
+    def setUp(self):
+        super(TestGraphiteBatch, self).setUp()
+        self.checks = [
+            GraphiteStatusCheck.objects.create(
+                name='Graphite Check %d' % i,
+                metric='stats.fake.value%d' % i,
+                check_type='>',
+                value=value,
+                importance=Service.ERROR_STATUS,
+            )
+            for i, value in enumerate(['9.0', '11.0', '9.0'])
+        ]
+        for check in self.checks:
+            check.utcnow = UTCNOW
+
+    @patch('cabot.cabotapp.graphite.requests.get')
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=fake_batched_render)
+    def test_checks_share_a_render_request(self, mock_post, mock_get):
+        GraphiteStatusCheck.run_batch(self.checks)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertFalse(mock_get.called)
+        self.assertEqual(mock_post.call_args[1]['data']['target'], [
+            "aliasSub(stats.fake.value0, '^', '__cabot_0__')",
+            "aliasSub(stats.fake.value1, '^', '__cabot_1__')",
+            "aliasSub(stats.fake.value2, '^', '__cabot_2__')",
+        ])
+        self.assertEqual([check.last_result().succeeded for check in self.checks], [False, True, False])
+        self.assertEqual(self.checks[0].last_result().error, u'PROD: 9.16092 > 9.0')
+        self.assertNotIn('__cabot_', self.checks[0].last_result().raw_data)
+
+    @patch('cabot.cabotapp.graphite.requests.get', fake_graphite_response)
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=fake_batched_render)
+    def test_same_results_as_running_singly(self, mock_post):
+        GraphiteStatusCheck.run_batch(self.checks)
+        batched = [(r.succeeded, r.error) for r in (check.last_result() for check in self.checks)]
+        for check in self.checks:
+            check.run()
+        single = [(r.succeeded, r.error) for r in (check.last_result() for check in self.checks)]
+        self.assertEqual(batched, single)
+
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=fake_batched_render)
+    def test_one_request_per_window(self, mock_post):
+        self.checks[2].frequency = 10
+        self.checks[2].save()
+        GraphiteStatusCheck.run_batch(self.checks)
+        windows = sorted((call[1]['data']['from'], len(call[1]['data']['target']))
+                         for call in mock_post.call_args_list)
+        self.assertEqual(windows, [('-10minute', 1), ('-5minute', 2)])
+
+    @patch('cabot.cabotapp.graphite.requests.get', fake_graphite_response)
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=requests.exceptions.HTTPError('400 bad target'))
+    def test_falls_back_to_one_request_per_check(self, mock_post):
+        GraphiteStatusCheck.run_batch(self.checks)
+        self.assertEqual([check.last_result().succeeded for check in self.checks], [False, True, False])
+
+    @patch('cabot.cabotapp.graphite.requests.post')
+    def test_get_data_many_splits_series(self, mock_post):
+        mock_post.return_value.json.return_value = [
+            {'target': '__cabot_1__b.one', 'datapoints': []},
+            {'target': '__cabot_0__a', 'datapoints': []},
+            {'target': 'untagged', 'datapoints': []},
+            {'target': '__cabot_1__b.two', 'datapoints': []},
+        ]
+        split = get_data_many(['a', 'b.*', 'c'], 5)
+        self.assertEqual([[s['target'] for s in series] for series in split],
+                         [['a'], ['b.one', 'b.two'], []])
+        self.assertEqual(mock_post.call_args[1]['data']['from'], '-5minute')
+
+
+class TestGraphiteRenderCache(LocalTestCase):
+
+    def setUp(self):
+        super(TestGraphiteRenderCache, self).setUp()
+        self.hits = metrics.get('graphite.render_cache.hits')
+        self.misses = metrics.get('graphite.render_cache.misses')
+
+    @patch('cabot.cabotapp.graphite.requests.get', side_effect=fake_graphite_response)
+    def test_renders_are_reused(self, mock_get):
+        first = get_data('stats.fake.value', 5)
+        self.assertEqual(get_data(' stats.fake.value ', 5), first)
+        self.assertEqual(mock_get.call_count, 1)
+        # A different window is fetched separately
+        get_data('stats.fake.value', 10)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(metrics.get('graphite.render_cache.hits'), self.hits + 1)
+        self.assertEqual(metrics.get('graphite.render_cache.misses'), self.misses + 2)
+
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=fake_batched_render)
+    def test_lookups_are_counted_once_per_request(self, mock_post):
+        get_data_many(['a', 'b', 'c'], 5)
+        with patch('cabot.cabotapp.graphite.metrics.incr') as mock_incr:
+            get_data_many(['a', 'b', 'c'], 5)
+        mock_incr.assert_called_once_with('graphite.render_cache.hits', 3)
+        self.assertEqual(mock_post.call_count, 1)
+
+    @patch('cabot.cabotapp.graphite.requests.get', side_effect=fake_graphite_response)
+    def test_entries_expire_after_resolution(self, mock_get):
+        # graphite_response.json has a point a minute, so at most the max TTL
+        with patch('cabot.cabotapp.utils.time.time', return_value=1000):
+            get_data('stats.fake.value', 5)
+        with patch('cabot.cabotapp.utils.time.time', return_value=1029):
+            get_data('stats.fake.value', 5)
+        self.assertEqual(mock_get.call_count, 1)
+        with patch('cabot.cabotapp.utils.time.time', return_value=1031):
+            get_data('stats.fake.value', 5)
+        self.assertEqual(mock_get.call_count, 2)
+
+    @override_settings(GRAPHITE_RENDER_CACHE_MAX_TTL=300)
+    def test_ttl_is_the_step_between_points(self):
+        data = json.loads(get_content('graphite_response.json'))
+        self.assertEqual(cache_ttl(data), 60)
+        self.assertEqual(cache_ttl([]), 300)
+
+    def test_normalize_target(self):
+        self.assertEqual(normalize_target(" sumSeries( a.*, b ) "), "sumSeries(a.*,b)")
+        self.assertEqual(normalize_target("alias(a, 'two  words')"), "alias(a,'two  words')")
+
+    @patch('cabot.cabotapp.graphite.requests.post', side_effect=fake_batched_render)
+    @patch('cabot.cabotapp.graphite.requests.get', side_effect=fake_graphite_response)
+    def test_batches_only_fetch_targets_not_cached(self, mock_get, mock_post):
+        get_data('stats.fake.value1', 5)
+        split = get_data_many(['stats.fake.value0', 'stats.fake.value1'], 5)
+        self.assertEqual(mock_post.call_args[1]['data']['target'],
+                         ["aliasSub(stats.fake.value0, '^', '__cabot_0__')"])
+        self.assertEqual(split[0], split[1])
+        get_data_many(['stats.fake.value0', 'stats.fake.value1'], 5)
+        self.assertEqual(mock_post.call_count, 1)
+
+
+class TestGraphiteFormats(LocalTestCase):
+
+    def setUp(self):
+        super(TestGraphiteFormats, self).setUp()
+        unsupported_formats.clear()
+        self.addCleanup(unsupported_formats.clear)
+        self.expected = json.loads(get_content('graphite_response.json'))
+
+    @override_settings(GRAPHITE_FORMAT='raw')
+    @patch('cabot.cabotapp.graphite.requests.get')
+    def test_raw(self, mock_get):
+        mock_get.return_value = fake_render_response(
+            'text/plain', lines=to_raw(self.expected))
+        self.assertEqual(get_data('stats.fake.value', 5), self.expected)
+        self.assertEqual(mock_get.call_args[1]['params']['format'], 'raw')
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        self.assertTrue(mock_get.return_value.close.called)
+
+    def test_raw_names_and_missing_values(self):
+        lines = ['sumSeries(a,b),100,130,10|1.5,None,2.0', '', 'empty,100,100,10|']
+        self.assertEqual(series_from_raw(lines), [
+            {'target': 'sumSeries(a,b)', 'datapoints': [[1.5, 100], [None, 110], [2.0, 120]]},
+            {'target': 'empty', 'datapoints': []},
+        ])
+
+    @unittest.skipIf(graphite.msgpack is None, 'msgpack is not installed')
+    @override_settings(GRAPHITE_FORMAT='msgpack')
+    @patch('cabot.cabotapp.graphite.requests.post')
+    def test_msgpack_batch(self, mock_post):
+        tagged = [dict(s, target='__cabot_0__' + s['target']) for s in self.expected]
+        mock_post.return_value = fake_render_response(
+            'application/x-msgpack', content=to_msgpack(tagged))
+        self.assertEqual(get_data_many(['stats.fake.value'], 5), [self.expected])
+        self.assertEqual(mock_post.call_args[1]['data']['format'], 'msgpack')
+
+    @override_settings(GRAPHITE_FORMAT='raw')
+    @patch('cabot.cabotapp.graphite.requests.get')
+    def test_falls_back_to_json(self, mock_get):
+        # Graphite renders a graph for formats it doesn't know
+        mock_get.return_value = fake_render_response('image/png')
+        self.assertEqual(get_data('stats.fake.value', 5), self.expected)
+        self.assertEqual([call[1]['params']['format'] for call in mock_get.call_args_list], ['raw', 'json'])
+        # and doesn't try again
+        mock_get.reset_mock()
+        get_data('stats.fake.other', 5)
+        self.assertEqual(mock_get.call_args[1]['params']['format'], 'json')
+
+
+class TestParseData(unittest.TestCase):
+
+    def test_missing_and_old_points_are_dropped(self):
+        data = [
+            {'target': 'a', 'datapoints': [[None, UTCNOW - 60], [0.1, UTCNOW - 30], [7, UTCNOW - 400]]},
+            {'target': 'empty', 'datapoints': []},
+            {'target': 'nulls', 'datapoints': [[None, UTCNOW - 60]]},
+            {'target': 'b', 'datapoints': [[0.2, UTCNOW - 60], [0.3, UTCNOW - 30], [-1, UTCNOW]]},
+        ]
+        parsed = parse_data(data, 5, UTCNOW)
+        self.assertEqual(parsed['num_series_no_data'], 2)
+        self.assertEqual([(s['target'], s['min'], s['max']) for s in parsed['series']],
+                         [('a', 0.1, 0.1), ('b', -1.0, 0.3)])
+        self.assertEqual(list(parsed['all_values']), [0.1, 0.2, 0.3, -1.0])
+
+    @unittest.skipIf(graphite.numpy is None, 'numpy is not installed')
+    def test_arrays_give_the_same_results(self):
+        data = [{'target': 'nulls', 'datapoints': [[None, UTCNOW - 60 * i] for i in range(30)]}]
+        for n in range(4):
+            data.append({'target': 'host%d' % n, 'datapoints': [
+                [None if i % 7 == n else (i * (n + 3) % 101) / 7.0 - 5, UTCNOW - 30 * i] for i in range(1000)]})
+        for mins in [1, 10, 1000]:
+            arrays = parse_data(data, mins, UTCNOW)
+            with patch('cabot.cabotapp.graphite.ARRAY_MIN_POINTS', len(data) * 1000 + 1):
+                lists = parse_data(data, mins, UTCNOW)
+            self.assertIsInstance(arrays['all_values'], graphite.numpy.ndarray)
+            self.assertEqual(arrays['num_series_no_data'], lists['num_series_no_data'])
+            self.assertEqual([(s['target'], s['min'], s['max'], list(s['values'])) for s in arrays['series']],
+                             [(s['target'], s['min'], s['max'], s['values']) for s in lists['series']])
+            for a, b in zip(arrays['series'], lists['series']):
+                self.assertAlmostEqual(a['average_value'], b['average_value'])
+            self.assertAlmostEqual(arrays['average_value'], lists['average_value'])
+
+            for check_type in ['<', '<=', '>', '>=', '==']:
+                for threshold in [-5.0, 0.0, 4.0, 9.0]:
+                    failures = graphite.series_failures(arrays['series'], check_type, threshold)
+                    with patch('cabot.cabotapp.graphite.numpy', None):
+                        self.assertEqual(failures, graphite.series_failures(lists['series'], check_type, threshold))
+
+
+def aggregated_response(data, aggregate):
+    """What Graphite sends for metric_target(metric, aggregate), given the series of the metric"""
+    reduce_values = max if aggregate == 'maxSeries' else min
+    with_data = [s for s in data if any(v is not None for v, _ in s['datapoints'])]
+    points = []
+    sums = []
+    for i, (_, timestamp) in enumerate(data[0]['datapoints']):
+        values = [s['datapoints'][i][0] for s in data if s['datapoints'][i][0] is not None]
+        points.append([reduce_values(values) if values else None, timestamp])
+        sums.append([sum(values) if values else None, len(values), timestamp])
+    return [
+        {'target': '__cabot_aggregate__', 'datapoints': points},
+        {'target': '__cabot_count__', 'datapoints': [[len(with_data), t] for _, t in points]},
+        {'target': '__cabot_sum__', 'datapoints': [[total, t] for total, _, t in sums]},
+        {'target': '__cabot_points__', 'datapoints': [[n, t] for _, n, t in sums]},
+    ]
+
+
+class TestGraphiteAggregation(LocalTestCase):
+
+    def setUp(self):
+        super(TestGraphiteAggregation, self).setUp()
+        self.graphite_check.utcnow = UTCNOW
+        self.series = json.loads(get_content('graphite_response.json'))
+
+    def test_aggregate(self):
+        check = self.graphite_check
+        self.assertIsNone(check.aggregate())
+        check.aggregate_in_graphite = True
+        self.assertEqual(check.aggregate(), 'maxSeries')
+        check.check_type = '<='
+        self.assertEqual(check.aggregate(), 'minSeries')
+        check.check_type = '=='
+        self.assertIsNone(check.aggregate())
+        check.check_type = '<'
+        check.allowed_num_failures = 1
+        self.assertIsNone(check.aggregate())
+
+    @patch('cabot.cabotapp.graphite.requests.get')
+    def test_only_the_aggregate_is_fetched(self, mock_get):
+        mock_get.return_value.json.return_value = aggregated_response(self.series, 'maxSeries')
+        self.graphite_check.aggregate_in_graphite = True
+        self.graphite_check.expected_num_hosts = 2
+        self.graphite_check.save()
+        self.graphite_check.run()
+        self.assertEqual(mock_get.call_args[1]['params']['target'],
+                         "group(alias(maxSeries(stats.fake.value), '__cabot_aggregate__'), "
+                         "alias(countSeries(removeEmptySeries(stats.fake.value)), '__cabot_count__'), "
+                         "alias(sumSeries(stats.fake.value), '__cabot_sum__'), "
+                         "alias(sumSeries(isNonNull(stats.fake.value)), '__cabot_points__'))")
+        result = self.graphite_check.last_result()
+        self.assertFalse(result.succeeded)
+        self.assertEqual(result.error, u'maxSeries(stats.fake.value): 9.16092 > 9.0')
+
+        self.graphite_check.expected_num_hosts = 3
+        self.graphite_check.value = '10.0'
+        self.graphite_check.save()
+        self.graphite_check.run()
+        self.assertEqual(self.graphite_check.last_result().error, u'Hosts missing | 2/3 hosts')
+
+    def test_same_outcome_as_fetching_every_series(self):
+        for check_type, value in [('>', '9.0'), ('>', '10.0'), ('>=', '9.16092'), ('<', '8.15'), ('<=', '8.0')]:
+            self.graphite_check.check_type = check_type
+            self.graphite_check.value = value
+            self.graphite_check.aggregate_in_graphite = False
+            with patch('cabot.cabotapp.graphite.requests.get', fake_graphite_response):
+                expected = self.graphite_check._run()
+            self.graphite_check.aggregate_in_graphite = True
+            aggregated = aggregated_response(self.series, self.graphite_check.aggregate())
+            with patch('cabot.cabotapp.graphite.requests.get') as mock_get:
+                mock_get.return_value.json.return_value = aggregated
+                result = self.graphite_check._run()
+            self.assertEqual(result.succeeded, expected.succeeded, (check_type, value))
+            self.assertAlmostEqual(result.average_value, expected.average_value)
+
+    @patch('cabot.cabotapp.graphite.requests.post')
+    def test_batched(self, mock_post):
+        self.graphite_check.aggregate_in_graphite = True
+        self.graphite_check.save()
+        tagged = [dict(s, target='__cabot_0__' + s['target'])
+                  for s in aggregated_response(self.series, 'maxSeries')]
+        mock_post.return_value.json.return_value = tagged
+        GraphiteStatusCheck.run_batch([self.graphite_check])
+        render = mock_post.call_args_list[0]
+        self.assertIn('maxSeries(stats.fake.value)', render[1]['data']['target'][0])
+        self.assertEqual(self.graphite_check.last_result().error, u'maxSeries(stats.fake.value): 9.16092 > 9.0')
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import httplib
+import re
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import requests
+from django.test.utils import override_settings
+from rest_framework.reverse import reverse as api_reverse
+from mock import Mock, patch
+from requests.cookies import extract_cookies_to_jar
+
+from cabot.cabotapp import http_checks
+from cabot.cabotapp.http_checks import (InvalidPattern, SessionRegistry, compile_text_match, phase_timings,
+                                        MATCH_OVERLAP, read_body)
+from cabot.cabotapp.models import HttpStatusCheck, Service, StatusCheckResult
+from cabot.cabotapp.tasks import run_status_checks
+from cabot.cabotapp.utils import LRUCache
+from cabot.cabotapp.views import HttpStatusCheckForm
+
+from .tests_basic import LocalTestCase, fake_http_200_response, fake_http_404_response, fake_http_response
+
+
+class TestHttpCheckBatch(LocalTestCase):
+
+    def setUp(self):
+        super(TestHttpCheckBatch, self).setUp()
+        self.checks = [self.http_check] + [
+            HttpStatusCheck.objects.create(
+                name='HTTP Check %d' % i,
+                endpoint='http://host%d.example.com' % (i % 2),
+                importance=Service.ERROR_STATUS,
+            )
+            for i in range(4)
+        ]
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_run_batch(self):
+        HttpStatusCheck.run_batch(self.checks)
+        for check in self.checks:
+            result = check.last_result()
+            self.assertTrue(result.succeeded)
+            self.assertIsNotNone(result.time_complete)
+            self.assertIsNotNone(HttpStatusCheck.objects.get(id=check.id).last_run)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_404_response)
+    def test_run_batch_truncates_raw_data(self):
+        HttpStatusCheck.run_batch(self.checks)
+        for result in StatusCheckResult.objects.filter(status_check__in=self.checks):
+            self.assertFalse(result.succeeded)
+            self.assertLessEqual(len(result.raw_data), 5000)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_run_status_checks_uses_batch(self):
+        with patch.object(HttpStatusCheck, 'run_batch') as mock_run_batch:
+            run_status_checks([check.id for check in self.checks])
+        batch = mock_run_batch.call_args[0][0]
+        self.assertEqual(sorted(check.id for check in batch), sorted(check.id for check in self.checks))
+
+    @override_settings(HTTP_CHECK_HOST_CONCURRENCY=1)
+    def test_per_host_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        in_flight = {}
+        most_in_flight = {}
+
+        def slow_get(url, *args, **kwargs):
+            with lock:
+                in_flight[url] = in_flight.get(url, 0) + 1
+                most_in_flight[url] = max(most_in_flight.get(url, 0), in_flight[url])
+            time.sleep(0.05)
+            with lock:
+                in_flight[url] -= 1
+            return fake_http_200_response()
+
+        with patch('cabot.cabotapp.models.base.pooled_get', slow_get):
+            HttpStatusCheck.run_batch(self.checks)
+        self.assertEqual(max(most_in_flight.values()), 1)
+        self.assertEqual(len(StatusCheckResult.objects.filter(status_check__in=self.checks)), len(self.checks))
+
+
+class TestSessionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.sessions = SessionRegistry()
+
+    def test_sessions_are_shared_per_host(self):
+        session = self.sessions.get('https://example.com/a')
+        self.assertIs(self.sessions.get('https://EXAMPLE.com/b?c=d'), session)
+        self.assertIsNot(self.sessions.get('http://example.com/a'), session)
+        self.assertIsNot(self.sessions.get('https://other.example.com/a'), session)
+        self.assertIsNot(self.sessions.get('https://example.com/a', verify=False), session)
+        self.assertEqual(len(self.sessions), 4)
+
+    @override_settings(HTTP_POOL_MAXSIZE=3)
+    def test_pool_size(self):
+        adapter = self.sessions.get('https://example.com').get_adapter('https://example.com')
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    @override_settings(HTTP_POOL_IDLE_TIMEOUT=60)
+    def test_idle_sessions_are_closed(self):
+        with patch('cabot.cabotapp.http_checks.time.time', return_value=1000):
+            idle = self.sessions.get('https://idle.example.com')
+            self.sessions.get('https://busy.example.com')
+        with patch('cabot.cabotapp.http_checks.time.time', return_value=1050):
+            self.sessions.get('https://busy.example.com')
+        with patch.object(idle, 'close') as mock_close:
+            with patch('cabot.cabotapp.http_checks.time.time', return_value=1070):
+                self.sessions.get('https://busy.example.com')
+        self.assertTrue(mock_close.called)
+        self.assertEqual(len(self.sessions), 1)
+
+    def test_cookies_are_not_kept_between_checks(self):
+        session = self.sessions.get('https://example.com')
+        request = requests.Request('GET', 'https://example.com/').prepare()
+        raw = Mock(_original_response=Mock(msg=httplib.HTTPMessage(
+            StringIO('Set-Cookie: session=abc; Path=/\r\n\r\n'))))
+        extract_cookies_to_jar(session.cookies, request, raw)
+        self.assertEqual(len(session.cookies), 0)
+
+
+class TestStreamingBody(LocalTestCase):
+
+    def run_check(self, resp, text_match):
+        self.http_check.text_match = text_match
+        self.http_check.save()
+        with patch('cabot.cabotapp.models.base.pooled_get', return_value=resp) as mock_get:
+            self.http_check.run()
+        self.assertTrue(mock_get.call_args[1]['stream'])
+        return self.http_check.last_result()
+
+    def test_stops_reading_once_matched(self):
+        resp = fake_http_response('<h1>Hello</h1>' + 'x' * 100000, 200, chunk_size=6)
+        self.assertTrue(self.run_check(resp, u'Hel+o').succeeded)
+        self.assertEqual(resp.chunks_read, 2)
+        self.assertTrue(resp.close.called)
+
+    def test_matches_across_chunks(self):
+        resp = fake_http_response('abcdefghij', 200, chunk_size=3)
+        text, match, complete = read_body(resp, pattern=re.compile('cdefgh'))
+        self.assertEqual(match.group(0), 'cdefgh')
+        self.assertEqual(resp.chunks_read, 3)
+        self.assertFalse(complete)
+
+    def test_long_matches_are_found_once_reading_stops(self):
+        body = 'x' * 100 + 'start' + 'y' * (MATCH_OVERLAP * 2) + 'end'
+        resp = fake_http_response(body, 200, chunk_size=1000)
+        text, match, complete = read_body(resp, pattern=re.compile('start y+ end'.replace(' ', '')))
+        self.assertEqual(match.start(), 100)
+        self.assertTrue(complete)
+
+    def test_anchors_see_the_whole_text(self):
+        # The window searched with the last chunk starts with 'needle'
+        prefix = 5000 - MATCH_OVERLAP
+        resp = fake_http_response('x' * prefix + 'needle' + 'y' * (5000 - prefix - 6) + 'z' * 1000, 200,
+                                  chunk_size=1000)
+        text, match, complete = read_body(resp, pattern=re.compile('^needle'))
+        self.assertIsNone(match)
+        self.assertTrue(complete)
+
+    def test_multibyte_characters_split_across_chunks(self):
+        resp = fake_http_response(u'как закалялась сталь'.encode('utf-8'), 200, chunk_size=1)
+        self.assertTrue(self.run_check(resp, u'закалялась').succeeded)
+
+    @override_settings(HTTP_CHECK_MAX_BODY_BYTES=1000)
+    def test_gives_up_after_byte_cap(self):
+        resp = fake_http_response('x' * 5000 + 'needle', 200, chunk_size=300)
+        result = self.run_check(resp, u'needle')
+        self.assertFalse(result.succeeded)
+        self.assertIn(u'in first 1000 bytes', result.error)
+        self.assertEqual(len(result.raw_data), 1000)
+        self.assertEqual(resp.chunks_read, 4)
+
+    def test_wrong_code_reads_only_what_is_kept(self):
+        resp = fake_http_response('x' * 100000, 500, chunk_size=1000)
+        result = self.run_check(resp, None)
+        self.assertFalse(result.succeeded)
+        self.assertEqual(resp.chunks_read, 5)
+
+    def test_errors_while_reading_are_request_errors(self):
+        def broken_body(*args, **kwargs):
+            yield 'abc'
+            raise requests.exceptions.ChunkedEncodingError('Connection broken: IncompleteRead')
+        for text_match in [u'needle', None]:
+            resp = fake_http_response('', 200)
+            resp.iter_content = broken_body
+            result = self.run_check(resp, text_match)
+            self.assertFalse(result.succeeded)
+            self.assertEqual(result.error, u'Request error occurred: Connection broken: IncompleteRead')
+            self.assertIsNotNone(result.total_time)
+            self.assertIsNotNone(result.body_time)
+            self.assertTrue(resp.close.called)
+
+    @override_settings(HTTP_CHECK_STREAM_BODY=False)
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_streaming_can_be_disabled(self):
+        self.http_check.text_match = u'blah blah'
+        self.http_check.save()
+        self.http_check.run()
+        self.assertFalse(self.http_check.last_result().succeeded)
+        self.assertIn(u'in response body', self.http_check.last_result().error)
+
+
+class TestTextMatchPatterns(unittest.TestCase):
+
+    def setUp(self):
+        http_checks._patterns.clear()
+        http_checks._engine = None
+
+    def tearDown(self):
+        http_checks._engine = None
+
+    def test_compiled_patterns_are_reused(self):
+        with patch('cabot.cabotapp.http_checks.re.compile', wraps=re.compile) as mock_compile:
+            first = compile_text_match(u'[Aa]rachnys')
+            second = compile_text_match(u'[Aa]rachnys')
+            compile_text_match(u'[Aa]rachnys', re.IGNORECASE)
+        self.assertIs(first, second)
+        self.assertEqual(mock_compile.call_count, 2)
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(InvalidPattern):
+            compile_text_match(u'unclosed (group')
+
+    @override_settings(HTTP_CHECK_REGEX_ENGINE='re2')
+    def test_re2_engine(self):
+        fake_re2 = Mock(__name__='re2')
+        with patch('cabot.cabotapp.http_checks.re2', fake_re2):
+            self.assertIs(compile_text_match(u'abc'), fake_re2.compile.return_value)
+
+    @override_settings(HTTP_CHECK_REGEX_ENGINE='re2')
+    def test_missing_re2_falls_back_to_re_with_one_warning(self):
+        with patch('cabot.cabotapp.http_checks.re2', None), \
+                patch('cabot.cabotapp.http_checks.logger') as mock_logger:
+            self.assertTrue(compile_text_match(u'abc').search(u'xabcx'))
+            self.assertTrue(compile_text_match(u'abc').search(u'xabcx'))
+            compile_text_match(u'def')
+        self.assertEqual(mock_logger.warning.call_count, 1)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 2)
+
+
+class TestHttpStatusCheckForm(LocalTestCase):
+
+    def form(self, text_match):
+        return HttpStatusCheckForm(data={
+            'name': 'Check',
+            'endpoint': 'http://example.com',
+            'text_match': text_match,
+            'status_code': '200',
+            'timeout': 10,
+            'frequency': 5,
+            'importance': Service.ERROR_STATUS,
+            'debounce': 0,
+        })
+
+    def test_valid_text_match(self):
+        self.assertTrue(self.form(u'[Aa]rachnys\\s+[Rr]ules').is_valid())
+
+    def test_invalid_text_match(self):
+        form = self.form(u'unclosed (group')
+        self.assertFalse(form.is_valid())
+        self.assertIn('Invalid regular expression', form.errors['text_match'][0])
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write('hello')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPhaseTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.sessions = SessionRegistry()
+
+    def tearDown(self):
+        self.sessions.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_timings_are_recorded_per_request(self):
+        url = 'http://127.0.0.1:%d/' % self.server.server_port
+        session = self.sessions.get(url)
+        first = phase_timings(session.get(url))
+        self.assertEqual(sorted(first.keys()), ['connect', 'dns', 'tls', 'ttfb'])
+        self.assertGreaterEqual(first['dns'], 0)
+        self.assertGreaterEqual(first['ttfb'], 0)
+        self.assertIsNone(first['tls'])
+        # The connection is reused, so there's nothing to resolve or connect
+        second = phase_timings(session.get(url))
+        self.assertEqual((second['dns'], second['connect']), (0, 0))
+
+
+class TestHttpCheckTimings(LocalTestCase):
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_timings_are_stored_on_result(self):
+        self.http_check.run()
+        result = self.http_check.last_result()
+        self.assertEqual(result.phase_timings[:4], [2, 10, 30, 100])
+        self.assertIsNotNone(result.body_time)
+        self.assertIsNotNone(result.total_time)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_ttfb_threshold(self):
+        self.http_check.max_ttfb = 500
+        self.http_check.save()
+        self.http_check.run()
+        self.assertTrue(self.http_check.last_result().succeeded)
+        self.http_check.max_ttfb = 50
+        self.http_check.save()
+        self.http_check.run()
+        self.assertFalse(self.http_check.last_result().succeeded)
+        self.assertIn(u'first byte after 100ms (limit 50ms)', self.http_check.last_result().error)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_total_time_threshold(self):
+        self.http_check.max_total_time = 1000
+        self.http_check.save()
+        with patch('cabot.cabotapp.models.base.default_timer', side_effect=[10.0, 10.5, 12.0]):
+            self.http_check.run()
+        result = self.http_check.last_result()
+        self.assertFalse(result.succeeded)
+        self.assertEqual((result.body_time, result.total_time), (1500, 2000))
+        self.assertIn(u'took 2000ms (limit 1000ms)', result.error)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_results_api(self):
+        self.http_check.run()
+        self.client.login(username=self.username, password=self.password)
+        response = self.client.get(api_reverse('statuscheckresult-list'), {'status_check': self.http_check.id},
+                                   format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['ttfb'], 100)
@@ -1,15 +1,48 @@
+import socket
 import subprocess
+import threading
+import unittest
 
+from django.test.utils import override_settings
 from mock import patch
 
+from cabot.cabotapp import icmp
 from cabot.cabotapp.models import (
     ICMPStatusCheck,
     Instance,
     Service,
+    StatusCheckResult,
 )
 
 from .tests_basic import LocalTestCase
 
+PING_OUTPUT = """PING 1.2.3.4 (1.2.3.4) 56(84) bytes of data.
+64 bytes from 1.2.3.4: icmp_seq=1 ttl=64 time=0.045 ms
+
+--- 1.2.3.4 ping statistics ---
+1 packets transmitted, 1 received, 0% packet loss, time 0ms
+rtt min/avg/max/mdev = 0.045/0.045/0.045/0.000 ms
+"""
+
+PING_OUTPUT_LOSSY = """PING 1.2.3.4 (1.2.3.4) 56(84) bytes of data.
+64 bytes from 1.2.3.4: icmp_seq=1 ttl=64 time=10.0 ms
+64 bytes from 1.2.3.4: icmp_seq=3 ttl=64 time=30.0 ms
+
+--- 1.2.3.4 ping statistics ---
+4 packets transmitted, 2 received, 50% packet loss, time 3004ms
+rtt min/avg/max/mdev = 10.000/20.000/30.000/10.000 ms
+"""
+
+
+def fake_probe(address, sent, received, error=None):
+    probe = icmp.ProbeResult(address)
+    probe.sent = sent
+    probe.rtts = [0.001 * (i + 1) for i in range(received)]
+    probe.error = error
+    return probe
+
+
+@override_settings(ICMP_NATIVE_PROBER=False)
 class TestICMPCheckRun(LocalTestCase):
 
     def setUp(self):
@@ -28,6 +61,7 @@ class TestICMPCheckRun(LocalTestCase):
 
         self.patch = patch('cabot.cabotapp.models.subprocess.check_output', autospec=True)
         self.mock_check_output = self.patch.start()
+        self.mock_check_output.return_value = PING_OUTPUT
 
     def tearDown(self):
         self.patch.stop()
@@ -63,3 +97,175 @@ class TestICMPCheckRun(LocalTestCase):
         checkresults = self.icmp_check.statuscheckresult_set.all()
         self.assertEqual(len(checkresults), 1)
         self.assertFalse(self.icmp_check.last_result().succeeded)
+
+    def test_icmp_run_records_rtt(self):
+        self.icmp_check.run()
+        result = self.icmp_check.last_result()
+        self.assertEqual((result.rtt_min, result.rtt_avg, result.rtt_max, result.rtt_stddev), (0.045, 0.045, 0.045, 0))
+        self.assertEqual(result.packet_loss, 0)
+
+    def test_icmp_run_packet_loss(self):
+        self.mock_check_output.return_value = PING_OUTPUT_LOSSY
+        self.icmp_check.packet_count = 4
+        self.icmp_check.packet_interval = 0.5
+        self.icmp_check.max_packet_loss = 50
+        self.icmp_check.save()
+        self.icmp_check.run()
+        self.mock_check_output.assert_called_once_with(
+            ['ping', '-c', '4', '-i', '0.5', u'1.2.3.4'], shell=False, stderr=-2)
+        self.assertTrue(self.icmp_check.last_result().succeeded)
+        self.assertEqual(self.icmp_check.last_result().packet_loss, 50)
+
+        self.icmp_check.max_packet_loss = 25
+        self.icmp_check.save()
+        self.icmp_check.run()
+        self.assertFalse(self.icmp_check.last_result().succeeded)
+        self.assertIn(u'50% packet loss to 1.2.3.4 (limit 25%)', self.icmp_check.last_result().error)
+
+    def test_icmp_run_rtt_threshold(self):
+        self.mock_check_output.return_value = PING_OUTPUT_LOSSY
+        self.icmp_check.max_packet_loss = 100
+        self.icmp_check.max_rtt = 15
+        self.icmp_check.save()
+        self.icmp_check.run()
+        self.assertFalse(self.icmp_check.last_result().succeeded)
+        self.assertIn(u'Average round trip time to 1.2.3.4 20.0ms (limit 15ms)', self.icmp_check.last_result().error)
+
+    def test_recent_latency(self):
+        self.icmp_check.run()
+        latency = self.instance.recent_latency
+        self.assertEqual(len(latency), 1)
+        self.assertEqual(latency[0]['rtt_avg'], 0.045)
+        self.assertIn('time', latency[0])
+
+
+class TestICMPBatch(LocalTestCase):
+
+    def setUp(self):
+        super(TestICMPBatch, self).setUp()
+        self.checks = []
+        for i in range(3):
+            instance = Instance.objects.create(name='Instance %d' % i, address='10.0.0.%d' % i)
+            check = ICMPStatusCheck.objects.create(name='ICMP Check %d' % i, importance=Service.ERROR_STATUS)
+            instance.status_checks.add(check)
+            self.checks.append(check)
+        self.orphan = ICMPStatusCheck.objects.create(name='No instance')
+
+        self.available_patch = patch('cabot.cabotapp.icmp.is_available', return_value=True)
+        self.available_patch.start()
+        self.ping_patch = patch('cabot.cabotapp.icmp.ping', side_effect=lambda targets, **kwargs: dict(
+            (target, fake_probe(target, 1, 0 if target == '10.0.0.1' else 1)) for target in targets))
+        self.mock_ping = self.ping_patch.start()
+
+    def tearDown(self):
+        self.ping_patch.stop()
+        self.available_patch.stop()
+        super(TestICMPBatch, self).tearDown()
+
+    @patch('cabot.cabotapp.models.subprocess.check_output')
+    def test_batch_pings_all_targets_at_once(self, mock_check_output):
+        ICMPStatusCheck.run_batch(self.checks + [self.orphan])
+        self.assertFalse(mock_check_output.called)
+        self.assertEqual(self.mock_ping.call_count, 1)
+        self.assertEqual(sorted(self.mock_ping.call_args[0][0]), ['10.0.0.0', '10.0.0.1', '10.0.0.2'])
+        self.assertEqual([check.last_result().succeeded for check in self.checks], [True, False, True])
+        self.assertIn(u'No reply from 10.0.0.1', self.checks[1].last_result().error)
+        self.assertIn(u'exactly one instance', self.orphan.last_result().error)
+        self.assertIsNotNone(ICMPStatusCheck.objects.get(id=self.checks[0].id).last_run)
+
+    def test_batch_groups_by_packet_settings(self):
+        self.checks[2].packet_count = 3
+        self.checks[2].save()
+        ICMPStatusCheck.run_batch(self.checks)
+        calls = sorted((call[1]['count'], sorted(call[0][0])) for call in self.mock_ping.call_args_list)
+        self.assertEqual(calls, [(1, ['10.0.0.0', '10.0.0.1']), (3, ['10.0.0.2'])])
+
+    def test_groups_are_pinged_at_the_same_time(self):
+        self.checks[2].packet_count = 3
+        self.checks[2].save()
+        both = threading.Event()
+        started = []
+
+        def ping(targets, **kwargs):
+            started.append(targets)
+            if len(started) == 2:
+                both.set()
+            # Each group waits for the other to start
+            self.assertTrue(both.wait(5))
+            return dict((target, fake_probe(target, 1, 1)) for target in targets)
+        self.mock_ping.side_effect = ping
+        ICMPStatusCheck.run_batch(self.checks)
+        self.assertEqual(len(started), 2)
+        self.assertEqual([check.last_result().succeeded for check in self.checks], [True, True, True])
+
+    def test_rtt_stats_from_probe(self):
+        probe = fake_probe('10.0.0.0', 4, 3)
+        result = self.checks[0]._result_from_probe(probe)
+        self.assertEqual(result.packet_loss, 25)
+        self.assertAlmostEqual(result.rtt_min, 1)
+        self.assertAlmostEqual(result.rtt_avg, 2)
+        self.assertAlmostEqual(result.rtt_max, 3)
+        self.assertAlmostEqual(result.rtt_stddev, (2 / 3.0) ** 0.5)
+        self.assertFalse(result.succeeded)
+
+    def test_single_run_uses_prober(self):
+        self.checks[1].run()
+        self.assertFalse(self.checks[1].last_result().succeeded)
+        self.mock_ping.assert_called_once_with(['10.0.0.1'], count=1, interval=1.0, timeout=5)
+
+    @patch('cabot.cabotapp.models.subprocess.check_output', return_value=PING_OUTPUT)
+    def test_falls_back_to_ping_command(self, mock_check_output):
+        with patch('cabot.cabotapp.icmp.is_available', return_value=False):
+            ICMPStatusCheck.run_batch(self.checks)
+        self.assertFalse(self.mock_ping.called)
+        self.assertEqual(mock_check_output.call_count, 3)
+        self.assertEqual(StatusCheckResult.objects.filter(status_check__in=self.checks, succeeded=True).count(), 3)
+
+    @patch('cabot.cabotapp.models.subprocess.check_output', return_value=PING_OUTPUT)
+    def test_falls_back_to_ping_command_when_prober_fails(self, mock_check_output):
+        self.mock_ping.side_effect = socket.error(1, 'Operation not permitted')
+        ICMPStatusCheck.run_batch(self.checks)
+        self.assertEqual(mock_check_output.call_count, 3)
+        self.assertEqual(StatusCheckResult.objects.filter(status_check__in=self.checks, succeeded=True).count(), 3)
+
+
+class TestICMPProber(unittest.TestCase):
+
+    def test_echo_request_checksum(self):
+        packet = icmp.echo_request(0x1234, 1)
+        self.assertEqual(icmp.checksum(packet), 0)
+
+    def test_unknown_host(self):
+        with patch('cabot.cabotapp.icmp._ping_addresses') as mock_ping_addresses:
+            with patch('cabot.cabotapp.icmp.socket.getaddrinfo', side_effect=socket.gaierror('nope')):
+                results = icmp.ping(['no.such.host'])
+        self.assertFalse(mock_ping_addresses.called)
+        self.assertIn(u'unknown host no.such.host', results['no.such.host'].error)
+
+    def test_targets_are_resolved_concurrently(self):
+        lock = threading.Lock()
+        started = []
+        all_started = threading.Event()
+        overlapped = []
+
+        def getaddrinfo(target, *args):
+            with lock:
+                started.append(target)
+                if len(started) == 3:
+                    all_started.set()
+            overlapped.append(all_started.wait(5))
+            if target == 'bad':
+                raise socket.gaierror('nope')
+            return [(socket.AF_INET, 0, 0, '', ('10.0.0.%s' % target, 0))]
+
+        with patch('cabot.cabotapp.icmp.socket.getaddrinfo', side_effect=getaddrinfo):
+            addresses, errors = icmp.resolve(['1', '2', 'bad'])
+        self.assertEqual(overlapped, [True] * 3)
+        self.assertEqual(addresses, {'1': '10.0.0.1', '2': '10.0.0.2'})
+        self.assertEqual(list(errors), ['bad'])
+
+    @unittest.skipUnless(icmp.is_available(), 'unprivileged ICMP sockets are not allowed here')
+    def test_ping_localhost(self):
+        results = icmp.ping(['127.0.0.1', 'localhost'], count=2, interval=0.01, timeout=1)
+        self.assertIs(results['127.0.0.1'], results['localhost'])
+        self.assertEqual((results['127.0.0.1'].sent, results['127.0.0.1'].received), (2, 2))
@@ -5,16 +5,22 @@ from datetime import timedelta
 
 import jenkins
 from cabot.cabotapp import jenkins as cabot_jenkins
-from cabot.cabotapp.models import JenkinsConfig
+from cabot.cabotapp import metrics
+from cabot.cabotapp.models import JenkinsConfig, Service
 from cabot.cabotapp.models.jenkins_check_plugin import JenkinsStatusCheck
+from django.core.cache import cache
 from django.utils import timezone
 from freezegun import freeze_time
 from mock import create_autospec, patch
 
+from .tests_basic import LocalTestCase, fake_jenkins_response
+
 
 class TestGetStatus(unittest.TestCase):
 
     def setUp(self):
+        cache.clear()
+        cabot_jenkins.jobs_cache.clear()
         self.job = {
             u'inQueue': False,
             u'queueItem': None,
@@ -192,3 +198,109 @@ class TestGetStatus(unittest.TestCase):
             'status_code': 200
         }
         self.assertEqual(status, expected)
+
+    @patch("cabot.cabotapp.jenkins._get_jenkins_client")
+    def test_all_job_statuses(self, mock_jenkins):
+        mock_jenkins.return_value = self.mock_client
+        self.job[u'name'] = u'foo'
+        self.job[u'lastCompletedBuild'] = {u'number': 12, u'result': u'FAILURE'}
+        self.job[u'lastSuccessfulBuild'] = {u'number': 10}
+        self.mock_client.get_info.return_value = {u'jobs': [self.job, {
+            u'name': u'unbuilt',
+            u'inQueue': False,
+            u'queueItem': None,
+            u'lastSuccessfulBuild': None,
+            u'lastCompletedBuild': None,
+            u'lastBuild': None,
+            u'color': u'notbuilt',
+        }]}
+
+        statuses = cabot_jenkins.get_job_statuses(self.mock_config)
+
+        self.assertIn('lastCompletedBuild[number,result]', self.mock_client.get_info.call_args[1]['query'])
+        self.assertFalse(self.mock_client.get_job_info.called)
+        self.assertFalse(self.mock_client.get_build_info.called)
+        self.assertEqual(statuses['foo'], {
+            'active': True,
+            'succeeded': False,
+            'job_number': 12,
+            'blocked_build_time': None,
+            'consecutive_failures': 2,
+            'status_code': 200
+        })
+        self.assertIsInstance(statuses['unbuilt'], Exception)
+
+    @patch("cabot.cabotapp.jenkins._get_jenkins_client")
+    def test_jobs_are_listed_once_per_cycle(self, mock_jenkins):
+        mock_jenkins.return_value = self.mock_client
+        self.job[u'name'] = u'foo'
+        self.job[u'lastCompletedBuild'] = {u'number': 12, u'result': u'SUCCESS'}
+        self.mock_client.get_info.return_value = {u'jobs': [self.job]}
+        with freeze_time('2017-03-02 10:30:00'):
+            cabot_jenkins.get_job_statuses(self.mock_config)
+        with freeze_time('2017-03-02 10:30:29'):
+            statuses = cabot_jenkins.get_job_statuses(self.mock_config)
+        self.assertEqual(self.mock_client.get_info.call_count, 1)
+        self.assertEqual(statuses['foo']['job_number'], 12)
+        with freeze_time('2017-03-02 10:30:31'):
+            cabot_jenkins.get_job_statuses(self.mock_config)
+        self.assertEqual(self.mock_client.get_info.call_count, 2)
+
+    @patch("cabot.cabotapp.jenkins._get_jenkins_client")
+    def test_completed_builds_are_only_fetched_once(self, mock_jenkins):
+        mock_jenkins.return_value = self.mock_client
+        self.mock_config.jenkins_api = 'http://jenkins.example.com'
+        first = cabot_jenkins.get_job_status(self.mock_config, 'foo')
+        self.assertEqual(cabot_jenkins.get_job_status(self.mock_config, 'foo'), first)
+        self.assertEqual(self.mock_client.get_build_info.call_count, 1)
+        self.assertEqual(metrics.get('jenkins.build_cache.hits'), 1)
+
+        # Another job, or a new build of this one, is fetched
+        cabot_jenkins.get_job_status(self.mock_config, 'bar')
+        self.assertEqual(self.mock_client.get_build_info.call_count, 2)
+        self.job[u'lastCompletedBuild'] = {u'number': 13}
+        self.build.update({u'number': 13, u'result': u'FAILURE'})
+        status = cabot_jenkins.get_job_status(self.mock_config, 'foo')
+        self.assertEqual(self.mock_client.get_build_info.call_args[0], ('foo', 13))
+        self.assertFalse(status['succeeded'])
+        self.assertEqual(status['consecutive_failures'], 1)
+
+
+class TestJenkinsBatch(LocalTestCase):
+
+    def setUp(self):
+        super(TestJenkinsBatch, self).setUp()
+        config = self.jenkins_check.jenkins_config
+        self.checks = [self.jenkins_check] + [
+            JenkinsStatusCheck.objects.create(
+                name=name,
+                importance=Service.ERROR_STATUS,
+                jenkins_config=config,
+            )
+            for name in ['Passing Job', 'Unbuilt Job', 'folder/Job']
+        ]
+
+    @patch('cabot.cabotapp.models.jenkins_check_plugin.get_job_status', return_value=fake_jenkins_response())
+    @patch('cabot.cabotapp.models.jenkins_check_plugin.get_job_statuses')
+    def test_one_request_per_jenkins(self, mock_get_job_statuses, mock_get_job_status):
+        mock_get_job_statuses.return_value = {
+            'Jenkins Check': fake_jenkins_response(),
+            'Passing Job': dict(fake_jenkins_response(), succeeded=True),
+            'Unbuilt Job': Exception('job has no build'),
+        }
+        JenkinsStatusCheck.run_batch(self.checks)
+
+        self.assertEqual(mock_get_job_statuses.call_count, 1)
+        # Jobs in folders aren't in the list of top level jobs
+        self.assertEqual([call[0][1] for call in mock_get_job_status.call_args_list], ['folder/Job'])
+        results = [check.last_result() for check in self.checks]
+        self.assertEqual([r.succeeded for r in results], [False, True, True, False])
+        self.assertEqual(results[2].error, u'Error fetching from Jenkins - job has no build')
+        self.assertEqual(results[0].job_number, 176)
+
+    @patch('cabot.cabotapp.models.jenkins_check_plugin.get_job_status', return_value=fake_jenkins_response())
+    @patch('cabot.cabotapp.models.jenkins_check_plugin.get_job_statuses', side_effect=jenkins.JenkinsException('boom'))
+    def test_falls_back_to_one_request_per_job(self, mock_get_job_statuses, mock_get_job_status):
+        JenkinsStatusCheck.run_batch(self.checks)
+        self.assertEqual(mock_get_job_status.call_count, len(self.checks))
+        self.assertEqual([check.last_result().succeeded for check in self.checks], [False] * 4)
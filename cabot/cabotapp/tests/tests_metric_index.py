@@ -0,0 +1,200 @@
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from fnmatch import fnmatchcase
+
+from django.test.utils import override_settings
+from mock import patch
+
+from cabot.cabotapp import metric_index, tasks
+from cabot.cabotapp.graphite import get_all_metrics, get_matching_metrics
+from cabot.cabotapp.metric_index import MetricIndex, crawl, expand_braces, refresh
+
+from .tests_basic import LocalTestCase
+
+LEAVES = [
+    'carbon.agents.a.cpuUsage',
+    'carbon.agents.a.memUsage',
+    'servers.db1.cpu.total',
+    'servers.web1.cpu.total',
+    'servers.web1.cpu.user',
+    'servers.web1.load',
+    'servers.web1-old.load',
+    'servers.web2.cpu.total',
+    'stats.counter',
+    'stats.counter.rate',
+    'uptime',
+]
+
+
+def index_of(leaves, crawled_at=0):
+    return MetricIndex({'all.': {'crawled_at': crawled_at, 'paths': leaves}})
+
+
+def brute_force_find(leaves, query):
+    """metrics/find's completer format, the slow way"""
+    nodes = set()
+    for pattern in expand_braces(metric_index.completer_query(query)):
+        parts = pattern.split('.')
+        for leaf in leaves:
+            components = leaf.split('.')
+            if len(components) >= len(parts) and all(
+                    fnmatchcase(c, p) for c, p in zip(components, parts)):
+                nodes.add(('.'.join(components[:len(parts)]), len(components) == len(parts)))
+    return sorted(nodes)
+
+
+def found(result):
+    return sorted((m['path'].rstrip('.'), m['is_leaf'] == '1') for m in result['metrics'])
+
+
+class FakeGraphite(object):
+    """Answers metrics/find for a fixed set of leaves, counting the requests made"""
+
+    def __init__(self, leaves, delay=0):
+        self.index = index_of(leaves)
+        self.delay = delay
+        self.queries = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, query):
+        with self._lock:
+            self.queries.append(query)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            if query in self.fail:
+                raise IOError('find failed for %s' % query)
+            return self.index.find(query)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class TestMetricIndexFind(unittest.TestCase):
+
+    def setUp(self):
+        self.index = index_of(LEAVES)
+
+    def test_top_level(self):
+        self.assertEqual(self.index.find(''), {'metrics': [
+            {'path': 'carbon.', 'name': 'carbon', 'is_leaf': '0'},
+            {'path': 'servers.', 'name': 'servers', 'is_leaf': '0'},
+            {'path': 'stats.', 'name': 'stats', 'is_leaf': '0'},
+            {'path': 'uptime', 'name': 'uptime', 'is_leaf': '1'},
+        ]})
+
+    def test_queries(self):
+        self.assertEqual(found(self.index.find('servers.web')),
+                         [('servers.web1', False), ('servers.web1-old', False), ('servers.web2', False)])
+        self.assertEqual(found(self.index.find('servers.*.cpu.t?tal')),
+                         [('servers.db1.cpu.total', True), ('servers.web1.cpu.total', True),
+                          ('servers.web2.cpu.total', True)])
+        self.assertEqual(found(self.index.find('servers.{db1,web2}.')),
+                         [('servers.db1.cpu', False), ('servers.web2.cpu', False)])
+        self.assertEqual(found(self.index.find('servers.web1-*')), [('servers.web1-old', False)])
+        # A node can be both a metric and a branch
+        self.assertEqual(found(self.index.find('stats.counter')),
+                         [('stats.counter', False), ('stats.counter', True)])
+        self.assertEqual(found(self.index.find('nothing.here')), [])
+
+    def test_same_as_brute_force(self):
+        leaves = ['.'.join(parts) for parts in itertools.product(
+            ['a', 'ab', 'a-b', 'b'], ['x', 'x-', 'x1', 'y'], ['m', 'n.o', 'n-.o', 'n.p', 'o'])]
+        index = index_of(leaves)
+        for query in ['', 'a', 'a.', 'a*.x', '*.x1.', '*.x.', '*.x-.n', '*.*.n.', '*.*.n.o', '*.{x,y}.n.o',
+                      'a-b.?.', '[ab].y.m', 'b.y.n.q', '*.*.m', '*.*.o', '*.y*.n-']:
+            self.assertEqual(found(index.find(query)), brute_force_find(leaves, query), query)
+
+
+class TestMetricIndexCrawl(unittest.TestCase):
+
+    def test_crawl_finds_every_leaf(self):
+        graphite = FakeGraphite(LEAVES, delay=0.01)
+        leaves = crawl(graphite, [''], max_workers=3)
+        self.assertEqual(sorted(leaves['']), sorted(LEAVES))
+        self.assertLessEqual(graphite.max_in_flight, 3)
+        self.assertGreater(graphite.max_in_flight, 1)
+
+    def test_failures_only_lose_their_root(self):
+        graphite = FakeGraphite(LEAVES)
+        graphite.fail.add('servers.web1.')
+        leaves = crawl(graphite, ['carbon.', 'servers.'], max_workers=2)
+        self.assertEqual(leaves.keys(), ['carbon.'])
+
+    def test_get_all_metrics(self):
+        with patch('cabot.cabotapp.graphite.find_metrics', FakeGraphite(LEAVES)):
+            self.assertEqual(sorted(get_all_metrics()), sorted(LEAVES))
+
+    def test_refresh_only_recrawls_stale_branches(self):
+        graphite = FakeGraphite(LEAVES)
+        index = refresh(None, graphite, max_age=3600, max_workers=2, now=1000)
+        self.assertEqual(index.paths, sorted(LEAVES))
+
+        # Nothing is stale, so only the top level is looked at
+        graphite.queries = []
+        graphite.index = index_of(LEAVES + ['servers.web3.load', 'newtop.metric'])
+        index = refresh(index, graphite, max_age=3600, max_workers=2, now=2000)
+        self.assertEqual(graphite.queries, ['', 'newtop.'])
+        self.assertIn('newtop.metric', index.paths)
+        self.assertNotIn('servers.web3.load', index.paths)
+
+        # Once stale, branches are crawled again, but keep what they had if that fails
+        graphite.fail.add('carbon.')
+        index = refresh(index, graphite, max_age=3600, max_workers=2, now=5000)
+        self.assertIn('servers.web3.load', index.paths)
+        self.assertIn('carbon.agents.a.cpuUsage', index.paths)
+        self.assertEqual(index.branches['carbon.']['crawled_at'], 1000)
+        self.assertEqual(index.branches['servers.']['crawled_at'], 5000)
+
+        # Branches gone from Graphite are dropped
+        graphite.index = index_of([leaf for leaf in LEAVES if not leaf.startswith('stats.')])
+        index = refresh(index, graphite, max_age=3600, max_workers=2, now=5001)
+        self.assertNotIn('stats.', index.branches)
+
+
+class TestLocalMetricIndex(LocalTestCase):
+
+    def setUp(self):
+        super(TestLocalMetricIndex, self).setUp()
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.path = os.path.join(tmp, 'index.json')
+        override = override_settings(GRAPHITE_METRIC_INDEX_PATH=self.path)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    @patch('cabot.cabotapp.graphite.requests.get')
+    def test_asks_graphite_until_the_index_is_built(self, mock_get):
+        mock_get.return_value.json.return_value = {'metrics': []}
+        get_matching_metrics('servers.')
+        self.assertEqual(mock_get.call_args[1]['params']['query'], 'servers.')
+
+    @patch('cabot.cabotapp.graphite.requests.get')
+    def test_answers_from_saved_index(self, mock_get):
+        index_of(LEAVES).save(self.path)
+        self.assertEqual(found(get_matching_metrics('servers.web2.')), [('servers.web2.cpu', False)])
+        self.assertFalse(mock_get.called)
+
+        # Changes to the file are picked up
+        index_of(['servers.web2.disk']).save(self.path)
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(found(get_matching_metrics('servers.web2.')), [('servers.web2.disk', True)])
+
+    def test_task_saves_index(self):
+        with patch('cabot.cabotapp.graphite.find_metrics', FakeGraphite(LEAVES)):
+            tasks.update_metric_index()
+        self.assertEqual(MetricIndex.load(self.path).paths, sorted(LEAVES))
+
+    def test_unreadable_index_is_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"branches": ')
+        self.assertIsNone(metric_index.current())
@@ -0,0 +1,94 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.test.utils import override_settings
+from django.utils import timezone
+from freezegun import freeze_time
+
+from cabot.cabotapp.models import Shift, UserProfile, get_duty_officers
+from cabot.cabotapp.rota import ShiftIndex
+
+from .tests_basic import LocalTestCase
+
+T0 = datetime(2016, 12, 1, 12, 0)
+
+
+def hours(n):
+    return T0 + timedelta(hours=n)
+
+
+class TestShiftIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ShiftIndex([(hours(0), hours(4), 'a'), (hours(2), hours(6), 'b'), (hours(6), hours(8), 'c')])
+
+    def test_lookups(self):
+        self.assertEqual(self.index.at(hours(-1)), ([], None, hours(0)))
+        self.assertEqual(self.index.at(hours(1)), (['a'], hours(0), hours(2)))
+        self.assertEqual(self.index.at(hours(3)), (['a', 'b'], hours(2), hours(4)))
+        self.assertEqual(self.index.at(hours(7)), (['c'], hours(6), hours(8)))
+        self.assertEqual(self.index.at(hours(9)), ([], hours(8), None))
+
+    def test_boundaries_are_covered_by_shifts_running_across_them(self):
+        self.assertEqual(self.index.at(hours(2))[0], ['a'])
+        self.assertEqual(self.index.at(hours(4))[0], ['b'])
+        self.assertEqual(self.index.at(hours(6))[0], [])
+        self.assertEqual(self.index.at(hours(0))[0], [])
+
+    def test_same_as_scanning_shifts(self):
+        rng = random.Random(4)
+        shifts = []
+        for n in range(200):
+            start = rng.randint(0, 100)
+            shifts.append((hours(start), hours(start + rng.randint(1, 10)), n))
+        index = ShiftIndex(shifts)
+        for half_hours in range(-2, 230):
+            t = T0 + timedelta(minutes=30 * half_hours)
+            self.assertEqual(index.at(t)[0], [user for start, end, user in shifts if start < t < end])
+
+
+@freeze_time('2016-12-01 12:00')
+class TestDutyOfficers(LocalTestCase):
+
+    def setUp(self):
+        super(TestDutyOfficers, self).setUp()
+        self.foo = User.objects.create(username='foo')
+        self.bar = User.objects.create(username='bar')
+        now = timezone.now()
+        Shift.objects.create(start=now - timedelta(hours=1), end=now + timedelta(hours=1), user=self.foo,
+                             uid='foo', last_modified=now)
+        Shift.objects.create(start=now + timedelta(hours=1), end=now + timedelta(hours=3), user=self.bar,
+                             uid='bar', last_modified=now)
+
+    @override_settings(DUTY_OFFICER_CACHE_MAX_AGE=86400)
+    def test_answered_from_memory(self):
+        self.assertEqual(get_duty_officers(), [self.foo])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_duty_officers(), [self.foo])
+            self.assertEqual(get_duty_officers(timezone.now() + timedelta(hours=2)), [self.bar])
+            self.assertEqual(get_duty_officers(timezone.now() + timedelta(hours=4)), [])
+            # The current answer expires when the next shift starts
+            with freeze_time(timezone.now() + timedelta(hours=1, minutes=1)):
+                self.assertEqual(get_duty_officers(), [self.bar])
+
+    def test_changes_to_the_rota_are_picked_up(self):
+        get_duty_officers()
+        Shift.objects.filter(user=self.foo).update(deleted=True)
+        profile = UserProfile.objects.get(user=self.bar)
+        profile.fallback_alert_user = True
+        profile.save()
+        self.assertEqual(get_duty_officers(), [self.bar])
+
+    @override_settings(DUTY_OFFICER_CACHE_MAX_AGE=30)
+    def test_reloaded_after_max_age(self):
+        get_duty_officers()
+        Shift.objects.filter(user=self.foo).update(deleted=True)
+        self.assertEqual(get_duty_officers(), [self.foo])
+        with freeze_time(timezone.now() + timedelta(seconds=30)):
+            self.assertEqual(get_duty_officers(), [])
+
+    def test_earlier_times_are_looked_up(self):
+        get_duty_officers()
+        self.assertEqual(get_duty_officers(timezone.now() - timedelta(minutes=30)), [self.foo])
@@ -0,0 +1,274 @@
+import unittest
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test.utils import override_settings
+from django.utils import timezone
+from freezegun import freeze_time
+from mock import patch
+
+from cabot.cabotapp import metrics, scheduling, tasks
+from cabot.cabotapp.scheduling import SCHEDULE_WINDOW
+from cabot.cabotapp.models import GraphiteStatusCheck, HttpStatusCheck, StatusCheck
+
+from .tests_basic import LocalTestCase, fake_http_200_response
+
+
+class TestRunAllChecks(LocalTestCase):
+
+    def scheduled_ids(self, mock_apply_async):
+        return sorted(self.scheduled_countdowns(mock_apply_async).keys())
+
+    def scheduled_countdowns(self, mock_apply_async):
+        countdowns = {}
+        for call in mock_apply_async.call_args_list:
+            for check_id in call[0][0][0]:
+                countdowns[check_id] = call[1]['countdown']
+        return countdowns
+
+    def assertOnSlot(self, check):
+        period = check.frequency * 60
+        since_last_run = (check.next_run_at - check.last_run).total_seconds()
+        self.assertGreaterEqual(since_last_run, period / 2)
+        self.assertLess(since_last_run, period * 1.5)
+        since_epoch = (check.next_run_at - scheduling.EPOCH).total_seconds()
+        self.assertEqual(since_epoch % period, scheduling.check_phase(check.id, period))
+
+    def test_next_run_at_maintained_on_save(self):
+        self.http_check.last_run = timezone.now()
+        self.http_check.save()
+        self.assertOnSlot(self.http_check)
+
+        # Editing the frequency moves the next run
+        self.http_check.frequency = 1
+        self.http_check.save()
+        reloaded = StatusCheck.objects.get(id=self.http_check.id)
+        self.assertOnSlot(reloaded)
+        self.assertLess(reloaded.next_run_at, reloaded.last_run + timedelta(minutes=2))
+
+    def test_slots_are_never_before_earliest(self):
+        period = 60
+        phase = scheduling.check_phase(self.http_check.id, period)
+        earliest = scheduling.EPOCH + timedelta(days=1, seconds=phase, milliseconds=400)
+        self.assertEqual(scheduling.next_slot(self.http_check.id, 1, earliest),
+                         scheduling.EPOCH + timedelta(days=1, seconds=phase + period))
+
+    def test_slow_runs_keep_their_cycle(self):
+        self.http_check.frequency = 1
+        slot = scheduling.next_slot(self.http_check.id, 1, timezone.now())
+        for took, due in [(5, 60), (31, 60), (59, 60), (70, 120)]:
+            self.http_check.next_run_at = slot
+            self.http_check.finish_run(slot + timedelta(seconds=took))
+            self.assertEqual(self.http_check.next_run_at, slot + timedelta(seconds=due), took)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_next_run_at_maintained_on_run(self):
+        self.http_check.run()
+        reloaded = StatusCheck.objects.get(id=self.http_check.id)
+        self.assertOnSlot(reloaded)
+
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_schedules_only_due_active_checks(self, mock_apply_async):
+        # Never run, so due straight away
+        never_run = HttpStatusCheck.objects.create(name='Never run', endpoint='http://example.com')
+        # Ran recently, not due yet
+        self.http_check.last_run = timezone.now()
+        self.http_check.save()
+        # Ran a long time ago, due
+        self.graphite_check.last_run = timezone.now() - timedelta(minutes=10)
+        self.graphite_check.save()
+        # Due but inactive
+        self.jenkins_check.active = False
+        self.jenkins_check.save()
+
+        tasks.run_all_checks()
+
+        self.assertEqual(self.scheduled_ids(mock_apply_async),
+                         sorted([never_run.id, self.graphite_check.id]))
+
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_countdowns_are_stable(self, mock_apply_async):
+        for i in range(20):
+            HttpStatusCheck.objects.create(name='Check %d' % i, endpoint='http://example.com', timeout=5)
+        tasks.run_all_checks()
+        first = self.scheduled_countdowns(mock_apply_async)
+        mock_apply_async.reset_mock()
+        StatusCheck.objects.update(lease_expires_at=None)
+        tasks.run_all_checks()
+        second = self.scheduled_countdowns(mock_apply_async)
+        self.assertEqual(first, second)
+        self.assertTrue(all(0 <= countdown < scheduling.SCHEDULE_WINDOW for countdown in first.values()))
+
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_in_flight_checks_are_not_dispatched_twice(self, mock_apply_async):
+        prevented = metrics.get('scheduler.duplicate_dispatches_prevented')
+        tasks.run_all_checks()
+        first = self.scheduled_ids(mock_apply_async)
+        self.assertIn(self.http_check.id, first)
+        reloaded = StatusCheck.objects.get(id=self.http_check.id)
+        self.assertGreater(reloaded.lease_expires_at, timezone.now())
+
+        # Still due, but leased by the previous tick
+        mock_apply_async.reset_mock()
+        tasks.run_all_checks()
+        self.assertEqual(self.scheduled_ids(mock_apply_async), [])
+        self.assertEqual(metrics.get('scheduler.duplicate_dispatches_prevented'), prevented + len(first))
+
+        # Leases expire eventually
+        mock_apply_async.reset_mock()
+        with freeze_time(timezone.now() + timedelta(seconds=SCHEDULE_WINDOW + settings.CHECK_LEASE_EXPIRY + 1)):
+            tasks.run_all_checks()
+        self.assertEqual(self.scheduled_ids(mock_apply_async), first)
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_run_releases_lease(self):
+        with patch('cabot.cabotapp.tasks.run_status_checks.apply_async'):
+            tasks.run_all_checks()
+        check = StatusCheck.objects.get(id=self.http_check.id)
+        self.assertIsNotNone(check.lease_expires_at)
+        check.run()
+        self.assertIsNone(StatusCheck.objects.get(id=self.http_check.id).lease_expires_at)
+
+    @override_settings(CHECK_BATCH_SIZE=2)
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_checks_are_dispatched_in_chunks(self, mock_apply_async):
+        for i in range(3):
+            HttpStatusCheck.objects.create(name='Check %d' % i, endpoint='http://example.com')
+        with patch('cabot.cabotapp.scheduling.preferred_countdown', return_value=0):
+            tasks.run_all_checks()
+        chunks = [call[0][0][0] for call in mock_apply_async.call_args_list]
+        self.assertTrue(all(len(chunk) <= 2 for chunk in chunks))
+        self.assertEqual(len(self.scheduled_ids(mock_apply_async)), StatusCheck.objects.count())
+
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_graphite_checks_sharing_a_window_are_sent_together(self, mock_apply_async):
+        same_window = [self.graphite_check.id]
+        for i in range(5):
+            same_window.append(GraphiteStatusCheck.objects.create(
+                name='Graphite %d' % i, metric='stats.%d' % i, check_type='>', value='1').id)
+        hourly = GraphiteStatusCheck.objects.create(name='Hourly', metric='stats.hourly', check_type='>', value='1',
+                                                    frequency=60)
+        with freeze_time('2016-12-01 12:00'):
+            for i, check_id in enumerate(same_window + [hourly.id]):
+                StatusCheck.objects.filter(id=check_id).update(next_run_at=timezone.now() + timedelta(seconds=5 * i))
+            # Grouped without loading the checks
+            with self.assertNumQueries(2):
+                tasks.run_all_checks()
+        countdowns = self.scheduled_countdowns(mock_apply_async)
+        batches = [sorted(call[0][0][0]) for call in mock_apply_async.call_args_list]
+        self.assertIn(sorted(same_window), batches)
+        # Sent when the last of them is due
+        self.assertEqual(set(countdowns[check_id] for check_id in same_window), {25})
+        self.assertEqual(countdowns[hourly.id], 30)
+
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_checks_are_routed_by_type_and_importance(self, mock_apply_async):
+        with tasks.run_all_checks.app.connection_or_acquire() as conn:
+            conn.default_channel.queue_declare(queue='checks.http')
+        tasks.run_all_checks()
+        queues = dict((call[0][0][0][0], call[1]['queue']) for call in mock_apply_async.call_args_list)
+        self.assertEqual(queues[self.graphite_check.id], 'checks.graphite')
+        self.assertEqual(queues[self.jenkins_check.id], 'checks.jenkins')
+        # Critical checks get a queue of their own
+        self.assertEqual(queues[self.http_check.id], 'checks.critical')
+        self.assertEqual(metrics.get('queue.checks.http.backlog', None), 0)
+
+    @override_settings(CELERY_ROUTE_CHECKS_BY_TYPE=False)
+    @patch('cabot.cabotapp.tasks.run_status_checks.apply_async')
+    def test_checks_routing_can_be_disabled(self, mock_apply_async):
+        tasks.run_all_checks()
+        queues = set(call[1]['queue'] for call in mock_apply_async.call_args_list)
+        self.assertEqual(queues, set([tasks.run_status_checks.app.conf.task_default_queue]))
+
+    @patch('cabot.cabotapp.models.base.pooled_get', fake_http_200_response)
+    def test_run_status_checks_isolates_failures(self):
+        with patch('cabot.cabotapp.models.GraphiteStatusCheck.run', side_effect=Exception('boom')):
+            tasks.run_status_checks([self.graphite_check.id, self.http_check.id, 12345])
+        self.assertEqual(self.http_check.statuscheckresult_set.count(), 1)
+
+    def test_failed_batches_release_their_leases(self):
+        with patch('cabot.cabotapp.tasks.run_status_checks.apply_async'):
+            tasks.run_all_checks()
+        self.assertIsNotNone(StatusCheck.objects.get(id=self.graphite_check.id).lease_expires_at)
+        with patch('cabot.cabotapp.models.GraphiteStatusCheck.run_batch', side_effect=Exception('boom')):
+            tasks.run_status_checks([self.graphite_check.id])
+        self.assertIsNone(StatusCheck.objects.get(id=self.graphite_check.id).lease_expires_at)
+        self.assertIsNotNone(StatusCheck.objects.get(id=self.http_check.id).lease_expires_at)
+
+
+class TestStatusUpdateCoalescing(LocalTestCase):
+
+    def setUp(self):
+        super(TestStatusUpdateCoalescing, self).setUp()
+        cache.clear()
+        # Updates left pending would hold back other tests' updates
+        self.addCleanup(cache.clear)
+        # Coalescing only happens when updates really are delayed
+        conf = tasks.update_service.app.conf
+        self.addCleanup(setattr, conf, 'task_always_eager', conf.task_always_eager)
+        conf.task_always_eager = False
+
+    @override_settings(STATUS_UPDATE_COALESCE_WINDOW=5)
+    @patch('cabot.cabotapp.tasks.update_service.apply_async')
+    def test_updates_are_coalesced_until_they_are_due(self, mock_apply_async):
+        collapsed = metrics.get('status_updates.service.collapsed')
+        with freeze_time('2016-12-01 12:00:00'):
+            for check in [self.graphite_check, self.jenkins_check, self.http_check]:
+                check.save()
+        mock_apply_async.assert_called_once_with((self.service.id,), countdown=5)
+        self.assertEqual(metrics.get('status_updates.service.collapsed'), collapsed + 2)
+
+        # Once the queued update is due, whichever worker runs it, further
+        # changes need another one
+        with freeze_time('2016-12-01 12:00:05'):
+            self.http_check.save()
+        self.assertEqual(mock_apply_async.call_count, 2)
+
+    @override_settings(STATUS_UPDATE_COALESCE_WINDOW=0)
+    @patch('cabot.cabotapp.tasks.update_service.delay')
+    def test_coalescing_can_be_disabled(self, mock_delay):
+        self.graphite_check.save()
+        self.http_check.save()
+        self.assertEqual(mock_delay.call_count, 2)
+
+
+class TestScheduling(unittest.TestCase):
+
+    def test_check_phase_is_stable_and_in_period(self):
+        for check_id in range(1, 100):
+            phase = scheduling.check_phase(check_id, 300)
+            self.assertEqual(phase, scheduling.check_phase(check_id, 300))
+            self.assertTrue(0 <= phase < 300)
+
+    def test_next_slot(self):
+        earliest = datetime(2017, 3, 2, 10, 30, 43, tzinfo=timezone.utc)
+        slot = scheduling.next_slot(7, 5, earliest)
+        self.assertGreaterEqual(slot, earliest)
+        self.assertLess(slot, earliest + timedelta(minutes=5))
+        # The same slot comes round every period
+        self.assertEqual(scheduling.next_slot(7, 5, slot + timedelta(seconds=1)), slot + timedelta(minutes=5))
+
+    @override_settings(ICMP_TIMEOUT=5)
+    def test_icmp_cost_covers_every_packet(self):
+        self.assertEqual(scheduling.expected_cost('icmpstatuscheck', packet_count=1, packet_interval=1.0), 6)
+        self.assertEqual(scheduling.expected_cost('icmpstatuscheck', packet_count=10, packet_interval=2.0), 25)
+
+    def test_spread_countdowns_keeps_preferred_second_when_there_is_room(self):
+        countdowns = scheduling.spread_countdowns([(1, 10, 1.0), (2, 20, 1.0)])
+        self.assertEqual(countdowns, {1: 10, 2: 20})
+
+    def test_spread_countdowns_balances_cost(self):
+        checks = [(check_id, 0, 1.0) for check_id in range(120)]
+        countdowns = scheduling.spread_countdowns(checks)
+        load = [0] * scheduling.SCHEDULE_WINDOW
+        for second in countdowns.values():
+            load[second] += 1
+        self.assertEqual(max(load), 2)
+        self.assertEqual(min(load), 2)
+        self.assertEqual(countdowns, scheduling.spread_countdowns(reversed(checks)))
+
+    def test_spread_countdowns_expensive_checks_get_room(self):
+        countdowns = scheduling.spread_countdowns([(1, 0, 30.0), (2, 0, 1.0), (3, 0, 1.0)])
+        self.assertEqual(countdowns[1], 0)
+        self.assertEqual(countdowns[2], 1)
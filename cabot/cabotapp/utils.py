@@ -1,5 +1,53 @@
+import threading
+import time
+from collections import OrderedDict
+
 from django.contrib.auth import get_user_model
 
 
 def cabot_needs_setup():
     return not get_user_model().objects.all().exists()
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping which holds at most `maxsize` items, evicting the
+    least recently used one when full. Items can also be given a time to
+    live in seconds, after which they are treated as missing.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                return default
+            self._items[key] = (value, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
@@ -5,7 +5,7 @@ from itertools import dropwhile, groupby, izip_longest
 
 import requests
 from alert import AlertPlugin, AlertPluginUserData
-from cabot.cabotapp import alert
+from cabot.cabotapp import alert, metrics, rota
 from cabot.cabotapp.utils import cabot_needs_setup
 from dateutil.relativedelta import relativedelta
 from django import forms
@@ -32,11 +32,13 @@ from models import (GraphiteStatusCheck, HttpStatusCheck, ICMPStatusCheck,
                     Instance, JenkinsStatusCheck, Service, Shift, StatusCheck,
                     StatusCheckResult, UserProfile, get_custom_check_plugins,
                     get_duty_officers)
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from tasks import run_status_check as _run_status_check
 
 from .graphite import get_data, get_matching_metrics
+from .http_checks import InvalidPattern, compile_text_match
 
 
 class LoginRequiredMixin(object):
@@ -200,6 +202,7 @@ class GraphiteStatusCheckForm(StatusCheckForm):
             'importance',
             'expected_num_hosts',
             'allowed_num_failures',
+            'aggregate_in_graphite',
             'debounce',
         )
         widgets = dict(**base_widgets)
@@ -223,6 +226,10 @@ class ICMPStatusCheckForm(StatusCheckForm):
         model = ICMPStatusCheck
         fields = (
             'name',
+            'packet_count',
+            'packet_interval',
+            'max_packet_loss',
+            'max_rtt',
             'frequency',
             'importance',
             'active',
@@ -243,6 +250,8 @@ class HttpStatusCheckForm(StatusCheckForm):
             'status_code',
             'timeout',
             'verify_ssl_certificate',
+            'max_ttfb',
+            'max_total_time',
             'frequency',
             'importance',
             'active',
@@ -272,6 +281,15 @@ class HttpStatusCheckForm(StatusCheckForm):
             }),
         })
 
+    def clean_text_match(self):
+        value = self.cleaned_data['text_match']
+        if value:
+            try:
+                compile_text_match(value)
+            except InvalidPattern as e:
+                raise ValidationError(unicode(e))
+        return value
+
     def clean_password(self):
         new_password_value = self.cleaned_data['password']
         if new_password_value == '':
@@ -792,6 +810,8 @@ class AlertTestView(LoginRequiredMixin, View):
             ).save()
             service.alert()
             transaction.savepoint_rollback(sid)
+            # The test shift is gone again, but may have been loaded
+            rota.invalidate()
 
     def post(self, request):
         form = AlertTestForm(request.POST)
@@ -1073,6 +1093,14 @@ class OnCallView(APIView):
         return Response(users_json)
 
 
+class MetricsView(APIView):
+    """The scheduler and worker metrics, by name"""
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        return Response(metrics.snapshot())
+
+
 # Misc JSON api and other stuff
 
 
@@ -21,6 +21,14 @@ app.conf.beat_schedule = {
         'task': 'cabot.cabotapp.tasks.update_shifts',
         'schedule': timedelta(seconds=1800),
     },
+    'update-metric-index': {
+        'task': 'cabot.cabotapp.tasks.update_metric_index',
+        'schedule': timedelta(seconds=300),
+    },
+    'log-metrics': {
+        'task': 'cabot.cabotapp.tasks.log_metrics',
+        'schedule': timedelta(seconds=settings.METRICS_LOG_INTERVAL),
+    },
     'clean-db': {
         'task': 'cabot.cabotapp.tasks.clean_db',
         'schedule': timedelta(seconds=60 * 60 * 24),
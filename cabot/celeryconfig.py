@@ -1,4 +1,8 @@
 import os
+
+from kombu import Queue
+
+from cabot.cabotapp.scheduling import ALL_CHECK_QUEUES
 from cabot.settings_utils import environ_get_list
 
 broker_url = environ_get_list(['CELERY_BROKER_URL', 'CACHE_URL'])
@@ -7,5 +11,7 @@ broker_url = environ_get_list(['CELERY_BROKER_URL', 'CACHE_URL'])
 task_always_eager = environ_get_list(['CELERY_ALWAYS_EAGER', 'CELERY_TASK_ALWAYS_EAGER'], False)
 backend = os.environ.get('CELERY_RESULT_BACKEND', None)
 task_default_queue = os.environ.get('CELERY_DEFAULT_QUEUE', 'celery')
+# Workers started without -Q consume from all of these
+task_queues = [Queue(task_default_queue)] + [Queue(name) for name in ALL_CHECK_QUEUES]
 
 timezone = 'UTC'
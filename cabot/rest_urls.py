@@ -5,14 +5,14 @@ from django.contrib.auth import models as django_models
 
 from polymorphic.models import PolymorphicModel
 from cabot.cabotapp import models, alert
-from rest_framework import routers, serializers, viewsets, mixins
+from rest_framework import mixins, pagination, routers, serializers, viewsets
 import logging
 
 logger = logging.getLogger(__name__)
 router = routers.DefaultRouter()
 
 
-def create_viewset(arg_model, arg_fields, arg_read_only_fields=(), readonly=False):
+def create_viewset(arg_model, arg_fields, arg_read_only_fields=(), readonly=False, arg_pagination_class=None):
     arg_read_only_fields = ('id',) + arg_read_only_fields
     for field in arg_read_only_fields:
         if field not in arg_fields:
@@ -35,9 +35,16 @@ def create_viewset(arg_model, arg_fields, arg_read_only_fields=(), readonly=Fals
         serializer_class = Serializer
         ordering = ['id']
         filter_fields = arg_fields
+        pagination_class = arg_pagination_class
 
     return ViewSet
 
+
+class StatusCheckResultPagination(pagination.CursorPagination):
+    # Every check's results are kept for days, far too many for one response.
+    # Cursors stay quick however deep a client pages.
+    page_size = 100
+
 check_group_mixin_fields = (
     'name',
     'users_to_notify',
@@ -81,7 +88,12 @@ router.register(r'status_checks', create_viewset(
 
 router.register(r'icmp_checks', create_viewset(
     arg_model=models.ICMPStatusCheck,
-    arg_fields=status_check_fields,
+    arg_fields=status_check_fields + (
+        'packet_count',
+        'packet_interval',
+        'max_packet_loss',
+        'max_rtt',
+    ),
 ))
 
 router.register(r'graphite_checks', create_viewset(
@@ -92,6 +104,7 @@ router.register(r'graphite_checks', create_viewset(
         'value',
         'expected_num_hosts',
         'allowed_num_failures',
+        'aggregate_in_graphite',
     ),
 ))
 
@@ -105,9 +118,35 @@ router.register(r'http_checks', create_viewset(
         'status_code',
         'timeout',
         'verify_ssl_certificate',
+        'max_ttfb',
+        'max_total_time',
     ),
 ))
 
+router.register(r'status_check_results', create_viewset(
+    arg_model=models.StatusCheckResult,
+    arg_fields=(
+        'status_check',
+        'time',
+        'time_complete',
+        'succeeded',
+        'error',
+        'rtt_min',
+        'rtt_avg',
+        'rtt_max',
+        'rtt_stddev',
+        'packet_loss',
+        'dns_time',
+        'connect_time',
+        'tls_time',
+        'ttfb',
+        'body_time',
+        'total_time',
+    ),
+    readonly=True,
+    arg_pagination_class=StatusCheckResultPagination,
+))
+
 router.register(r'jenkins_checks', create_viewset(
     arg_model=models.JenkinsStatusCheck,
     arg_fields=status_check_fields + (
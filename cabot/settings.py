@@ -22,6 +22,17 @@ if os.environ.get('CABOT_FROM_EMAIL'):
 
 DATABASES = {'default': dj_database_url.config()}
 
+# Scheduling state, metrics and rota versions are kept in the cache, which
+# must be shared by the web and worker processes in production, e.g.
+# CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache with
+# CACHE_LOCATION=cabot_cache (created by `manage.py createcachetable`).
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    }
+}
+
 TEST_RUNNER = 'django.test.runner.DiscoverRunner'
 
 URL_PREFIX = os.environ.get('URL_PREFIX', '/').rstrip('/')
@@ -10,7 +10,8 @@ from cabot.cabotapp.views import (
     JenkinsCheckCreateView, JenkinsCheckUpdateView,
     StatusCheckDeleteView, StatusCheckListView, StatusCheckDetailView,
     StatusCheckResultDetailView, StatusCheckReportView, UserProfileUpdateAlert,
-    PluginSettingsView, AlertTestView, AlertTestPluginView, SetupView, OnCallView)
+    PluginSettingsView, AlertTestView, AlertTestPluginView, SetupView, OnCallView,
+    MetricsView)
 
 from cabot.cabotapp.views import (InstanceListView, InstanceDetailView,
     InstanceUpdateView, InstanceCreateView, InstanceDeleteView,
@@ -168,6 +169,7 @@ urlpatterns = [
      url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
      url(r'^api/', include(rest_urls.router.urls)),
      url(r'^api/oncall', view=OnCallView.as_view(), name='oncall'),
+     url(r'^api/metrics', view=MetricsView.as_view(), name='metrics'),
      url(r'^docs/', include_docs_urls(title="Cabot API", description="An API to create and view Cabot checks and services."))
 ]
 